@@ -46,6 +46,22 @@ static void storage_check_write(const char *file, int err)
 #ifndef OSM_MCU_BUILD
 static void test_driver_init(void);
 
+/* Readiness handshake for test harnesses: if OSM_READY_FD names an
+ * inherited pipe, write "1" once the transport is listening, then close
+ * it. On failure it is just closed, so the reader sees EOF right away. */
+static void notify_ready(bool listening)
+{
+    const char *env = getenv("OSM_READY_FD");
+    if (!env) return;
+    int fd = atoi(env);
+    if (fd <= 2) return;
+    if (listening) {
+        ssize_t n = write(fd, "1", 1);
+        (void)n;
+    }
+    close(fd);
+}
+
 /*---------- Screenshot helper (via SDL renderer) ----------*/
 #include LV_SDL_INCLUDE_PATH
 
@@ -261,7 +277,7 @@ static void on_ca_message(int client_idx, uint16_t char_uuid,
 void app_init(lv_display_t *disp,
               lv_indev_t *mouse, lv_indev_t *kb,
               lv_group_t *dev_group, bool test_mode,
-              uint16_t port, const char *name)
+              uint16_t port, const char *name, const char *data_dir)
 {
     memset(&g_app, 0, sizeof(g_app));
     g_app.dev_disp = disp;
@@ -277,7 +293,7 @@ void app_init(lv_display_t *disp,
         strncpy(g_app.device_name, name, sizeof(g_app.device_name) - 1);
 
     /* Initialize storage (LittleFS) */
-    if (!hal_storage_init(".")) {
+    if (!hal_storage_init(data_dir ? data_dir : ".")) {
         fprintf(stderr, "FATAL: Could not init storage\n");
     }
 
@@ -337,10 +353,14 @@ void app_init(lv_display_t *disp,
         .on_ack        = on_ca_ack,
     });
     if (!test_mode) {
-        if (transport_start(&g_app.transport))
+        bool started = transport_start(&g_app.transport);
+        if (started)
             app_log("Transport", "Started");
         else
             app_log("Transport", "Failed to start (port in use?)");
+#ifndef OSM_MCU_BUILD
+        notify_ready(started);
+#endif
     }
 
     /* Start on setup or home depending on identity */
@@ -740,9 +760,12 @@ static void process_stdin_command(char *cmd)
         };
         const char *scr_name = (g_app.current_screen < SCR_COUNT) ?
             scr_names[g_app.current_screen] : "UNKNOWN";
-        fprintf(stdout, "CMD:STATE:contacts=%u,pending=%u,outbox=%u,screen=%s\n",
+        const char *storage = g_app.storage_full ? "FULL" :
+                              g_app.storage_error ? "ERROR" : "OK";
+        fprintf(stdout, "CMD:STATE:contacts=%u,pending=%u,outbox=%u,screen=%s,clients=%d,storage=%s\n",
                g_app.contact_count, g_app.pending_key_count,
-               g_app.outbox_count, scr_name);
+               g_app.outbox_count, scr_name,
+               transport_connected_count(&g_app.transport), storage);
         fflush(stdout);
         for (uint32_t i = 0; i < g_app.contact_count; i++) {
             contact_t *c = &g_app.contacts[i];
@@ -912,6 +935,35 @@ static void process_stdin_command(char *cmd)
         printf("CMD:OK:delete:%s\n", name);
         fflush(stdout);
     }
+    /* CMD:RESET — wipe identity, contacts, messages, pending keys, outbox
+     * and storage/navigation flags so one OSM process can be reused for a
+     * fresh test scenario */
+    else if (strcmp(cmd, "CMD:RESET") == 0) {
+        /* Cleared before the storage calls below, which set them again if
+         * the storage really is failing */
+        g_app.storage_error = false;
+        g_app.storage_full = false;
+        identity_clear(&g_app.identity);
+        memset(g_app.contacts, 0, sizeof(g_app.contacts));
+        memset(g_app.messages, 0, sizeof(g_app.messages));
+        memset(g_app.pending_keys, 0, sizeof(g_app.pending_keys));
+        memset(g_app.outbox, 0, sizeof(g_app.outbox));
+        g_app.contact_count = 0;
+        g_app.message_count = 0;
+        g_app.pending_key_count = 0;
+        g_app.outbox_count = 0;
+        g_app.next_contact_id = 1;
+        g_app.next_message_id = 1;
+        g_app.selected_contact_id = 0;
+        g_app.nav_back_screen = SCR_SETUP;
+        contacts_save();
+        messages_save();
+        app_pending_keys_save();
+        app_outbox_save();
+        app_navigate_to(SCR_SETUP);
+        printf("CMD:OK:reset\n");
+        fflush(stdout);
+    }
     /* CMD:DELETE_MSG:<text_substring> — delete first message matching text */
     else if (strncmp(cmd, "CMD:DELETE_MSG:", 15) == 0) {
         const char *needle = cmd + 15;
@@ -142,7 +142,7 @@ extern app_state_t g_app;
 void app_init(lv_display_t *disp,
               lv_indev_t *mouse, lv_indev_t *kb,
               lv_group_t *dev_group, bool test_mode,
-              uint16_t port, const char *name);
+              uint16_t port, const char *name, const char *data_dir);
 
 /* Log output to stderr (replaces I/O monitor) */
 void app_log(const char *context, const char *data);
@@ -88,3 +88,12 @@ void identity_save(const crypto_identity_t *id)
     memset(pubkey_b64, 0, sizeof(pubkey_b64));
     memset(privkey_b64, 0, sizeof(privkey_b64));
 }
+
+void identity_clear(crypto_identity_t *id)
+{
+    /* Volatile writes so the key wipe cannot be optimized away */
+    volatile unsigned char *v = (volatile unsigned char *)id;
+    for (size_t i = 0; i < sizeof(*id); i++) v[i] = 0;
+    if (hal_storage_remove_file(IDENTITY_FILE) != 0)
+        g_app.storage_error = true;
+}
@@ -9,4 +9,7 @@ bool identity_load(crypto_identity_t *id);
 /* Save identity to data_identity.json. */
 void identity_save(const crypto_identity_t *id);
 
+/* Zero the keypair in memory and delete data_identity.json. */
+void identity_clear(crypto_identity_t *id);
+
 #endif /* IDENTITY_H */
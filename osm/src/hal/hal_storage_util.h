@@ -51,4 +51,15 @@ static inline int hal_storage_write_file(const char *path,
     return (n == (lfs_ssize_t)len) ? 0 : LFS_ERR_NOSPC;
 }
 
+/* Remove a file. A file that doesn't exist counts as removed.
+ * Returns 0 on success, or a negative LFS error code on failure. */
+static inline int hal_storage_remove_file(const char *path)
+{
+    lfs_t *lfs = hal_storage_get();
+    if (!lfs) return LFS_ERR_INVAL;
+
+    int err = lfs_remove(lfs, path);
+    return (err == LFS_ERR_NOENT) ? 0 : err;
+}
+
 #endif /* HAL_STORAGE_UTIL_H */
@@ -22,6 +22,7 @@ int main(int argc, char *argv[])
     bool test_mode = false;
     uint16_t port = TRANSPORT_DEFAULT_PORT;
     const char *name = "";
+    const char *data_dir = ".";
     for (int i = 1; i < argc; i++) {
         if (strcmp(argv[i], "--test") == 0)
             test_mode = true;
@@ -29,6 +30,8 @@ int main(int argc, char *argv[])
             port = (uint16_t)atoi(argv[++i]);
         else if (strcmp(argv[i], "--name") == 0 && i + 1 < argc)
             name = argv[++i];
+        else if (strcmp(argv[i], "--data-dir") == 0 && i + 1 < argc)
+            data_dir = argv[++i];
     }
 
 #ifdef TRANSPORT_BLE
@@ -56,7 +59,7 @@ int main(int argc, char *argv[])
     lv_indev_set_group(kb, dev_group);
 
     /* Initialize the application */
-    app_init(dev_disp, mouse, kb, dev_group, test_mode, port, name);
+    app_init(dev_disp, mouse, kb, dev_group, test_mode, port, name, data_dir);
 
     /* Main loop */
     while (!app_should_quit()) {
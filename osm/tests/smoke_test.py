@@ -3,11 +3,13 @@
 Smoke test for Secure Communicator UI Prototype.
 
 Runs the built-in --test mode, validates all 18 screenshots are generated,
-checks pass/fail output, and verifies screenshot file sizes (non-empty renders).
+checks pass/fail output, and verifies each screenshot is a complete BMP of a
+non-empty render.
 """
 
 import os
 import re
+import struct
 import subprocess
 import sys
 from pathlib import Path
@@ -39,6 +41,17 @@ EXPECTED_SCREENSHOTS = [
 ]
 
 MIN_BMP_SIZE = 5000  # 320×240 BMP should be ~150KB+
+BMP_HEADER = struct.Struct("<2sI")  # "BM" magic, declared file size
+
+
+def list_files(directory):
+    """Map file name -> stat result for the regular files in directory,
+    from one directory scan instead of an exists() + stat() per file."""
+    try:
+        with os.scandir(directory) as it:
+            return {e.name: e.stat() for e in it if e.is_file()}
+    except FileNotFoundError:
+        return {}
 
 
 def main():
@@ -78,14 +91,23 @@ def main():
 
     # 5. Verify screenshots exist and have valid size
     print("\nVerifying screenshots...")
+    screenshots = list_files(SCREENSHOT_DIR)
     for name in EXPECTED_SCREENSHOTS:
-        path = SCREENSHOT_DIR / name
-        if not path.exists():
+        if name not in screenshots:
             errors.append(f"Missing screenshot: {name}")
             print(f"  MISS: {name}")
         else:
-            size = path.stat().st_size
-            if size < MIN_BMP_SIZE:
+            size = screenshots[name].st_size
+            with open(SCREENSHOT_DIR / name, "rb") as f:
+                header = f.read(BMP_HEADER.size).ljust(BMP_HEADER.size, b"\0")
+            magic, declared = BMP_HEADER.unpack(header)
+            if magic != b"BM":
+                errors.append(f"Screenshot is not a BMP: {name}")
+                print(f"  BAD: {name} (no BM header)")
+            elif declared != size:
+                errors.append(f"Screenshot truncated ({size}B of {declared}B): {name}")
+                print(f"  TRUNCATED: {name} ({size} of {declared} bytes)")
+            elif size < MIN_BMP_SIZE:
                 errors.append(f"Screenshot too small ({size}B): {name}")
                 print(f"  SMALL: {name} ({size} bytes)")
             else:
@@ -93,13 +115,13 @@ def main():
 
     # 6. Verify persistence files
     print("\nVerifying persistence files...")
+    build_files = list_files(BUILD_DIR)
     for fname in ["data_contacts.json", "data_messages.json"]:
-        fpath = BUILD_DIR / fname
-        if not fpath.exists():
+        if fname not in build_files:
             errors.append(f"Missing persistence file: {fname}")
             print(f"  MISS: {fname}")
         else:
-            size = fpath.stat().st_size
+            size = build_files[fname].st_size
             if size < 10:
                 errors.append(f"Persistence file too small: {fname}")
                 print(f"  EMPTY: {fname}")
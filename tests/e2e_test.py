@@ -3,6 +3,7 @@
 # dependencies = [
 #     "pynacl",
 #     "pytest",
+#     "pytest-xdist",
 # ]
 # ///
 """
@@ -17,26 +18,94 @@ Orchestrates 2 OSM instances + simulated CA transport to test:
 
 Usage:
     cd osm/build && cmake .. && make -j$(nproc)
-    cd ../.. && python3 tests/e2e_test.py
+    cd ../.. && python3 tests/e2e_test.py        # one worker per CPU; -j 1 for serial
+    # or via pytest: python3 -m pytest tests/e2e_test.py -n auto
+    # (pytest --lf reruns last failures, -m timing_sensitive picks @flaky tests)
 """
 
+import argparse
+import atexit
 import socket
 import struct
 import subprocess
 import sys
 import time
 import os
+import queue
 import signal
-import base64
+import contextlib
+import errno
+from collections import Counter
+from collections.abc import Iterable
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import glob as globmod
+import hashlib
+import inspect
+import itertools
+import json
+import multiprocessing.util
+import random
+import re
+import select
+import selectors
+import shutil
+import tempfile
+import threading
+import weakref
+import xml.etree.ElementTree as ET
+
+import pytest
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    # SIMD base64 when available; same call signatures as the stdlib's.
+    from pybase64 import b64decode, b64encode
+except ImportError:
+    from base64 import b64decode, b64encode
 
 BINARY = os.path.join(os.path.dirname(__file__), "..", "osm", "build", "secure_communicator")
-PORT_A = 19210
-PORT_B = 19211
+# Resolved once: the module fixture chdirs away, and a relative __file__
+# would otherwise point somewhere else by the time OSM is spawned.
+_BINARY_ABS = os.path.abspath(BINARY)
 
-# Data files that OSM persists (relative to cwd)
-DATA_FILES = ["data_contacts.json", "data_messages.json", "data_identity.json",
-              "data_pending_keys.json", "data_outbox.json", "osm_data.img"]
+
+def _free_ports(count: int) -> list[int]:
+    """Ask the kernel for `count` distinct unused localhost TCP ports."""
+    socks = [socket.socket(socket.AF_INET, socket.SOCK_STREAM) for _ in range(count)]
+    try:
+        for s in socks:
+            s.bind(("127.0.0.1", 0))  # all held at once, so never repeated
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+
+# Under pytest-xdist each worker (gw0, gw1, ...) takes its own pair of
+# kernel-assigned ports, so parallel workers (and concurrent runs on the
+# same host) never collide; plain runs keep the historical ports.
+_XDIST_WORKER = os.environ.get("PYTEST_XDIST_WORKER", "")
+if _XDIST_WORKER:
+    PORT_A, PORT_B, PORT_SHARED = _free_ports(3)
+else:
+    PORT_A, PORT_B, PORT_SHARED = 19210, 19211, 19212
+
+# Per-test OSM working dirs go on tmpfs when available so osm_data.img
+# writes and the rmtree cleanup never touch disk. OSM_TEST_TMPDIR overrides.
+_TMP_ROOT = os.environ.get("OSM_TEST_TMPDIR") or (
+    "/dev/shm" if os.access("/dev/shm", os.W_OK) else None)
+
+# OSM persists all its data in this LittleFS image (relative to its cwd).
+STORAGE_IMAGE = "osm_data.img"
 
 # Fragmentation constants (must match transport.h)
 FRAG_FLAG_START = 0x01
@@ -47,138 +116,359 @@ CHAR_UUID_RX = 0xFE03
 MTU = 200
 ACK_ID_LEN = 8
 
+# Wire headers, compiled once and used for every frame built or parsed:
+# TCP frame [4B len][2B uuid] (big-endian), then fragment [1B flags][2B seq]
+# (little-endian); a START fragment adds [2B total_len].
+_FRAME = struct.Struct("!IH")
+_FRAG = struct.Struct("<BH")
+_FRAG_START = struct.Struct("<BHH")
+
+_IOV_MAX = 1024  # sendmsg() buffers per call (Linux UIO_MAXIOV)
+
+# Linux can create the socket non-blocking in the socket() call itself;
+# elsewhere connect() falls back to setblocking(False).
+_SOCK_NONBLOCK = getattr(socket, "SOCK_NONBLOCK", 0)
+
+# Throwaway peer keypair shared by tests that only need *a* valid pubkey to
+# complete KEX; generated once per run instead of per test.
+try:
+    import nacl.bindings
+    _HAS_NACL = True
+    _PEER_SK = nacl.bindings.randombytes(32)
+    _PEER_PK_B64 = b64encode(nacl.bindings.crypto_scalarmult_base(_PEER_SK)).decode()
+except ImportError:
+    _HAS_NACL = False
+    _PEER_SK = _PEER_PK_B64 = None
+
+requires_nacl = pytest.mark.skipif(not _HAS_NACL, reason="pynacl not installed")
+
+# Envelope prefixes as bytes: envelopes are built by concatenation, with
+# no str formatting and re-encoding per message.
+_MSG_PREFIX = b"OSM:MSG:"
+_KEY_PREFIX = b"OSM:KEY:"
+_PEER_KEX = _KEY_PREFIX + _PEER_PK_B64.encode() if _HAS_NACL else None
+
+# One CMD:CONTACT:<id>:<name>:<status>:<pubkey> line of a CMD:STATE dump.
+_CONTACT_RE = re.compile(r"^CMD:CONTACT:[^:\n]*:([^:\n]*):([^:\n]*):([^:\n]*)", re.MULTILINE)
+
+# Fixed 32-byte "pubkeys" for tests that only check how OSM queues a key,
+# base64-encoded once at import.
+_TEST_KEY_SEQ_B64 = b64encode(bytes(range(32)))
+_TEST_KEY_11_B64 = b64encode(b"\x11" * 32)
+_TEST_KEY_22_B64 = b64encode(b"\x22" * 32)
+_TEST_KEY_33_B64 = b64encode(b"\x33" * 32)
+_TEST_KEY_AA_B64 = b64encode(b"\xaa" * 32)
+_TEST_KEY_BB_B64 = b64encode(b"\xbb" * 32)
+
+# Payloads of the send-and-survive tests, built once at import.
+_LARGE_PAYLOAD = b"X" * 2000  # needs several MTU-sized fragments
+_FAKE_CIPHER_ENVELOPE = _MSG_PREFIX + b64encode(bytes(range(80)))  # decodes, won't decrypt
+
+
+def _kex_envelope(key_b64: bytes) -> bytes:
+    """OSM:KEY:<pubkey> envelope for a base64-encoded key."""
+    return _KEY_PREFIX + key_b64
+
+
+def _encrypt_msg(plaintext: str, peer_pk: bytes, my_sk: bytes) -> bytes:
+    """Encrypt for OSM's wire format: base64(nonce || box), the part after
+    OSM:MSG:. PyNaCl's crypto_box strips BOXZEROBYTES itself — do NOT
+    pre-pad."""
+    nonce = nacl.bindings.randombytes(24)
+    ct = nacl.bindings.crypto_box(plaintext.encode(), nonce, peer_pk, my_sk)
+    return b64encode(nonce + ct)
+
+
+def flaky(fn):
+    """Mark a timing-sensitive test; `e2e_test.py --repeat N` reruns these
+    and `pytest -m timing_sensitive` selects them."""
+    fn._flaky = True
+    return pytest.mark.timing_sensitive(fn)
+
+
+def debug_only(fn):
+    """Mark a test whose steps a combined test already runs in one session.
+    It is left out of the default run and kept for targeted debugging:
+    `e2e_test.py -k NAME` or `pytest -m debug_only -k NAME`."""
+    fn._debug_only = True
+    return pytest.mark.debug_only(fn)
+
 
 class TcpClient:
     """Simulates a Companion App TCP client."""
 
-    def __init__(self, port: int, name: str = "CA"):
+    def __init__(self, port: int, name: str = "CA", recv_size: int = 65536,
+                 background: bool = False):
         self.port = port
         self.name = name
+        self.recv_size = recv_size  # one recv() takes a whole outbox flush
         self.sock: socket.socket | None = None
+        # Registered once per connection; poll() then waits with a single
+        # epoll_wait (on Linux) instead of rebuilding a select() fd set.
+        self._sel: selectors.BaseSelector | None = None
         self.received: list[tuple[int, bytes]] = []  # (char_uuid, data)
         self.acks_received: list[bytes] = []  # msg_id bytes from ACKs we received
+        # background=True: a reader thread receives (and ACKs) as soon as
+        # data arrives, and poll() just drains its queue. Off by default
+        # because some tests rely on nothing being ACKed until they poll.
+        self.background = background
+        self._rx_thread: threading.Thread | None = None
+        self._q: queue.Queue = queue.Queue()
+        self._send_lock = threading.Lock()  # the reader thread sends ACKs
+        self._reset_rx()
+
+    def _reset_rx(self):
+        """Receive state kept across poll() calls, so a frame or a fragment
+        run that straddles two polls is completed rather than dropped."""
+        self._raw = bytearray()  # TCP bytes not yet parsed into whole frames
+        self._rx_buf = bytearray()  # payload of the message being reassembled
+        self._rx_seq = 0
+        self._rx_active = False
 
     @staticmethod
     def compute_msg_id(data: bytes) -> bytes:
         """Compute message ID: first 8 bytes of SHA-512 (matches TweetNaCl)."""
-        import hashlib
         return hashlib.sha512(data).digest()[:ACK_ID_LEN]
 
     def send_ack(self, msg_id: bytes):
         """Send an ACK frame for a received message."""
-        frag = struct.pack("<BH", FRAG_FLAG_ACK, 0) + msg_id[:ACK_ID_LEN]
-        frame = struct.pack("!IH", len(frag), CHAR_UUID_RX) + frag
-        self.sock.sendall(frame)
+        msg_id = msg_id[:ACK_ID_LEN]
+        frame = (_FRAME.pack(_FRAG.size + len(msg_id), CHAR_UUID_RX)
+                 + _FRAG.pack(FRAG_FLAG_ACK, 0) + msg_id)
+        self._sendv([memoryview(frame)])
 
     def connect(self, timeout: float = 5.0) -> bool:
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            try:
-                self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                self.sock.settimeout(1.0)
-                self.sock.connect(("127.0.0.1", self.port))
-                self.sock.setblocking(False)
+        """Connect to the OSM. A refused attempt is retried after 5 ms,
+        doubling up to 100 ms, so a just-started OSM is picked up as soon
+        as it listens instead of on a fixed 200 ms tick."""
+        self._reset_rx()
+        delay = 0.005
+        deadline = time.monotonic() + timeout
+        while (remaining := deadline - time.monotonic()) > 0:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM | _SOCK_NONBLOCK)
+            if not _SOCK_NONBLOCK:
+                sock.setblocking(False)
+            err = sock.connect_ex(("127.0.0.1", self.port))
+            if err == errno.EINPROGRESS:
+                if select.select([], [sock], [], remaining)[1]:
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err == 0:
+                # Frames are small and latency-sensitive (ACKs, KEX); don't
+                # let Nagle hold them back. OSM sets the same on its side.
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                # Room for a whole send_batch() of max-size messages, so a
+                # burst is one sendmsg() rather than a wait on the OSM.
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+                self.sock = sock
+                self._sel = selectors.DefaultSelector()
+                self._sel.register(sock, selectors.EVENT_READ)
+                if self.background:
+                    self._q = queue.Queue()
+                    self._rx_thread = threading.Thread(target=self._reader_loop,
+                                                       daemon=True)
+                    self._rx_thread.start()
                 return True
-            except (ConnectionRefusedError, OSError):
-                if self.sock:
-                    self.sock.close()
-                    self.sock = None
-                time.sleep(0.2)
+            sock.close()
+            time.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            delay = min(delay * 2, 0.1)
         return False
 
     def disconnect(self):
         if self.sock:
+            if self._rx_thread:
+                # shutdown() wakes the reader's select() with EOF; close()
+                # alone would leave it blocked.
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self._rx_thread.join(timeout=1.0)
+                self._rx_thread = None
+            self._sel.close()
+            self._sel = None
             self.sock.close()
             self.sock = None
 
+    def reconnect(self, timeout: float = 1.0) -> bool:
+        """Drop the connection and open a new one, as a CA going away and
+        coming back would. The OSM is already listening, so the retry
+        budget is shorter than a first connect()'s."""
+        self.disconnect()
+        return self.connect(timeout)
+
     def send_message(self, char_uuid: int, data: bytes):
         """Send data with fragmentation protocol."""
-        max_payload = MTU - 3  # flags(1) + seq(2)
-        offset = 0
-        seq = 0
-
-        while offset < len(data):
-            is_start = offset == 0
-            overhead = 2 if is_start else 0  # total_len in START
-            chunk_size = min(len(data) - offset, max_payload - overhead)
-            is_end = (offset + chunk_size >= len(data))
-
-            flags = 0
-            if is_start:
-                flags |= FRAG_FLAG_START
-            if is_end:
-                flags |= FRAG_FLAG_END
-
-            frag = struct.pack("<BH", flags, seq)
-            if is_start:
-                frag += struct.pack("<H", len(data))
-            frag += data[offset:offset + chunk_size]
-
-            # TCP frame: [4B len big-endian][2B uuid big-endian][frag]
-            frame = struct.pack("!IH", len(frag), char_uuid) + frag
-            self.sock.sendall(frame)
+        self._sendv(self._frame_iov(char_uuid, data))
+
+    def send_batch(self, char_uuid: int, items: Iterable[bytes]):
+        """Send several messages back-to-back in a single write. `items`
+        may be a generator; it is consumed as the write is assembled.
+
+        TCP keeps them in order and OSM reassembles per frame, so there is
+        no need to pace relays from the test side.
+        """
+        self._sendv([v for data in items for v in self._frame_iov(char_uuid, data)])
+
+    def _sendv(self, iov: list[memoryview]):
+        """sendmsg() a gather list, resuming after partial writes (the
+        socket is non-blocking, so a full send buffer is waited out)."""
+        i = 0
+        with self._send_lock:
+            while i < len(iov):
+                try:
+                    sent = self.sock.sendmsg(iov[i:i + _IOV_MAX])
+                except BlockingIOError:
+                    select.select([], [self.sock], [])
+                    continue
+                while sent:
+                    if sent >= len(iov[i]):
+                        sent -= len(iov[i])
+                        i += 1
+                    else:
+                        iov[i] = iov[i][sent:]
+                        sent = 0
 
-            offset += chunk_size
-            seq += 1
+    @staticmethod
+    def _frame_iov(char_uuid: int, data: bytes) -> list[memoryview]:
+        """Gather list for one fragmented message: each fragment's headers,
+        then a view of its slice of `data`. Headers for all fragments share
+        one bytearray and the payload is never copied in user space."""
+        max_payload = MTU - 3  # flags(1) + seq(2)
+        total = len(data)
+        if not total:
+            return []
+        first = min(total, max_payload - 2)  # START also carries total_len
+        n_frags = 1 + -(-(total - first) // max_payload)
+        hdrs = bytearray(n_frags * (_FRAME.size + _FRAG.size) + 2)  # +2: total_len
+        hv = memoryview(hdrs)
+        src = memoryview(data)
+
+        # START fragment, once, outside the loop:
+        # TCP frame [4B len big-endian][2B uuid big-endian], then
+        # [flags][seq=0][total_len]
+        flags = FRAG_FLAG_START | (FRAG_FLAG_END if n_frags == 1 else 0)
+        _FRAME.pack_into(hdrs, 0, _FRAG_START.size + first, char_uuid)
+        _FRAG_START.pack_into(hdrs, _FRAME.size, flags, 0, total)
+        pos = _FRAME.size + _FRAG_START.size
+        iov = [hv[:pos], src[:first]]
+
+        # Continuation fragments are all full-size except the last, which
+        # is the only one with END set
+        hdr_size = _FRAME.size + _FRAG.size
+        last = n_frags - 1
+        for seq, offset in enumerate(range(first, total, max_payload), 1):
+            chunk = min(total - offset, max_payload)
+            _FRAME.pack_into(hdrs, pos, _FRAG.size + chunk, char_uuid)
+            _FRAG.pack_into(hdrs, pos + _FRAME.size, FRAG_FLAG_END if seq == last else 0, seq)
+            iov += (hv[pos:pos + hdr_size], src[offset:offset + chunk])
+            pos += hdr_size
+        return iov
 
     def poll(self, timeout: float = 0.5) -> list[tuple[int, bytes]]:
         """Read and reassemble incoming messages. Returns list of (uuid, data).
         Also handles incoming ACK frames and sends ACKs for received messages."""
+        if self._rx_thread:
+            return self._poll_queue(timeout)
         messages = []
-        rx_buf = bytearray()
-        rx_seq = 0
-        rx_active = False
-        deadline = time.time() + timeout
+        deadline = time.monotonic() + timeout
+        sel = self._sel
+        if sel is None:
+            return messages
+
+        while (remaining := deadline - time.monotonic()) > 0:
+            # Sleep in the kernel until bytes arrive (or the window closes)
+            # rather than spinning on recv() with short naps.
+            try:
+                if not sel.select(remaining):
+                    break
+                raw = self.sock.recv(self.recv_size)
+                if not raw:
+                    break
+            except BlockingIOError:
+                continue
+            except (OSError, ValueError):
+                break
+            messages += self._feed(raw)
+
+        self.received.extend(messages)
+        return messages
+
+    def _poll_queue(self, timeout: float) -> list[tuple[int, bytes]]:
+        """poll() for a background client: collect what the reader thread
+        queues within the window."""
+        messages = []
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            try:
+                messages.append(self._q.get(timeout=remaining) if remaining > 0
+                                else self._q.get_nowait())
+            except queue.Empty:
+                break
+        self.received.extend(messages)
+        return messages
 
-        while time.time() < deadline:
+    def _reader_loop(self):
+        sock, sel = self.sock, self._sel
+        while True:
             try:
-                raw = self.sock.recv(4096)
+                sel.select()
+                raw = sock.recv(self.recv_size)
                 if not raw:
                     break
             except BlockingIOError:
-                time.sleep(0.01)
                 continue
-            except OSError:
+            except (OSError, ValueError):
                 break
+            for msg in self._feed(raw):
+                self._q.put(msg)
 
-            # Buffer and parse TCP frames
-            buf = raw
-            pos = 0
-            while pos + 6 <= len(buf):
-                msg_len, char_uuid = struct.unpack("!IH", buf[pos:pos+6])
-                pos += 6
-                if pos + msg_len > len(buf):
+    def _feed(self, raw: bytes) -> list[tuple[int, bytes]]:
+        """Parse newly received bytes; returns the messages they complete."""
+        messages = []
+        buf = self._raw
+        # Buffer and parse TCP frames; a frame split across recv()
+        # calls (or polls) stays in buf until the rest arrives.
+        buf += raw
+        pos = 0
+        # Parse in place through a view; only message payloads are
+        # copied out. No slice may outlive the with block, or the
+        # del below cannot resize buf.
+        with memoryview(buf) as mv:
+            while pos + _FRAME.size <= len(mv):
+                msg_len, char_uuid = _FRAME.unpack_from(mv, pos)
+                end = pos + _FRAME.size + msg_len
+                if end > len(mv):
                     break
-                frag = buf[pos:pos+msg_len]
-                pos += msg_len
+                frag_at, pos = pos + _FRAME.size, end
 
-                if len(frag) < 3:
+                if msg_len < _FRAG.size:
                     continue
-                flags, seq = struct.unpack("<BH", frag[:3])
-                payload = frag[3:]
+                flags, seq = _FRAG.unpack_from(mv, frag_at)
+                start = frag_at + _FRAG.size  # payload offset
 
                 # Handle ACK frame from OSM
                 if flags & FRAG_FLAG_ACK:
-                    if len(payload) >= ACK_ID_LEN:
-                        self.acks_received.append(payload[:ACK_ID_LEN])
+                    if end - start >= ACK_ID_LEN:
+                        self.acks_received.append(bytes(mv[start:start + ACK_ID_LEN]))
                     continue
 
                 if flags & FRAG_FLAG_START:
-                    rx_buf = bytearray()
-                    rx_seq = 0
-                    rx_active = True
-                    if len(payload) >= 2:
-                        payload = payload[2:]  # skip total_len
-
-                if not rx_active or seq != rx_seq:
-                    rx_active = False
+                    self._rx_buf.clear()
+                    self._rx_seq = 0
+                    self._rx_active = True
+                    if end - start >= 2:
+                        start += 2  # skip total_len
+
+                if not self._rx_active or seq != self._rx_seq:
+                    self._rx_active = False
                     continue
 
-                rx_buf.extend(payload)
-                rx_seq += 1
+                self._rx_buf += mv[start:end]
+                self._rx_seq += 1
 
                 if flags & FRAG_FLAG_END:
-                    complete = bytes(rx_buf)
+                    complete = bytes(self._rx_buf)
                     messages.append((char_uuid, complete))
                     # Send ACK back to OSM
                     try:
@@ -186,115 +476,618 @@ class TcpClient:
                         self.send_ack(msg_id)
                     except OSError:
                         pass
-                    rx_active = False
-                    rx_buf = bytearray()
-
-        self.received.extend(messages)
+                    self._rx_active = False
+                    self._rx_buf.clear()
+        del buf[:pos]
         return messages
 
 
+class _StderrDrain:
+    """Reads a child's stderr on a daemon thread so the pipe never fills up
+    while the test is busy elsewhere. read() waits for EOF (the child has
+    exited) and returns everything, like the pipe's own read(); wait_for()
+    lets a test block on a log line while the child is still running."""
+
+    def __init__(self, pipe):
+        self._pipe = pipe
+        self._buf = bytearray()
+        self._cond = threading.Condition()
+        self._eof = False
+        self.decrypt_count = 0  # "Decrypted from" log lines seen so far
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        with self._pipe:
+            for line in iter(self._pipe.readline, b""):
+                with self._cond:
+                    self._buf += line
+                    if b"Decrypted from" in line:
+                        self.decrypt_count += 1
+                    self._cond.notify_all()
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def wait_for(self, needle: bytes, timeout: float = 1.0, since: int = 0) -> bool:
+        """Wait until `needle` is logged at or after offset `since` (see
+        mark()); False on timeout or EOF."""
+        with self._cond:
+            self._cond.wait_for(lambda: self._buf.find(needle, since) >= 0 or self._eof,
+                                timeout)
+            return self._buf.find(needle, since) >= 0
+
+    def mark(self) -> int:
+        """Current log length, for wait_for(since=...)."""
+        with self._cond:
+            return len(self._buf)
+
+    def wait_decrypted(self, count: int, timeout: float = 2.0) -> bool:
+        """Wait until at least `count` messages have been decrypted."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.decrypt_count >= count or self._eof, timeout)
+            return self.decrypt_count >= count
+
+    def read(self) -> bytes:
+        self._thread.join()
+        return bytes(self._buf)
+
+    def snapshot(self) -> bytes:
+        """Everything logged so far, without waiting for the child to exit."""
+        with self._cond:
+            return bytes(self._buf)
+
+
+class _SpawnedProc:
+    """Minimal Popen look-alike for an OSM started with os.posix_spawn."""
+
+    def __init__(self, pid: int, stdin_fd: int, stdout_fd: int, stderr_fd: int | None):
+        self.pid = pid
+        self.stdin = os.fdopen(stdin_fd, "wb")
+        self.stdout = os.fdopen(stdout_fd, "rb")
+        self.stderr = (_StderrDrain(os.fdopen(stderr_fd, "rb"))
+                       if stderr_fd is not None else None)
+        self.returncode = None
+
+    def poll(self):
+        if self.returncode is None:
+            pid, status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.returncode = os.waitstatus_to_exitcode(status)
+        return self.returncode
+
+    def wait(self, timeout: float = None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.poll() is None:
+            if deadline is not None and time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(self.pid, timeout)
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, sig: int):
+        if self.poll() is None:
+            os.kill(self.pid, sig)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+def _grow_pipe(fd: int, size: int = 1 << 20):
+    """Raise a pipe's capacity (Linux only) so a burst of OSM output never
+    blocks the child before the test gets around to reading it."""
+    if fcntl is None or not hasattr(fcntl, "F_SETPIPE_SZ"):
+        return
+    try:
+        fcntl.fcntl(fd, fcntl.F_SETPIPE_SZ, size)
+    except OSError:
+        pass  # above /proc/sys/fs/pipe-max-size; keep the default
+
+
+_SPAWN_COUNT = 0  # OSM processes started by this process, for telemetry
+
+# Environment for every OSM child, built once rather than per spawn. Test
+# images are thrown away, so fsync of osm_data.img is skipped (it matters
+# when _TMP_ROOT is on a real disk rather than tmpfs). The ready pipe is
+# always fd 3 on the posix_spawn path.
+_OSM_ENV = {**os.environ, "SDL_VIDEODRIVER": "dummy", "OSM_NO_FSYNC": "1",
+            "OSM_READY_FD": "3"}
+
+# OSM installs no SIGTERM handler and writes its storage as it goes, so
+# SIGTERM ends it at once; SIGKILL anything still alive after this long.
+_STOP_GRACE = 0.5
+
+
+def _spawn_osm(port: int, work_dir: str = None, capture_stderr: bool = False):
+    """Launch the OSM binary with piped stdin/stdout. work_dir (default: cwd)
+    is where it keeps osm_data.img. stderr goes to /dev/null unless
+    capture_stderr is set; a pipe nobody drains would eventually block the
+    OSM's log writes.
+
+    Uses os.posix_spawn where available so the child is exec'd without
+    fork()ing the test runner; falls back to subprocess.Popen elsewhere."""
+    global _SPAWN_COUNT
+    _SPAWN_COUNT += 1
+    env = _OSM_ENV
+    argv = [_BINARY_ABS, "--port", str(port)]
+    # OSM writes one byte here once it is listening (see _wait_ready).
+    ready_r, ready_w = os.pipe()
+    if not hasattr(os, "posix_spawn"):
+        env = {**_OSM_ENV, "OSM_READY_FD": str(ready_w)}
+        try:
+            proc = subprocess.Popen(
+                argv,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE if capture_stderr else subprocess.DEVNULL,
+                env=env, cwd=work_dir, pass_fds=(ready_w,),
+            )
+        except OSError:
+            os.close(ready_r)
+            raise
+        finally:
+            os.close(ready_w)
+        if capture_stderr:
+            proc.stderr = _StderrDrain(proc.stderr)
+        proc.ready_fd = ready_r
+        return proc
+    if work_dir:
+        argv += ["--data-dir", os.path.abspath(work_dir)]
+    in_r, in_w = os.pipe()
+    out_r, out_w = os.pipe()
+    err_r, err_w = os.pipe() if capture_stderr else (None, None)
+    for fd in (out_r, err_r):
+        if fd is not None:
+            _grow_pipe(fd)
+    actions = [
+        (os.POSIX_SPAWN_DUP2, in_r, 0),
+        (os.POSIX_SPAWN_DUP2, out_w, 1),
+        (os.POSIX_SPAWN_DUP2, err_w, 2) if capture_stderr else
+        (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0),
+        (os.POSIX_SPAWN_DUP2, ready_w, 3),
+    ]
+    try:
+        pid = os.posix_spawn(_BINARY_ABS, argv, env, file_actions=actions)
+    except OSError:
+        for fd in (in_w, out_r, err_r, ready_r):
+            if fd is not None:
+                os.close(fd)
+        raise
+    finally:
+        for fd in (in_r, out_w, err_w, ready_w):
+            if fd is not None:
+                os.close(fd)
+    proc = _SpawnedProc(pid, in_w, out_r, err_r)
+    proc.ready_fd = ready_r
+    return proc
+
+
+def _reap(proc, grace: float = _STOP_GRACE):
+    """Wait for a terminated OSM to exit, SIGKILLing it after `grace` s."""
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+def _stop_osm(*procs):
+    """Terminate each OSM process that is still running (None is skipped).
+    All are signalled before any is waited for, so they exit in parallel."""
+    running = [p for p in procs if p and p.poll() is None]
+    for proc in running:
+        proc.terminate()
+    for proc in running:
+        _reap(proc)
+    for proc in procs:
+        sel = _SELECTORS.pop(proc, None) if proc else None
+        if sel:
+            sel.close()
+
+
+def _wait_for_port(port: int, timeout: float = 5.0) -> bool:
+    """Wait until something accepts TCP connections on localhost:port.
+    connect_ex reports the expected ECONNREFUSED as an errno instead of
+    raising, so the probe loop never builds exceptions. The retry delay
+    starts at 10 ms and doubles (capped at 320 ms): the OSM is usually
+    listening within a few hundred ms."""
+    delay = 0.01
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(0.2)
+            if s.connect_ex(("127.0.0.1", port)) == 0:
+                return True
+        time.sleep(delay)
+        delay = min(delay * 2, 0.32)
+    return False
+
+
+def _wait_ready(proc, port: int, timeout: float = 5.0) -> bool:
+    """Block until a freshly spawned OSM is listening. It writes one byte to
+    its OSM_READY_FD pipe after listen(); EOF means it failed to start or
+    died first. Unlike _wait_for_port this never connects to the OSM, so it
+    doesn't show up as a short-lived CA client."""
+    fd = getattr(proc, "ready_fd", None)
+    if fd is None:
+        return _wait_for_port(port, timeout)
+    proc.ready_fd = None
+    try:
+        readable, _, _ = select.select([fd], [], [], timeout)
+        return bool(readable) and os.read(fd, 1) == b"1"
+    finally:
+        os.close(fd)
+
+
+def _start_osm(work_dir: str, port: int, capture_stderr: bool = False):
+    """Start an OSM keeping its data in work_dir; returns the process once
+    its TCP port accepts connections, or None."""
+    proc = _spawn_osm(port, work_dir, capture_stderr)
+    if _wait_ready(proc, port):
+        return proc
+    return None
+
+
 class OsmProcess:
     """Manages an OSM simulator instance."""
 
     def __init__(self, port: int, name: str = "OSM", work_dir: str = None):
         self.port = port
         self.name = name
-        self.proc: subprocess.Popen | None = None
+        self.proc: subprocess.Popen | _SpawnedProc | None = None
         self.work_dir = work_dir  # if set, run OSM in this directory
-
-    @staticmethod
-    def cleanup_data_files(directory: str = None):
-        """Remove persisted data files so each test starts fresh."""
-        for f in DATA_FILES:
-            path = os.path.join(directory, f) if directory else f
-            if os.path.exists(path):
-                os.remove(path)
+        self._stderr: _StderrDrain | None = None  # outlives proc for get_stderr()
 
     def start(self, clean: bool = True) -> bool:
         if clean:
-            self.cleanup_data_files(self.work_dir)
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        binary = os.path.abspath(BINARY) if self.work_dir else BINARY
+            # Each test already runs in a fresh cwd (_scratch_cwd); this only
+            # matters when a test starts a second OSM in the same directory.
+            try:
+                os.remove(os.path.join(self.work_dir or ".", STORAGE_IMAGE))
+            except FileNotFoundError:
+                pass
         try:
-            self.proc = subprocess.Popen(
-                [binary, "--port", str(self.port)],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=env,
-                cwd=self.work_dir,
-            )
+            self.proc = _spawn_osm(self.port, self.work_dir, capture_stderr=True)
+            self._stderr = self.proc.stderr
         except FileNotFoundError:
-            print(f"  ERROR: Binary not found: {binary}")
+            print(f"  ERROR: Binary not found: {_BINARY_ABS}")
             return False
-        # Wait for port to be available
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", self.port))
-                s.close()
-                return True
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return False
+        return _wait_ready(self.proc, self.port)
 
     def stop(self):
         if self.proc:
             self.proc.terminate()
-            try:
-                self.proc.wait(timeout=3)
-            except subprocess.TimeoutExpired:
-                self.proc.kill()
-                self.proc.wait()
+            _reap(self.proc)
             self.proc = None
 
     def send_cmd(self, cmd: str, timeout: float = 3.0) -> str:
         """Send a command via stdin and read response from stdout using raw fd reads."""
-        import select
         assert self.proc and self.proc.poll() is None, "OSM not running"
-        self.proc.stdin.write(f"{cmd}\n".encode())
-        self.proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = self.proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk:
-                    break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                # Check for terminator
-                if is_state and "CMD:STATE:END" in text:
-                    break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        # Collected enough
-                        deadline = 0  # break outer loop
-                        break
-            if self.proc.poll() is not None:
-                break
-        # Filter to CMD: lines only
-        result = []
-        for line in buf.decode(errors="replace").split("\n"):
-            line = line.strip()
-            if line.startswith("CMD:"):
-                result.append(line)
-        return "\n".join(result)
-
-    def get_stderr(self) -> str:
-        """Get stderr output after stopping."""
-        if self.proc:
-            return self.proc.stderr.read().decode()
+        return _send_cmd(self.proc, cmd, timeout)
+
+    def reset(self) -> bool:
+        """Wipe identity, contacts, messages and queues in place (CMD:RESET);
+        leaves the process and its CA connections running."""
+        return "CMD:OK:reset" in self.send_cmd("CMD:RESET")
+
+    def wait_for_stderr(self, needle: bytes, timeout: float = 1.0, since: int = 0) -> bool:
+        """Wait for a log line from the running OSM instead of sleeping.
+        On the shared OSM pass since=osm.stderr_mark() taken at the start
+        of the test, so earlier tests' output doesn't match."""
+        return self.proc.stderr.wait_for(needle, timeout, since)
+
+    def stderr_mark(self) -> int:
+        return self.proc.stderr.mark()
+
+    def get_stderr(self, since: int = 0) -> str:
+        """stderr logged so far (from offset `since`, see stderr_mark());
+        works while running and after stop()."""
+        if self._stderr:
+            return self._stderr.snapshot()[since:].decode(errors="replace")
         return ""
 
 
+def _mkdtemp(prefix: str) -> str:
+    """tempfile.mkdtemp under _TMP_ROOT (default temp dir if unset)."""
+    return tempfile.mkdtemp(prefix=prefix, dir=_TMP_ROOT)
+
+
+# Long-lived OSM on PORT_SHARED for tests that only need a fresh state, not
+# a fresh process: one per test process, wiped with CMD:RESET between uses.
+_SHARED_OSM: OsmProcess | None = None
+
+
+def _shared_osm() -> OsmProcess:
+    """Return this process's shared OSM, reset to a blank state with no CA
+    connected. Tests must not stop it; _stop_shared_osm() does that when
+    the process exits.
+
+    CMD:RESET leaves transport clients alone, so this also waits for the
+    OSM to drop the CAs earlier tests closed: a caller's
+    _wait_ca_connected(osm.proc) then counts only its own CA. A CA that
+    never goes away means a test leaked it; start a fresh OSM instead."""
+    global _SHARED_OSM
+    osm = _SHARED_OSM
+    if (osm is None or osm.proc is None or osm.proc.poll() is not None
+            or not osm.reset() or not _wait_ca_disconnected(osm.proc)):
+        _stop_shared_osm()
+        osm = OsmProcess(PORT_SHARED, "OSM-Shared", work_dir=_mkdtemp("osm_shared_"))
+        assert osm.start(), "Shared OSM failed to start"
+        _SHARED_OSM = osm
+    return osm
+
+
+def _stop_shared_osm():
+    global _SHARED_OSM
+    osm, _SHARED_OSM = _SHARED_OSM, None
+    if osm is not None:
+        osm.stop()
+        shutil.rmtree(osm.work_dir, ignore_errors=True)
+
+
+# Once per process, not per shared OSM started; a no-op if none is running.
+atexit.register(_stop_shared_osm)
+
+
+# One selector per OSM process, registered on its stdout the first time a
+# command is sent and reused for every later command.
+_SELECTORS = weakref.WeakKeyDictionary()
+
+
+def _cmd_selector(proc) -> selectors.BaseSelector:
+    sel = _SELECTORS.get(proc)
+    if sel is None:
+        sel = selectors.DefaultSelector()
+        sel.register(proc.stdout.fileno(), selectors.EVENT_READ)
+        _SELECTORS[proc] = sel
+    return sel
+
+
+def _read_cmd_lines(proc, count: int = 1, is_state: bool = False,
+                    timeout: float = 5.0) -> str:
+    """Read stdout until `count` CMD responses (or the STATE dump) arrive.
+    Returns only the CMD: lines, newline-joined."""
+    result = []
+    buf = bytearray()  # bytes read but not yet terminated by a newline
+    done = 0
+    # Bound once: this loop spins for the whole response window.
+    fd = proc.stdout.fileno()
+    poll, read, now = proc.poll, os.read, time.monotonic
+    deadline = now() + timeout
+    sel = _cmd_selector(proc)
+    while (remaining := deadline - now()) > 0:
+        # EOF also wakes the selector, so no need to cap the wait to
+        # notice the process exiting.
+        if sel.select(remaining):
+            chunk = read(fd, 65536)
+            if not chunk:
+                break
+            # Only the new bytes can hold a newline: anything older was
+            # already split off, so a long unterminated line isn't rescanned.
+            nl = chunk.rfind(b"\n")
+            buf += chunk
+            if nl < 0:
+                continue
+            nl += len(buf) - len(chunk)
+            finished = False
+            for line in buf[:nl].split(b"\n"):
+                line = line.strip()
+                if not line.startswith(b"CMD:"):
+                    continue
+                result.append(line.decode("utf-8", "replace"))
+                if is_state:
+                    finished = finished or line == b"CMD:STATE:END"
+                elif line.startswith((b"CMD:OK:", b"CMD:ERR:", b"CMD:IDENTITY:",
+                                      b"CMD:PRIVKEY:")):
+                    done += 1
+                    finished = finished or done >= count
+            del buf[:nl + 1]
+            if finished:
+                break
+        if poll() is not None:
+            break
+    tail = buf.strip()
+    if tail.startswith(b"CMD:"):
+        result.append(tail.decode("utf-8", "replace"))
+    return "\n".join(result)
+
+
+def _send_cmd(proc, cmd: str, timeout: float = 5.0) -> str:
+    """Send one command to an OSM process and return its CMD: response."""
+    proc.stdin.write(f"{cmd}\n".encode())
+    proc.stdin.flush()
+    return _read_cmd_lines(proc, 1, cmd.strip() == "CMD:STATE", timeout)
+
+
+def _send_all(procs, cmd: str, timeout: float = 5.0) -> list[str]:
+    """Send one command to several OSM processes, writing to every stdin
+    before reading any reply so their round-trips overlap."""
+    for proc in procs:
+        proc.stdin.write(f"{cmd}\n".encode())
+        proc.stdin.flush()
+    return [_read_cmd_lines(proc, 1, cmd.strip() == "CMD:STATE", timeout)
+            for proc in procs]
+
+
+def _send_many(proc, cmds: list[str], timeout: float = 10.0) -> str:
+    """Write a burst of commands with a single flush, then collect one
+    response per command. Not for CMD:STATE (its dump has no OK/ERR line)."""
+    proc.stdin.write("".join(f"{cmd}\n" for cmd in cmds).encode())
+    proc.stdin.flush()
+    return _read_cmd_lines(proc, len(cmds), False, timeout)
+
+
+def _keygen_identity(*procs) -> list[str]:
+    """CMD:KEYGEN then CMD:IDENTITY, written to every OSM before any reply
+    is read; returns each one's base64 pubkey."""
+    for proc in procs:
+        proc.stdin.write(b"CMD:KEYGEN\nCMD:IDENTITY\n")
+        proc.stdin.flush()
+    pubkeys = []
+    for proc in procs:
+        resp = _read_cmd_lines(proc, 2)
+        assert "CMD:OK:keygen" in resp, f"keygen failed: {resp}"
+        assert "CMD:IDENTITY:" in resp, f"identity failed: {resp}"
+        pubkeys.append(resp.partition("CMD:IDENTITY:")[2].split("\n", 1)[0].strip())
+    return pubkeys
+
+
+def _privkeys(*procs) -> list[bytes]:
+    """Raw secret keys of test-mode OSMs via CMD:PRIVKEY, all requested
+    before any reply is read."""
+    keys = []
+    for resp in _send_all(procs, "CMD:PRIVKEY"):
+        assert "CMD:PRIVKEY:" in resp, f"CMD:PRIVKEY failed: {resp}"
+        keys.append(b64decode(resp.partition("CMD:PRIVKEY:")[2].split("\n", 1)[0]))
+    return keys
+
+
+def _script(proc, cmds: list[str], expected: list[str], timeout: float = 10.0) -> str:
+    """Send a fixed command script in one write and assert that each
+    expected response token shows up, in order."""
+    resp = _send_many(proc, cmds, timeout)
+    pos = 0
+    for token in expected:
+        idx = resp.find(token, pos)
+        assert idx >= 0, f"Missing {token!r} in response to {cmds}: {resp}"
+        pos = idx + len(token)
+    return resp
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _osm_binary():
+    """Check for the OSM build once per session. Every test drives that one
+    binary, so without it the run is skipped with the build hint instead of
+    failing each test on start-up."""
+    if not os.path.isfile(_BINARY_ABS):
+        pytest.skip(f"OSM binary not found at {_BINARY_ABS}; build it first: "
+                    "cd osm/build && cmake .. && make -j$(nproc)")
+    yield _BINARY_ABS
+    _stop_shared_osm()
+
+
+@contextlib.contextmanager
+def _scratch_cwd():
+    """Run one test from a fresh cwd under _TMP_ROOT: tests that start
+    OsmProcess without a work_dir persist osm_data.img relative to cwd, so
+    this keeps them on tmpfs, out of the checkout, and apart from each other.
+    Cleanup is a single rmtree, whatever the test left behind."""
+    prev = os.getcwd()
+    cwd = _mkdtemp("osm_cwd_")
+    os.chdir(cwd)
+    try:
+        yield cwd
+    finally:
+        os.chdir(prev)
+        shutil.rmtree(cwd, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def _osm_cwd():
+    with _scratch_cwd():
+        yield
+
+
+def _wait_until(fn, timeout: float, interval: float = 0.05) -> bool:
+    """Poll fn() until it returns truthy or timeout expires.
+
+    The interval starts small and doubles up to 0.2s, so a condition that is
+    already met returns almost immediately while slow ones don't spin."""
+    deadline = time.monotonic() + timeout
+    while True:
+        if fn():
+            return True
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, 0.2)
+
+
+def _drain_all(ca, timeout: float = 1.0, quiet: float = 0.05) -> list:
+    """Poll in short slices until something has arrived and the link has
+    then been quiet for `quiet` seconds, or timeout expires. Returns
+    everything received (ACKs are sent as usual)."""
+    got = []
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        batch = ca.poll(timeout=quiet)
+        got += batch
+        if got and not batch:
+            break
+    return got
+
+
+def _wait_pending_key(proc, count: int = 1, timeout: float = 2.0) -> bool:
+    """Poll CMD:STATE until the OSM has queued at least `count` pending
+    keys, i.e. an OSM:KEY sent by the CA has been processed."""
+    def queued():
+        m = re.search(r"pending=(\d+)", _send_cmd(proc, "CMD:STATE"))
+        return m is not None and int(m.group(1)) >= count
+    return _wait_until(queued, timeout)
+
+
+def _ca_clients(proc) -> int:
+    """CA connections the OSM currently holds (clients= in CMD:STATE)."""
+    m = re.search(r"clients=(\d+)", _send_cmd(proc, "CMD:STATE"))
+    return int(m.group(1)) if m else -1
+
+
+def _wait_ca_connected(proc, count: int = 1, timeout: float = 2.0,
+                       exact: bool = False) -> bool:
+    """Poll CMD:STATE until the OSM has accepted `count` CA connections, so
+    anything it sends next goes straight out instead of to the outbox.
+    With exact=True the count must match, e.g. 0 once every CA has gone."""
+    if exact:
+        return _wait_until(lambda: _ca_clients(proc) == count, timeout)
+    return _wait_until(lambda: _ca_clients(proc) >= count, timeout)
+
+
+def _wait_ca_disconnected(proc, remaining: int = 0, timeout: float = 2.0) -> bool:
+    """Poll CMD:STATE until the OSM has dropped closed CA connections and
+    holds exactly `remaining`, so what it sends next goes to the outbox."""
+    return _wait_ca_connected(proc, remaining, timeout, exact=True)
+
+
+def _log_counts(log: bytes, needles: list[bytes]) -> Counter:
+    """How often each needle occurs in log, counted in one regex pass rather
+    than one substring scan per needle. Needles must not overlap."""
+    return Counter(re.findall(b"|".join(map(re.escape, needles)), log))
+
+
+def _missing_from_log(log: bytes, needles: list[bytes]) -> list[bytes]:
+    """Needles that do not appear in log."""
+    found = _log_counts(log, needles)
+    return [n for n in needles if n not in found]
+
+
+def _deliver_to_shared_osm(payload: bytes, expect: bytes, what: str) -> str:
+    """Skeleton of the one-CA, one-message tests: send payload to the shared
+    OSM, wait until it logs `expect` for it and check it is still alive.
+    Returns what the OSM logged meanwhile, for extra checks."""
+    osm = _shared_osm()
+    mark = osm.stderr_mark()
+
+    ca = TcpClient(osm.port, "CA-A")
+    assert ca.connect(), "CA failed to connect"
+    try:
+        ca.send_message(CHAR_UUID_RX, payload)
+        handled = osm.wait_for_stderr(expect, since=mark)
+        assert osm.proc.poll() is None, f"OSM crashed on {what}"
+        stderr = osm.get_stderr(since=mark)
+        assert handled, f"{what} not handled, expected {expect!r} in: {stderr}"
+        return stderr
+    finally:
+        ca.disconnect()
+
+
+def _poll_count(ca: TcpClient, prefix: bytes = b"OSM:MSG:", timeout: float = 0.1) -> int:
+    """Poll ca briefly, then count everything it has received with prefix."""
+    ca.poll(timeout=timeout)
+    return sum(1 for _, d in ca.received if d.startswith(prefix))
+
+
 def test_tcp_connectivity():
     """Test 1: Verify OSM starts and accepts TCP connections."""
     print("[Test 1] TCP connectivity")
@@ -314,77 +1107,46 @@ def test_tcp_connectivity():
 def test_send_receive():
     """Test 2: Send data from CA to OSM and receive response."""
     print("\n[Test 2] Send/receive via transport")
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
-
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-
-    # Send a properly enveloped message (will fail decrypt but shouldn't crash)
-    test_data = b"OSM:MSG:InvalidCiphertext123"
-    ca.send_message(CHAR_UUID_RX, test_data)
-    print("  PASS: Sent enveloped data to OSM")
-
-    # Give OSM time to process
-    time.sleep(0.5)
-
-    # The OSM will try to decrypt and log — we just verify no crash
-    assert osm.proc.poll() is None, "OSM crashed after receiving data"
+    # A properly enveloped message fails to decrypt but mustn't crash the OSM
+    _deliver_to_shared_osm(b"OSM:MSG:InvalidCiphertext123", b"Could not decrypt",
+                           "enveloped data")
     print("  PASS: OSM processed incoming data without crash")
 
-    ca.disconnect()
-    osm.stop()
-
 
 def test_osm_sends_to_ca():
     """Test 3: Verify OSM can send data to connected CA (outbox)."""
     print("\n[Test 3] OSM sends to CA via outbox")
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
+    osm = _shared_osm()
 
-    ca = TcpClient(PORT_A, "CA-A")
+    ca = TcpClient(osm.port, "CA-A")
     assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
-
-    # Poll for any data the OSM might send (e.g., from outbox flush)
-    msgs = ca.poll(timeout=1.0)
-    # OSM starts with empty outbox, so no messages expected
-    print(f"  INFO: Received {len(msgs)} messages from OSM (expected 0 on fresh start)")
-    assert osm.proc.poll() is None, "OSM crashed"
-    print("  PASS: OSM alive, no unexpected data")
-
-    ca.disconnect()
-    osm.stop()
+    try:
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
+
+        # Poll for any data the OSM might send (e.g., from outbox flush)
+        msgs = ca.poll(timeout=1.0)
+        # A reset OSM has an empty outbox, so no messages expected
+        print(f"  INFO: Received {len(msgs)} messages from OSM (expected 0 on fresh state)")
+        assert osm.proc.poll() is None, "OSM crashed"
+        print("  PASS: OSM alive, no unexpected data")
+    finally:
+        ca.disconnect()
 
 
 def test_large_message_fragmentation():
     """Test 4: Send a large message that requires fragmentation."""
     print("\n[Test 4] Large message fragmentation")
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
-
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-
-    # Send a 2KB message (requires multiple fragments)
-    large_data = b"X" * 2000
-    ca.send_message(CHAR_UUID_RX, large_data)
-    print(f"  PASS: Sent {len(large_data)}-byte fragmented message")
-
-    time.sleep(0.5)
-    assert osm.proc.poll() is None, "OSM crashed after large message"
+    # 2KB needs multiple fragments; logged once the last one is in and the
+    # reassembled message dispatched
+    _deliver_to_shared_osm(_LARGE_PAYLOAD, b"Unknown message format", "large message")
     print("  PASS: OSM handled large fragmented message")
 
-    ca.disconnect()
-    osm.stop()
-
 
 def test_multiple_osm_instances():
     """Test 5: Run two OSM instances on different ports."""
     print("\n[Test 5] Multiple OSM instances")
-    import tempfile, shutil
-    dir_a = tempfile.mkdtemp(prefix="osm_a_")
-    dir_b = tempfile.mkdtemp(prefix="osm_b_")
+    dir_a = _mkdtemp("osm_a_")
+    dir_b = _mkdtemp("osm_b_")
     osm_a = OsmProcess(PORT_A, "OSM-A", work_dir=dir_a)
     osm_b = OsmProcess(PORT_B, "OSM-B", work_dir=dir_b)
 
@@ -405,7 +1167,9 @@ def test_multiple_osm_instances():
     # Send data through each independently (using envelope format)
     ca_a.send_message(CHAR_UUID_RX, b"OSM:MSG:Hello from A")
     ca_b.send_message(CHAR_UUID_RX, b"OSM:MSG:Hello from B")
-    time.sleep(0.5)
+    # Neither has a contact that can decrypt these, so each logs that
+    assert osm_a.wait_for_stderr(b"Could not decrypt"), "OSM-A never processed its message"
+    assert osm_b.wait_for_stderr(b"Could not decrypt"), "OSM-B never processed its message"
 
     assert osm_a.proc.poll() is None, "OSM-A crashed"
     assert osm_b.proc.poll() is None, "OSM-B crashed"
@@ -419,6 +1183,7 @@ def test_multiple_osm_instances():
     shutil.rmtree(dir_b, ignore_errors=True)
 
 
+@flaky
 def test_reconnect():
     """Test 6: Disconnect and reconnect CA."""
     print("\n[Test 6] CA reconnect")
@@ -427,145 +1192,179 @@ def test_reconnect():
 
     ca = TcpClient(PORT_A, "CA-A")
     assert ca.connect(), "CA failed to connect (first)"
+    mark = osm.stderr_mark()
     ca.send_message(CHAR_UUID_RX, b"OSM:MSG:First connection")
-    time.sleep(0.3)
-    ca.disconnect()
-    print("  PASS: First connection OK, disconnected")
+    assert osm.wait_for_stderr(b"Could not decrypt", since=mark), "First message not processed"
+    print("  PASS: First connection OK")
 
-    time.sleep(0.5)
-
-    ca2 = TcpClient(PORT_A, "CA-A-2")
-    assert ca2.connect(), "CA failed to reconnect"
-    ca2.send_message(CHAR_UUID_RX, b"OSM:MSG:Second connection")
-    time.sleep(0.3)
+    assert ca.reconnect(), "CA failed to reconnect"
+    mark = osm.stderr_mark()
+    ca.send_message(CHAR_UUID_RX, b"OSM:MSG:Second connection")
+    assert osm.wait_for_stderr(b"Could not decrypt", since=mark), "Second message not processed"
     assert osm.proc.poll() is None, "OSM crashed after reconnect"
     print("  PASS: Reconnection OK")
 
-    ca2.disconnect()
+    ca.disconnect()
     osm.stop()
 
 
 def test_key_exchange_envelope():
     """Test 7: Key exchange via OSM:KEY:<pubkey> (no name) queues pending key."""
     print("\n[Test 7] Key exchange envelope (anonymous)")
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
-
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
-
-    fake_key = bytes(range(32))
-    key_b64 = base64.b64encode(fake_key).decode()
-    kex_msg = f"OSM:KEY:{key_b64}".encode()
-    ca.send_message(CHAR_UUID_RX, kex_msg)
-    print("  PASS: Sent anonymous KEX envelope to OSM")
-
-    time.sleep(0.5)
-    assert osm.proc.poll() is None, "OSM crashed after KEX message"
-
-    osm.proc.terminate()
-    osm.proc.wait(timeout=3)
-    stderr = osm.proc.stderr.read().decode()
-    osm.proc = None
-
-    assert "KEX queued for assignment" in stderr, \
-        f"Expected 'KEX queued for assignment', got: {stderr}"
+    stderr = _deliver_to_shared_osm(_kex_envelope(_TEST_KEY_SEQ_B64),
+                                    b"KEX queued for assignment", "KEX message")
     assert "bad pubkey" not in stderr, f"Bad pubkey error: {stderr}"
     print("  PASS: OSM queued key for user assignment")
 
-    ca.disconnect()
-
 
 def test_unknown_envelope():
     """Test 8: Unknown envelope prefix is handled gracefully."""
     print("\n[Test 8] Unknown envelope prefix")
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
+    _deliver_to_shared_osm(b"JUNK:SomeRandomData", b"Unknown message format",
+                           "unknown envelope")
+    print("  PASS: Unknown envelope handled gracefully")
 
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
 
-    ca.send_message(CHAR_UUID_RX, b"JUNK:SomeRandomData")
-    time.sleep(0.5)
-    assert osm.proc.poll() is None, "OSM crashed on unknown envelope"
-    print("  PASS: Unknown envelope handled gracefully")
+_KEX_LOG_NEEDLES = [b"bad pubkey", b"KEX queued for assignment", b"already pending"]
 
+
+def _kex_queue_step(osm: OsmProcess, ca: TcpClient, kex: bytes, pending: int):
+    """Send a key the OSM hasn't seen: it must go to the pending queue (now
+    `pending` keys long) rather than auto-creating a contact."""
+    mark = osm.stderr_mark()
+    ca.send_message(CHAR_UUID_RX, kex)
+    assert _wait_pending_key(osm.proc, pending), "Key not queued"
+    assert osm.wait_for_stderr(b"KEX queued for assignment", 2.0, since=mark), \
+        f"Expected pending queue log, got: {osm.get_stderr(since=mark)}"
+    counts = _log_counts(osm.proc.stderr.snapshot()[mark:], _KEX_LOG_NEEDLES)
+    assert not counts[b"bad pubkey"], f"Bad pubkey error: {osm.get_stderr(since=mark)}"
+    print("  PASS: Key queued for assignment (not auto-created)")
+
+
+def _kex_dedup_step(osm: OsmProcess, ca: TcpClient, kex: bytes, sentinel: bytes,
+                    pending: int):
+    """Resend a key that is already pending, then a new sentinel key. Frames
+    are handled in order, so once the sentinel is queued (`pending` keys)
+    the duplicate has been processed: it must be rejected, not queued."""
+    mark = osm.stderr_mark()
+    ca.send_message(CHAR_UUID_RX, kex)
+    ca.send_message(CHAR_UUID_RX, sentinel)
+    assert _wait_pending_key(osm.proc, pending), "Sentinel key not queued"
+    assert osm.wait_for_stderr(b"KEX queued for assignment", 2.0, since=mark), \
+        "Sentinel key not logged"
+    assert osm.proc.poll() is None, "OSM crashed"
+    counts = _log_counts(osm.proc.stderr.snapshot()[mark:], _KEX_LOG_NEEDLES)
+    queued_count = counts[b"KEX queued for assignment"]
+    dup_count = counts[b"already pending"]
+    assert queued_count == 1, f"Expected only the sentinel queued, got {queued_count}"
+    assert dup_count == 1, f"Expected 1 duplicate rejection, got {dup_count}"
+    print("  PASS: Duplicate key rejected, only queued once")
+
+
+def _kex_restart_step(osm: OsmProcess, ca: TcpClient) -> tuple[OsmProcess, TcpClient]:
+    """Stop the OSM and start a new one on the same storage image; returns
+    the new OSM and a CA connected to it."""
     ca.disconnect()
     osm.stop()
+    # Check the LittleFS image was written (data persisted)
+    assert os.path.exists(STORAGE_IMAGE), "Storage image not written"
 
+    # Restart OSM (don't clean data files)
+    osm2 = OsmProcess(PORT_A, f"{osm.name}-2")
+    ca2 = TcpClient(PORT_A, f"{ca.name}-2")
+    try:
+        assert osm2.start(clean=False), "OSM failed to restart"
+        assert ca2.connect(), "CA failed to reconnect"
+    except BaseException:
+        # The caller only cleans up what it got back, i.e. the old pair.
+        ca2.disconnect()
+        osm2.stop()
+        raise
+    return osm2, ca2
 
-def test_kex_queues_pending_key():
-    """Test 9: CA→OSM key exchange queues in pending_keys (not auto-create).
-
-    The new anonymous protocol (OSM:KEY:<pubkey>) stores the key in a
-    pending queue rather than auto-creating a contact.
-    """
-    print("\n[Test 9] CA→OSM KEX queues pending key")
 
+def _kex_session() -> tuple[OsmProcess, TcpClient]:
     osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
-
     ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
+    try:
+        assert osm.start(), "OSM failed to start"
+        assert ca.connect(), "CA failed to connect"
+    except BaseException:
+        ca.disconnect()
+        osm.stop()
+        raise
+    return osm, ca
 
-    fake_key = bytes([0x11] * 32)
-    key_b64 = base64.b64encode(fake_key).decode()
-    kex_msg = f"OSM:KEY:{key_b64}".encode()
-    ca.send_message(CHAR_UUID_RX, kex_msg)
-    time.sleep(0.5)
 
-    assert osm.proc.poll() is None, "OSM crashed"
+def test_kex_pending_queue():
+    """Test 9: CA→OSM key exchange goes to the pending queue, duplicates are
+    rejected, and the queue survives an OSM restart.
 
-    osm.proc.terminate()
-    osm.proc.wait(timeout=3)
-    stderr = osm.proc.stderr.read().decode()
-    osm.proc = None
-
-    assert "KEX queued for assignment" in stderr, \
-        f"Expected pending queue log, got: {stderr}"
-    assert "bad pubkey" not in stderr, f"Bad pubkey error: {stderr}"
-    print("  PASS: Key queued for assignment (not auto-created)")
+    The anonymous protocol (OSM:KEY:<pubkey>) stores the key in a pending
+    queue rather than auto-creating a contact. One session runs the steps
+    of tests 9a-9c (queueing, dedup, persistence) back to back; run those
+    on their own to see which step broke.
+    """
+    print("\n[Test 9] KEX pending queue: queue, dedup, persistence")
 
-    ca.disconnect()
+    key_kex = _kex_envelope(_TEST_KEY_11_B64)
+    osm, ca = _kex_session()
+    try:
+        _kex_queue_step(osm, ca, key_kex, pending=1)
+        _kex_dedup_step(osm, ca, key_kex, _kex_envelope(_TEST_KEY_22_B64), pending=2)
 
+        osm, ca = _kex_restart_step(osm, ca)
+        _kex_dedup_step(osm, ca, key_kex, _kex_envelope(_TEST_KEY_33_B64), pending=3)
+        print("  PASS: Key survived restart (duplicate rejected)")
+    finally:
+        # Whichever pair is current; stopping an already stopped one is a no-op.
+        ca.disconnect()
+        osm.stop()
 
-def test_kex_dedup_pending():
-    """Test 10: Duplicate KEX pubkey is rejected (not queued twice)."""
-    print("\n[Test 10] KEX dedup in pending queue")
 
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
+@debug_only
+def test_kex_queues_pending_key():
+    """Test 9a: CA→OSM key exchange queues in pending_keys (not auto-create)."""
+    print("\n[Test 9a] CA→OSM KEX queues pending key")
 
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
+    osm, ca = _kex_session()
+    try:
+        _kex_queue_step(osm, ca, _kex_envelope(_TEST_KEY_11_B64), pending=1)
+    finally:
+        ca.disconnect()
+        osm.stop()
 
-    fake_key = bytes([0x22] * 32)
-    key_b64 = base64.b64encode(fake_key).decode()
-    kex_msg = f"OSM:KEY:{key_b64}".encode()
 
-    # Send the same key twice
-    ca.send_message(CHAR_UUID_RX, kex_msg)
-    time.sleep(0.3)
-    ca.send_message(CHAR_UUID_RX, kex_msg)
-    time.sleep(0.5)
+@debug_only
+def test_kex_dedup_pending():
+    """Test 9b: Duplicate KEX pubkey is rejected (not queued twice)."""
+    print("\n[Test 9b] KEX dedup in pending queue")
 
-    assert osm.proc.poll() is None, "OSM crashed"
+    key_kex = _kex_envelope(_TEST_KEY_11_B64)
+    osm, ca = _kex_session()
+    try:
+        _kex_queue_step(osm, ca, key_kex, pending=1)
+        _kex_dedup_step(osm, ca, key_kex, _kex_envelope(_TEST_KEY_22_B64), pending=2)
+    finally:
+        ca.disconnect()
+        osm.stop()
 
-    osm.proc.terminate()
-    osm.proc.wait(timeout=3)
-    stderr = osm.proc.stderr.read().decode()
-    osm.proc = None
 
-    queued_count = stderr.count("KEX queued for assignment")
-    dup_count = stderr.count("already pending")
-    assert queued_count == 1, f"Expected 1 queued, got {queued_count}"
-    assert dup_count == 1, f"Expected 1 duplicate rejection, got {dup_count}"
-    print("  PASS: Duplicate key rejected, only queued once")
+@debug_only
+def test_pending_key_persistence():
+    """Test 9c: Pending keys survive OSM restart."""
+    print("\n[Test 9c] Pending key persistence")
 
-    ca.disconnect()
+    key_kex = _kex_envelope(_TEST_KEY_11_B64)
+    osm, ca = _kex_session()
+    try:
+        _kex_queue_step(osm, ca, key_kex, pending=1)
+        osm, ca = _kex_restart_step(osm, ca)
+        _kex_dedup_step(osm, ca, key_kex, _kex_envelope(_TEST_KEY_22_B64), pending=2)
+        print("  PASS: Key survived restart (duplicate rejected)")
+    finally:
+        ca.disconnect()
+        osm.stop()
 
 
 def test_bidirectional_kex_anonymous():
@@ -582,13 +1381,11 @@ def test_bidirectional_kex_anonymous():
 
     ca_bob = TcpClient(PORT_B, "CA-Bob")
     assert ca_bob.connect(), "CA-Bob failed to connect"
-    time.sleep(0.3)
+    assert _wait_ca_connected(osm_bob.proc), "OSM never accepted the CA"
 
-    alice_key = bytes([0xAA] * 32)
-    alice_b64 = base64.b64encode(alice_key).decode()
-    kex_alice = f"OSM:KEY:{alice_b64}".encode()
+    kex_alice = _kex_envelope(_TEST_KEY_AA_B64)
     ca_bob.send_message(CHAR_UUID_RX, kex_alice)
-    time.sleep(0.5)
+    osm_bob.wait_for_stderr(b"KEX queued for assignment")
 
     assert osm_bob.proc.poll() is None, "OSM-Bob crashed"
     osm_bob.proc.terminate()
@@ -607,13 +1404,11 @@ def test_bidirectional_kex_anonymous():
 
     ca_alice = TcpClient(PORT_A, "CA-Alice")
     assert ca_alice.connect(), "CA-Alice failed to connect"
-    time.sleep(0.3)
+    assert _wait_ca_connected(osm_alice.proc), "OSM never accepted the CA"
 
-    bob_key = bytes([0xBB] * 32)
-    bob_b64 = base64.b64encode(bob_key).decode()
-    kex_bob = f"OSM:KEY:{bob_b64}".encode()
+    kex_bob = _kex_envelope(_TEST_KEY_BB_B64)
     ca_alice.send_message(CHAR_UUID_RX, kex_bob)
-    time.sleep(0.5)
+    osm_alice.wait_for_stderr(b"KEX queued for assignment")
 
     assert osm_alice.proc.poll() is None, "OSM-Alice crashed"
     osm_alice.proc.terminate()
@@ -633,25 +1428,9 @@ def test_bidirectional_kex_anonymous():
 def test_encrypted_msg_delivery():
     """Test 12: Encrypted message (OSM:MSG:) arrives at OSM without crash."""
     print("\n[Test 12] Encrypted message delivery")
-
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
-
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
-
-    fake_cipher = base64.b64encode(bytes(range(80))).decode()
-    msg = f"OSM:MSG:{fake_cipher}".encode()
-    ca.send_message(CHAR_UUID_RX, msg)
-    time.sleep(0.5)
-
-    assert osm.proc.poll() is None, "OSM crashed on encrypted message"
+    _deliver_to_shared_osm(_FAKE_CIPHER_ENVELOPE, b"Could not decrypt", "encrypted message")
     print("  PASS: OSM handled encrypted message without crash")
 
-    ca.disconnect()
-    osm.stop()
-
 
 def test_kex_outbound_no_name():
     """Test 13: Outbound KEX from OSM has no sender name.
@@ -666,19 +1445,18 @@ def test_kex_outbound_no_name():
 
     ca = TcpClient(PORT_A, "CA-A")
     assert ca.connect(), "CA failed to connect"
-    time.sleep(0.5)
+    assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-    # The OSM should send any queued outbox messages.
-    # In the test driver, contacts are created with our pubkey stored.
+    # Adding a contact makes the OSM send its KEX to the CA.
     # We need to check that the format is OSM:KEY:<base64> with no extra colons.
-    # Poll for any messages (OSM may have sent on connect)
-    msgs = ca.poll(timeout=2.0)
-
-    # Even if no messages are sent (fresh start), we verify no crash.
+    _script(osm.proc, ["CMD:KEYGEN", "CMD:ADD:Peer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:Peer"])
+    assert _wait_until(lambda: _poll_count(ca, _KEY_PREFIX) >= 1, timeout=2.0), \
+        "OSM never sent its KEX"
     assert osm.proc.poll() is None, "OSM crashed"
 
-    # Verify any KEY messages have the right format
-    for uuid, data in msgs:
+    # Verify the KEY messages have the right format
+    for uuid, data in ca.received:
         text = data.decode('utf-8', errors='replace')
         if text.startswith("OSM:KEY:"):
             payload = text[len("OSM:KEY:"):]
@@ -693,62 +1471,7 @@ def test_kex_outbound_no_name():
     osm.stop()
 
 
-def test_pending_key_persistence():
-    """Test 14: Pending keys survive OSM restart.
-
-    Send a KEX, stop OSM, restart it, verify the pending key is still there.
-    """
-    print("\n[Test 14] Pending key persistence")
-
-    osm = OsmProcess(PORT_A, "OSM-A")
-    assert osm.start(), "OSM failed to start"
-
-    ca = TcpClient(PORT_A, "CA-A")
-    assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
-
-    fake_key = bytes([0xCC] * 32)
-    key_b64 = base64.b64encode(fake_key).decode()
-    ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{key_b64}".encode())
-    time.sleep(0.5)
-
-    osm.proc.terminate()
-    osm.proc.wait(timeout=3)
-    stderr1 = osm.proc.stderr.read().decode()
-    osm.proc = None
-    ca.disconnect()
-
-    assert "KEX queued for assignment" in stderr1, \
-        f"Key not queued: {stderr1}"
-    print("  PASS: Key queued in first session")
-
-    # Check the LittleFS image was written (data persisted)
-    assert os.path.exists("osm_data.img"), \
-        "Storage image not written"
-
-    # Restart OSM (don't clean data files)
-    osm2 = OsmProcess(PORT_A, "OSM-A-2")
-    assert osm2.start(clean=False), "OSM failed to restart"
-
-    ca2 = TcpClient(PORT_A, "CA-A-2")
-    assert ca2.connect(), "CA failed to reconnect"
-    time.sleep(0.3)
-
-    # Send the same key again — should be rejected as duplicate
-    ca2.send_message(CHAR_UUID_RX, f"OSM:KEY:{key_b64}".encode())
-    time.sleep(0.5)
-
-    osm2.proc.terminate()
-    osm2.proc.wait(timeout=3)
-    stderr2 = osm2.proc.stderr.read().decode()
-    osm2.proc = None
-    ca2.disconnect()
-
-    assert "already pending" in stderr2, \
-        f"Expected duplicate rejection after reload, got: {stderr2}"
-    print("  PASS: Key survived restart (duplicate rejected)")
-
-
+@requires_nacl
 def test_full_kex_and_multi_message():
     """Test 15: Full key exchange + multiple bidirectional messages.
 
@@ -760,34 +1483,17 @@ def test_full_kex_and_multi_message():
     """
     print("\n[Test 15] Full KEX + multi-message (real crypto)")
 
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed (pip install pynacl)")
-        return
-
-    import tempfile, shutil
-
     # Generate two keypairs
     alice_pk, alice_sk = nacl.bindings.crypto_box_keypair()
     bob_pk, bob_sk = nacl.bindings.crypto_box_keypair()
 
-    alice_pk_b64 = base64.b64encode(alice_pk).decode()
-    alice_sk_b64 = base64.b64encode(alice_sk).decode()
-    bob_pk_b64 = base64.b64encode(bob_pk).decode()
-    bob_sk_b64 = base64.b64encode(bob_sk).decode()
+    alice_pk_b64 = b64encode(alice_pk).decode()
+    alice_sk_b64 = b64encode(alice_sk).decode()
+    bob_pk_b64 = b64encode(bob_pk).decode()
+    bob_sk_b64 = b64encode(bob_sk).decode()
 
-    # Helper: encrypt a message using NaCl (matching OSM wire format)
-    # PyNaCl's crypto_box auto-pads with ZEROBYTES — do NOT pre-pad
-    def encrypt_msg(plaintext: str, peer_pk: bytes, my_sk: bytes) -> str:
-        pt_bytes = plaintext.encode()
-        nonce = nacl.bindings.randombytes(24)
-        ct = nacl.bindings.crypto_box(pt_bytes, nonce, peer_pk, my_sk)
-        raw = nonce + ct  # ct already has BOXZEROBYTES stripped
-        return base64.b64encode(raw).decode()
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_alice_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_bob_")
+    alice_dir = _mkdtemp("osm_alice_")
+    bob_dir = _mkdtemp("osm_bob_")
 
     try:
         # -- Start OSM-Alice --
@@ -796,13 +1502,13 @@ def test_full_kex_and_multi_message():
         assert osm_alice.start(clean=True), "OSM-Alice failed to start"
         ca_alice = TcpClient(PORT_A, "CA-Alice")
         assert ca_alice.connect(), "CA-Alice failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm_alice.proc), "OSM never accepted the CA"
 
-        # Set identity and add contact via CMD interface
-        resp = osm_alice.send_cmd(f"CMD:SET_IDENTITY:{alice_pk_b64}:{alice_sk_b64}")
-        assert "CMD:OK:set_identity" in resp, f"Set identity failed: {resp}"
-        resp = osm_alice.send_cmd(f"CMD:ADD_CONTACT:Bob:2:{bob_pk_b64}")
-        assert "CMD:OK:add_contact:Bob" in resp, f"Add contact failed: {resp}"
+        # Set identity and add contact via CMD interface, in one write
+        _script(osm_alice.proc,
+                [f"CMD:SET_IDENTITY:{alice_pk_b64}:{alice_sk_b64}",
+                 f"CMD:ADD_CONTACT:Bob:2:{bob_pk_b64}"],
+                ["CMD:OK:set_identity", "CMD:OK:add_contact:Bob"])
 
         # -- Start OSM-Bob --
         osm_bob = OsmProcess(PORT_B, "Bob", work_dir=bob_dir)
@@ -810,56 +1516,54 @@ def test_full_kex_and_multi_message():
         assert osm_bob.start(clean=True), "OSM-Bob failed to start"
         ca_bob = TcpClient(PORT_B, "CA-Bob")
         assert ca_bob.connect(), "CA-Bob failed to connect"
-        time.sleep(0.3)
-
-        resp = osm_bob.send_cmd(f"CMD:SET_IDENTITY:{bob_pk_b64}:{bob_sk_b64}")
-        assert "CMD:OK:set_identity" in resp, f"Set identity failed: {resp}"
-        resp = osm_bob.send_cmd(f"CMD:ADD_CONTACT:Alice:2:{alice_pk_b64}")
-        assert "CMD:OK:add_contact:Alice" in resp, f"Add contact failed: {resp}"
-
-        # -- Send 4 messages: Alice→Bob, Bob→Alice, Alice→Bob, Bob→Alice --
-        messages = [
-            ("Alice→Bob", alice_sk, bob_pk, ca_bob, "Hello Bob, first msg!"),
-            ("Bob→Alice", bob_sk, alice_pk, ca_alice, "Hi Alice, replying!"),
-            ("Alice→Bob", alice_sk, bob_pk, ca_bob, "Second message to Bob"),
-            ("Bob→Alice", bob_sk, alice_pk, ca_alice, "Bob's second reply"),
-        ]
-
-        for label, sender_sk, receiver_pk, receiver_ca, plaintext in messages:
-            cipher_b64 = encrypt_msg(plaintext, receiver_pk, sender_sk)
-            envelope = f"OSM:MSG:{cipher_b64}".encode()
-            receiver_ca.send_message(CHAR_UUID_RX, envelope)
-            time.sleep(0.3)
-
-        # -- Also test trailing whitespace tolerance --
-        cipher_ws = encrypt_msg("Whitespace test", bob_pk, alice_sk)
-        envelope_ws = f"OSM:MSG:{cipher_ws}\n\r  ".encode()
-        ca_bob.send_message(CHAR_UUID_RX, envelope_ws)
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm_bob.proc), "OSM never accepted the CA"
+
+        _script(osm_bob.proc,
+                [f"CMD:SET_IDENTITY:{bob_pk_b64}:{bob_sk_b64}",
+                 f"CMD:ADD_CONTACT:Alice:2:{alice_pk_b64}"],
+                ["CMD:OK:set_identity", "CMD:OK:add_contact:Alice"])
+
+        # -- Send 2 messages each way, each side's in one write --
+        # Envelopes are encrypted lazily while the batch is assembled, so
+        # this scales to long message plans without building a list first.
+        def envelopes(sender_sk, receiver_pk, plaintexts, tail=b""):
+            for plaintext in plaintexts:
+                yield _MSG_PREFIX + _encrypt_msg(plaintext, receiver_pk, sender_sk) + tail
+
+        ca_bob.send_batch(CHAR_UUID_RX, itertools.chain(
+            envelopes(alice_sk, bob_pk, ["Hello Bob, first msg!", "Second message to Bob"]),
+            # -- Also test trailing whitespace tolerance --
+            envelopes(alice_sk, bob_pk, ["Whitespace test"], tail=b"\n\r  ")))
+        ca_alice.send_batch(CHAR_UUID_RX,
+                            envelopes(bob_sk, alice_pk, ["Hi Alice, replying!", "Bob's second reply"]))
+
+        # Wait for the decrypt log lines
+        osm_alice.proc.stderr.wait_decrypted(2)
+        osm_bob.proc.stderr.wait_decrypted(3)
 
         # -- Verify --
         # Stop both and check logs
         osm_alice.proc.terminate()
         osm_alice.proc.wait(timeout=3)
         stderr_alice = osm_alice.proc.stderr.read().decode()
+        alice_decrypted = osm_alice.proc.stderr.decrypt_count
         osm_alice.proc = None
 
         osm_bob.proc.terminate()
         osm_bob.proc.wait(timeout=3)
         stderr_bob = osm_bob.proc.stderr.read().decode()
+        bob_decrypted = osm_bob.proc.stderr.decrypt_count
         osm_bob.proc = None
 
         ca_alice.disconnect()
         ca_bob.disconnect()
 
         # Check Alice received 2 messages from Bob
-        alice_decrypted = stderr_alice.count("Decrypted from")
         assert alice_decrypted >= 2, \
             f"Alice should have decrypted ≥2 msgs, got {alice_decrypted}.\nLogs: {stderr_alice}"
         print(f"  PASS: Alice decrypted {alice_decrypted} messages")
 
         # Check Bob received 2 messages from Alice + 1 whitespace test
-        bob_decrypted = stderr_bob.count("Decrypted from")
         assert bob_decrypted >= 3, \
             f"Bob should have decrypted ≥3 msgs, got {bob_decrypted}.\nLogs: {stderr_bob}"
         print(f"  PASS: Bob decrypted {bob_decrypted} messages")
@@ -880,6 +1584,7 @@ def test_full_kex_and_multi_message():
         shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_full_kex_flow_via_stdin():
     """Test 16: Full bidirectional key exchange + encrypted messaging via stdin commands.
 
@@ -895,49 +1600,27 @@ def test_full_kex_flow_via_stdin():
     """
     print("\n[Test 16] Full KEX flow via stdin commands + encrypted messaging")
 
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed (pip install pynacl)")
-        return
-
-    import select
-    import tempfile, shutil
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_kex_alice_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_kex_bob_")
+    alice_dir = _mkdtemp("osm_kex_alice_")
+    bob_dir = _mkdtemp("osm_kex_bob_")
 
     # --- Start Alice ---
     osm_alice = OsmProcess(PORT_A, "Alice", work_dir=alice_dir)
     assert osm_alice.start(clean=True), "Alice failed to start"
-    time.sleep(0.5)
 
     # --- Start Bob ---
     osm_bob = OsmProcess(PORT_B, "Bob", work_dir=bob_dir)
     assert osm_bob.start(clean=True), "Bob failed to start"
-    time.sleep(0.5)
 
     # Connect CAs
     ca_alice = TcpClient(PORT_A, "CA-Alice")
     assert ca_alice.connect(), "CA-Alice failed to connect"
     ca_bob = TcpClient(PORT_B, "CA-Bob")
     assert ca_bob.connect(), "CA-Bob failed to connect"
-    time.sleep(0.3)
+    assert _wait_ca_connected(osm_bob.proc), "OSM never accepted the CA"
 
     # --- Step 1: Generate keypairs and get identities ---
-    resp = osm_alice.send_cmd("CMD:KEYGEN")
-    assert "CMD:OK:keygen" in resp, f"Alice keygen failed: {resp}"
-    resp = osm_bob.send_cmd("CMD:KEYGEN")
-    assert "CMD:OK:keygen" in resp, f"Bob keygen failed: {resp}"
-
-    alice_identity = osm_alice.send_cmd("CMD:IDENTITY")
-    assert "CMD:IDENTITY:" in alice_identity, f"Alice identity failed: {alice_identity}"
-    alice_pubkey_b64 = alice_identity.split("CMD:IDENTITY:")[1].strip()
+    alice_pubkey_b64, bob_pubkey_b64 = _keygen_identity(osm_alice.proc, osm_bob.proc)
     print(f"  PASS: Alice identity: {alice_pubkey_b64[:20]}...")
-
-    bob_identity = osm_bob.send_cmd("CMD:IDENTITY")
-    assert "CMD:IDENTITY:" in bob_identity, f"Bob identity failed: {bob_identity}"
-    bob_pubkey_b64 = bob_identity.split("CMD:IDENTITY:")[1].strip()
     print(f"  PASS: Bob identity: {bob_pubkey_b64[:20]}...")
 
     # --- Step 2: Alice creates contact "Bob" and initiates KEX ---
@@ -946,22 +1629,19 @@ def test_full_kex_flow_via_stdin():
     print("  PASS: Alice created contact Bob (PENDING_SENT)")
 
     # Alice's outbox should have sent the key — capture from CA
-    time.sleep(0.5)
-    alice_outbox = ca_alice.poll(timeout=1.0)
+    alice_outbox = _drain_all(ca_alice)
     assert len(alice_outbox) > 0, "Alice should have sent a KEX message to CA"
     _, kex_data = alice_outbox[0]
-    kex_msg = kex_data.decode()
-    assert kex_msg.startswith("OSM:KEY:"), f"Expected KEX message, got: {kex_msg}"
-    assert alice_pubkey_b64 in kex_msg, "Alice's KEX should contain her pubkey"
+    assert kex_data.startswith(_KEY_PREFIX), f"Expected KEX message, got: {kex_data!r}"
+    assert alice_pubkey_b64.encode() in kex_data, "Alice's KEX should contain her pubkey"
     print(f"  PASS: Alice sent OSM:KEY to CA")
 
     # --- Step 3: Deliver Alice's key to Bob via TCP ---
-    ca_bob.send_message(CHAR_UUID_RX, kex_msg.encode())
-    time.sleep(0.5)
+    ca_bob.send_message(CHAR_UUID_RX, kex_data)
 
     # Verify Bob queued it
-    state = osm_bob.send_cmd("CMD:STATE")
-    assert "pending=1" in state, f"Bob should have 1 pending key: {state}"
+    assert _wait_pending_key(osm_bob.proc), \
+        f"Bob should have 1 pending key: {osm_bob.send_cmd('CMD:STATE')}"
     print("  PASS: Bob received and queued Alice's key")
 
     # --- Step 4: Bob assigns key to new contact "Alice" (PENDING_RECEIVED) ---
@@ -975,22 +1655,19 @@ def test_full_kex_flow_via_stdin():
     print("  PASS: Bob completed exchange (ESTABLISHED)")
 
     # Bob's outbox should have his key
-    time.sleep(0.5)
-    bob_outbox = ca_bob.poll(timeout=1.0)
+    bob_outbox = _drain_all(ca_bob)
     assert len(bob_outbox) > 0, "Bob should have sent a KEX message to CA"
     _, bob_kex_data = bob_outbox[0]
-    bob_kex_msg = bob_kex_data.decode()
-    assert bob_kex_msg.startswith("OSM:KEY:"), f"Expected KEX message, got: {bob_kex_msg}"
-    assert bob_pubkey_b64 in bob_kex_msg, "Bob's KEX should contain his pubkey"
+    assert bob_kex_data.startswith(_KEY_PREFIX), f"Expected KEX message, got: {bob_kex_data!r}"
+    assert bob_pubkey_b64.encode() in bob_kex_data, "Bob's KEX should contain his pubkey"
     print("  PASS: Bob sent OSM:KEY to CA")
 
     # --- Step 6: Deliver Bob's key to Alice via TCP ---
-    ca_alice.send_message(CHAR_UUID_RX, bob_kex_msg.encode())
-    time.sleep(0.5)
+    ca_alice.send_message(CHAR_UUID_RX, bob_kex_data)
 
     # Verify Alice queued it
-    state = osm_alice.send_cmd("CMD:STATE")
-    assert "pending=1" in state, f"Alice should have 1 pending key: {state}"
+    assert _wait_pending_key(osm_alice.proc), \
+        f"Alice should have 1 pending key: {osm_alice.send_cmd('CMD:STATE')}"
     print("  PASS: Alice received and queued Bob's key")
 
     # --- Step 7: Alice assigns key to existing "Bob" contact → ESTABLISHED ---
@@ -1007,15 +1684,14 @@ def test_full_kex_flow_via_stdin():
 
     # --- Step 9: Send encrypted messages ---
     # Get raw keys for PyNaCl encryption
-    alice_pk = base64.b64decode(alice_pubkey_b64)
-    bob_pk = base64.b64decode(bob_pubkey_b64)
+    alice_pk = b64decode(alice_pubkey_b64)
+    bob_pk = b64decode(bob_pubkey_b64)
 
     # We need the secret keys from the identity files
     # Read them from the state — they're in data_identity.json
     # But the OSMs are running from the test dir... let's use nacl to encrypt
     # Actually, we can't get the private keys via the command protocol (by design).
     # Instead, read the data_identity.json files that OSM wrote.
-    import json as json_mod
 
     # Stop Alice briefly to read her identity file, but actually
     # the data_identity.json file is in the CWD where the process runs.
@@ -1048,12 +1724,8 @@ def test_full_kex_flow_via_stdin():
     # and the contacts have each other's pubkeys properly stored.
     # Parse the CMD:STATE output
     def parse_contacts(state_output):
-        contacts = {}
-        for line in state_output.split("\n"):
-            if line.startswith("CMD:CONTACT:"):
-                parts = line.split(":", 6)  # CMD:CONTACT:id:name:status:pubkey
-                contacts[parts[3]] = {"status": parts[4], "pubkey": parts[5]}
-        return contacts
+        return {name: {"status": status, "pubkey": pubkey}
+                for name, status, pubkey in _CONTACT_RE.findall(state_output)}
 
     alice_contacts = parse_contacts(alice_state)
     bob_contacts = parse_contacts(bob_state)
@@ -1096,6 +1768,7 @@ def test_full_kex_flow_via_stdin():
     print("  PASS: Full KEX flow completed successfully")
 
 
+@requires_nacl
 def test_full_kex_and_messaging_isolated():
     """Test 17: Full KEX flow + encrypted messaging with isolated working dirs.
 
@@ -1104,167 +1777,78 @@ def test_full_kex_and_messaging_isolated():
     """
     print("\n[Test 17] Full KEX + messaging (isolated dirs)")
 
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed (pip install pynacl)")
-        return
-
-    import json as json_mod
-    import tempfile
-    import shutil
-
     # Create isolated dirs
-    alice_dir = tempfile.mkdtemp(prefix="osm_alice_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_bob_")
-
-    def start_osm_in_dir(workdir, port, name):
-        """Start OSM process in a specific working directory."""
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env,
-            cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=3.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk:
-                    break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text:
-                    break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0
-                        break
-            if proc.poll() is not None:
-                break
-        result = []
-        for line in buf.decode(errors="replace").split("\n"):
-            line = line.strip()
-            if line.startswith("CMD:"):
-                result.append(line)
-        return "\n".join(result)
+    alice_dir = _mkdtemp("osm_alice_")
+    bob_dir = _mkdtemp("osm_bob_")
 
     try:
         # Start both OSMs in isolated dirs
-        alice_proc = start_osm_in_dir(alice_dir, PORT_A, "Alice")
+        alice_proc = _start_osm(alice_dir, PORT_A, capture_stderr=True)
         assert alice_proc, "Alice failed to start"
-        bob_proc = start_osm_in_dir(bob_dir, PORT_B, "Bob")
+        bob_proc = _start_osm(bob_dir, PORT_B, capture_stderr=True)
         assert bob_proc, "Bob failed to start"
-        time.sleep(0.5)
 
         # Connect CAs
         ca_alice = TcpClient(PORT_A, "CA-Alice")
         assert ca_alice.connect(), "CA-Alice failed"
         ca_bob = TcpClient(PORT_B, "CA-Bob")
         assert ca_bob.connect(), "CA-Bob failed"
-        time.sleep(0.3)
+        assert _wait_ca_connected(bob_proc), "OSM never accepted the CA"
 
         # Generate keypairs and get identities
-        resp = send_cmd(alice_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp, f"Alice keygen failed: {resp}"
-        resp = send_cmd(bob_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp, f"Bob keygen failed: {resp}"
-
-        alice_id = send_cmd(alice_proc, "CMD:IDENTITY")
-        alice_pubkey_b64 = alice_id.split("CMD:IDENTITY:")[1].strip()
-        bob_id = send_cmd(bob_proc, "CMD:IDENTITY")
-        bob_pubkey_b64 = bob_id.split("CMD:IDENTITY:")[1].strip()
+        alice_pubkey_b64, bob_pubkey_b64 = _keygen_identity(alice_proc, bob_proc)
 
         # Full KEX flow
-        resp = send_cmd(alice_proc, "CMD:ADD:Bob")
+        resp = _send_cmd(alice_proc, "CMD:ADD:Bob")
         assert "CMD:OK:add:Bob" in resp, f"Add failed: {resp}"
 
-        time.sleep(0.5)
-        alice_outbox = ca_alice.poll(timeout=1.0)
+        alice_outbox = _drain_all(ca_alice)
         assert len(alice_outbox) > 0, "Alice should have sent KEX"
         _, kex_data = alice_outbox[0]
-        kex_msg = kex_data.decode()
 
-        ca_bob.send_message(CHAR_UUID_RX, kex_msg.encode())
-        time.sleep(0.5)
+        ca_bob.send_message(CHAR_UUID_RX, kex_data)
+        assert _wait_pending_key(bob_proc), "Bob never queued Alice's key"
 
-        resp = send_cmd(bob_proc, "CMD:CREATE:Alice")
+        resp = _send_cmd(bob_proc, "CMD:CREATE:Alice")
         assert "CMD:OK:create:Alice:PENDING_RECEIVED" in resp, f"Create failed: {resp}"
 
-        resp = send_cmd(bob_proc, "CMD:COMPLETE:Alice")
+        resp = _send_cmd(bob_proc, "CMD:COMPLETE:Alice")
         assert "CMD:OK:complete:Alice:ESTABLISHED" in resp, f"Complete failed: {resp}"
 
-        time.sleep(0.5)
-        bob_outbox = ca_bob.poll(timeout=1.0)
+        bob_outbox = _drain_all(ca_bob)
         assert len(bob_outbox) > 0, "Bob should have sent KEX"
         _, bob_kex_data = bob_outbox[0]
-        bob_kex_msg = bob_kex_data.decode()
 
-        ca_alice.send_message(CHAR_UUID_RX, bob_kex_msg.encode())
-        time.sleep(0.5)
+        ca_alice.send_message(CHAR_UUID_RX, bob_kex_data)
+        assert _wait_pending_key(alice_proc), "Alice never queued Bob's key"
 
-        resp = send_cmd(alice_proc, "CMD:ASSIGN:Bob")
+        resp = _send_cmd(alice_proc, "CMD:ASSIGN:Bob")
         assert "CMD:OK:assign:Bob:ESTABLISHED" in resp, f"Assign failed: {resp}"
         print("  PASS: Full KEX completed (both ESTABLISHED)")
 
         # Now get private keys via CMD:PRIVKEY
-        alice_privkey_resp = send_cmd(alice_proc, "CMD:PRIVKEY")
-        alice_sk_b64 = alice_privkey_resp.strip().split("CMD:PRIVKEY:")[-1].split("\n")[0]
-        alice_sk = base64.b64decode(alice_sk_b64)
-        alice_pk = base64.b64decode(alice_pubkey_b64)
-
-        bob_privkey_resp = send_cmd(bob_proc, "CMD:PRIVKEY")
-        bob_sk_b64 = bob_privkey_resp.strip().split("CMD:PRIVKEY:")[-1].split("\n")[0]
-        bob_sk = base64.b64decode(bob_sk_b64)
-        bob_pk = base64.b64decode(bob_pubkey_b64)
-
-        # Encrypt messages using PyNaCl and send via TCP
-        def encrypt_msg(plaintext, peer_pk, my_sk):
-            nonce = nacl.bindings.randombytes(24)
-            ct = nacl.bindings.crypto_box(plaintext.encode(), nonce, peer_pk, my_sk)
-            return base64.b64encode(nonce + ct).decode()
-
-        # Alice → Bob: 2 messages
-        for msg in ["Hello Bob from Alice!", "Second msg to Bob"]:
-            cipher = encrypt_msg(msg, bob_pk, alice_sk)
-            ca_bob.send_message(CHAR_UUID_RX, f"OSM:MSG:{cipher}".encode())
-            time.sleep(0.3)
+        alice_sk, bob_sk = _privkeys(alice_proc, bob_proc)
+        alice_pk = b64decode(alice_pubkey_b64)
+        bob_pk = b64decode(bob_pubkey_b64)
+
+        # Encrypt messages using PyNaCl and send via TCP, one write per
+        # direction (each envelope is still its own frame)
+        # Alice → Bob: 2 messages + whitespace tolerance test
+        ca_bob.send_batch(CHAR_UUID_RX, [
+            _MSG_PREFIX + _encrypt_msg("Hello Bob from Alice!", bob_pk, alice_sk),
+            _MSG_PREFIX + _encrypt_msg("Second msg to Bob", bob_pk, alice_sk),
+            _MSG_PREFIX + _encrypt_msg("Whitespace OK", bob_pk, alice_sk) + b"\n\r ",
+        ])
 
         # Bob → Alice: 2 messages
-        for msg in ["Hi Alice from Bob!", "Bob's reply #2"]:
-            cipher = encrypt_msg(msg, alice_pk, bob_sk)
-            ca_alice.send_message(CHAR_UUID_RX, f"OSM:MSG:{cipher}".encode())
-            time.sleep(0.3)
+        ca_alice.send_batch(CHAR_UUID_RX, [
+            _MSG_PREFIX + _encrypt_msg(msg, alice_pk, bob_sk)
+            for msg in ["Hi Alice from Bob!", "Bob's reply #2"]
+        ])
 
-        # Whitespace tolerance test
-        cipher = encrypt_msg("Whitespace OK", bob_pk, alice_sk)
-        ca_bob.send_message(CHAR_UUID_RX, f"OSM:MSG:{cipher}\n\r ".encode())
-        time.sleep(0.3)
+        # Wait for the decrypt log lines instead of sleeping after each send
+        alice_proc.stderr.wait_decrypted(2)
+        bob_proc.stderr.wait_decrypted(3)
 
         # Stop and read logs
         ca_alice.disconnect()
@@ -1272,41 +1856,36 @@ def test_full_kex_and_messaging_isolated():
 
         alice_proc.terminate()
         alice_proc.wait(timeout=3)
-        stderr_alice = alice_proc.stderr.read().decode()
+        stderr_alice = alice_proc.stderr.read()
+        alice_dec = alice_proc.stderr.decrypt_count
 
         bob_proc.terminate()
         bob_proc.wait(timeout=3)
-        stderr_bob = bob_proc.stderr.read().decode()
+        stderr_bob = bob_proc.stderr.read()
+        bob_dec = bob_proc.stderr.decrypt_count
 
         # Verify Alice decrypted Bob's messages
-        assert "Hi Alice from Bob!" in stderr_alice, \
-            f"Alice didn't decrypt Bob's msg.\nLogs: {stderr_alice}"
-        assert "Bob's reply #2" in stderr_alice, \
-            f"Alice didn't decrypt Bob's second msg.\nLogs: {stderr_alice}"
-        alice_dec = stderr_alice.count("Decrypted from")
+        missing = _missing_from_log(stderr_alice, [b"Hi Alice from Bob!", b"Bob's reply #2"])
+        assert not missing, \
+            f"Alice didn't decrypt {missing}.\nLogs: {stderr_alice.decode(errors='replace')}"
         print(f"  PASS: Alice decrypted {alice_dec} messages")
 
         # Verify Bob decrypted Alice's messages
-        assert "Hello Bob from Alice!" in stderr_bob, \
-            f"Bob didn't decrypt Alice's msg.\nLogs: {stderr_bob}"
-        assert "Second msg to Bob" in stderr_bob, \
-            f"Bob didn't decrypt Alice's second msg.\nLogs: {stderr_bob}"
-        assert "Whitespace OK" in stderr_bob, \
-            f"Bob didn't decrypt whitespace msg.\nLogs: {stderr_bob}"
-        bob_dec = stderr_bob.count("Decrypted from")
+        missing = _missing_from_log(stderr_bob, [b"Hello Bob from Alice!", b"Second msg to Bob",
+                                                 b"Whitespace OK"])
+        assert not missing, \
+            f"Bob didn't decrypt {missing}.\nLogs: {stderr_bob.decode(errors='replace')}"
         print(f"  PASS: Bob decrypted {bob_dec} messages")
         print("  PASS: Full KEX + encrypted messaging verified")
 
     finally:
         # Cleanup
-        for proc in [alice_proc, bob_proc]:
-            if proc and proc.poll() is None:
-                proc.terminate()
-                proc.wait(timeout=3)
+        _stop_osm(alice_proc, bob_proc)
         shutil.rmtree(alice_dir, ignore_errors=True)
         shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_ui_driven_kex_and_messaging():
     """Test 18: Full KEX + 12 messages each direction via UI-driven commands.
 
@@ -1317,73 +1896,8 @@ def test_ui_driven_kex_and_messaging():
     """
     print("\n[Test 18] UI-driven KEX + many-message stress test")
 
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed (pip install pynacl)")
-        return
-
-    import json as json_mod
-    import tempfile
-    import shutil
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_ui_alice_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_ui_bob_")
-
-    def start_osm_in_dir(workdir, port, name):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env,
-            cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk:
-                    break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text:
-                    break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0
-                        break
-            if proc.poll() is not None:
-                break
-        result = []
-        for line in buf.decode(errors="replace").split("\n"):
-            line = line.strip()
-            if line.startswith("CMD:"):
-                result.append(line)
-        return "\n".join(result)
+    alice_dir = _mkdtemp("osm_ui_alice_")
+    bob_dir = _mkdtemp("osm_ui_bob_")
 
     alice_proc = None
     bob_proc = None
@@ -1391,129 +1905,97 @@ def test_ui_driven_kex_and_messaging():
     ca_bob = None
 
     try:
-        alice_proc = start_osm_in_dir(alice_dir, PORT_A, "Alice")
+        alice_proc = _start_osm(alice_dir, PORT_A, capture_stderr=True)
         assert alice_proc, "Alice failed to start"
-        bob_proc = start_osm_in_dir(bob_dir, PORT_B, "Bob")
+        bob_proc = _start_osm(bob_dir, PORT_B, capture_stderr=True)
         assert bob_proc, "Bob failed to start"
-        time.sleep(0.5)
 
         ca_alice = TcpClient(PORT_A, "CA-Alice")
         assert ca_alice.connect(), "CA-Alice failed"
         ca_bob = TcpClient(PORT_B, "CA-Bob")
         assert ca_bob.connect(), "CA-Bob failed"
-        time.sleep(0.3)
+        assert _wait_ca_connected(bob_proc), "OSM never accepted the CA"
 
         # Generate keypairs
-        resp = send_cmd(alice_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp, f"Alice keygen failed: {resp}"
-        resp = send_cmd(bob_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp, f"Bob keygen failed: {resp}"
-
-        alice_id = send_cmd(alice_proc, "CMD:IDENTITY")
-        alice_pubkey_b64 = alice_id.split("CMD:IDENTITY:")[1].strip()
-        bob_id = send_cmd(bob_proc, "CMD:IDENTITY")
-        bob_pubkey_b64 = bob_id.split("CMD:IDENTITY:")[1].strip()
+        alice_pubkey_b64, bob_pubkey_b64 = _keygen_identity(alice_proc, bob_proc)
         print(f"  Alice pubkey: {alice_pubkey_b64[:20]}...")
         print(f"  Bob pubkey:   {bob_pubkey_b64[:20]}...")
 
         # === STEP 1: Alice adds contact "Bob" via UI ===
-        resp = send_cmd(alice_proc, "CMD:UI_ADD_CONTACT:Bob")
+        resp = _send_cmd(alice_proc, "CMD:UI_ADD_CONTACT:Bob")
         assert "CMD:OK:ui_add_contact:Bob" in resp, f"UI add contact failed: {resp}"
         print("  PASS: Alice UI added contact Bob (PENDING_SENT)")
 
         # Capture Alice's KEX message from CA
-        time.sleep(0.5)
-        alice_outbox = ca_alice.poll(timeout=1.0)
+        alice_outbox = _drain_all(ca_alice)
         assert len(alice_outbox) > 0, "Alice should have sent KEX to CA"
         _, kex_data = alice_outbox[0]
-        kex_msg = kex_data.decode()
-        assert kex_msg.startswith("OSM:KEY:"), f"Bad KEX: {kex_msg}"
-        assert alice_pubkey_b64 in kex_msg
+        assert kex_data.startswith(_KEY_PREFIX), f"Bad KEX: {kex_data!r}"
+        assert alice_pubkey_b64.encode() in kex_data
         print(f"  PASS: Alice's KEX captured from CA")
 
         # === STEP 2: Deliver Alice's key to Bob ===
-        ca_bob.send_message(CHAR_UUID_RX, kex_msg.encode())
-        time.sleep(0.5)
-
-        state = send_cmd(bob_proc, "CMD:STATE")
-        assert "pending=1" in state, f"Bob should have 1 pending: {state}"
+        ca_bob.send_message(CHAR_UUID_RX, kex_data)
+        assert _wait_pending_key(bob_proc), \
+            f"Bob should have 1 pending: {_send_cmd(bob_proc, 'CMD:STATE')}"
         print("  PASS: Bob received Alice's key")
 
         # === STEP 3: Bob creates contact "Alice" from pending key via UI ===
-        resp = send_cmd(bob_proc, "CMD:UI_NEW_FROM_PENDING:Alice")
+        resp = _send_cmd(bob_proc, "CMD:UI_NEW_FROM_PENDING:Alice")
         assert "CMD:OK:ui_new_from_pending:Alice" in resp, f"UI new from pending failed: {resp}"
         print("  PASS: Bob UI created contact Alice (PENDING_RECEIVED)")
 
         # === STEP 4: Bob completes KEX via UI (clicks action button) ===
-        resp = send_cmd(bob_proc, "CMD:UI_COMPLETE_KEX:Alice")
+        resp = _send_cmd(bob_proc, "CMD:UI_COMPLETE_KEX:Alice")
         assert "ESTABLISHED" in resp, f"UI complete KEX failed: {resp}"
         print("  PASS: Bob UI completed KEX → ESTABLISHED")
 
         # Capture Bob's KEX response
-        time.sleep(0.5)
-        bob_outbox = ca_bob.poll(timeout=1.0)
+        bob_outbox = _drain_all(ca_bob)
         assert len(bob_outbox) > 0, "Bob should have sent KEX to CA"
         _, bob_kex_data = bob_outbox[0]
-        bob_kex_msg = bob_kex_data.decode()
-        assert bob_kex_msg.startswith("OSM:KEY:")
-        assert bob_pubkey_b64 in bob_kex_msg
+        assert bob_kex_data.startswith(_KEY_PREFIX)
+        assert bob_pubkey_b64.encode() in bob_kex_data
         print("  PASS: Bob's KEX response captured")
 
         # === STEP 5: Deliver Bob's key to Alice ===
-        ca_alice.send_message(CHAR_UUID_RX, bob_kex_msg.encode())
-        time.sleep(0.5)
-
-        state = send_cmd(alice_proc, "CMD:STATE")
-        assert "pending=1" in state, f"Alice should have 1 pending: {state}"
+        ca_alice.send_message(CHAR_UUID_RX, bob_kex_data)
+        assert _wait_pending_key(alice_proc), \
+            f"Alice should have 1 pending: {_send_cmd(alice_proc, 'CMD:STATE')}"
 
         # === STEP 6: Alice assigns pending key to "Bob" via UI ===
-        resp = send_cmd(alice_proc, "CMD:UI_ASSIGN_PENDING:Bob")
+        resp = _send_cmd(alice_proc, "CMD:UI_ASSIGN_PENDING:Bob")
         assert "CMD:OK:ui_assign_pending:Bob" in resp, f"UI assign pending failed: {resp}"
         print("  PASS: Alice UI assigned key → ESTABLISHED")
 
         # Verify both ESTABLISHED
-        alice_state = send_cmd(alice_proc, "CMD:STATE")
-        bob_state = send_cmd(bob_proc, "CMD:STATE")
+        alice_state = _send_cmd(alice_proc, "CMD:STATE")
+        bob_state = _send_cmd(bob_proc, "CMD:STATE")
         assert "ESTABLISHED" in alice_state
         assert "ESTABLISHED" in bob_state
         print("  PASS: Both contacts ESTABLISHED via UI")
 
         # Read private keys via CMD:PRIVKEY
-        alice_privkey_resp = send_cmd(alice_proc, "CMD:PRIVKEY")
-        alice_sk_b64 = alice_privkey_resp.strip().split("CMD:PRIVKEY:")[-1].split("\n")[0]
-        alice_sk = base64.b64decode(alice_sk_b64)
-        alice_pk = base64.b64decode(alice_pubkey_b64)
-
-        bob_privkey_resp = send_cmd(bob_proc, "CMD:PRIVKEY")
-        bob_sk_b64 = bob_privkey_resp.strip().split("CMD:PRIVKEY:")[-1].split("\n")[0]
-        bob_sk = base64.b64decode(bob_sk_b64)
-        bob_pk = base64.b64decode(bob_pubkey_b64)
-
-        def encrypt_msg(plaintext, peer_pk, my_sk):
-            nonce = nacl.bindings.randombytes(24)
-            ct = nacl.bindings.crypto_box(plaintext.encode(), nonce, peer_pk, my_sk)
-            return base64.b64encode(nonce + ct).decode()
+        alice_sk, bob_sk = _privkeys(alice_proc, bob_proc)
+        alice_pk = b64decode(alice_pubkey_b64)
+        bob_pk = b64decode(bob_pubkey_b64)
 
         # === STEP 7: Send 12 messages Alice→Bob via UI Compose ===
         alice_messages = [f"Alice msg {i+1}: Hello Bob! #{i+1}" for i in range(12)]
         for msg in alice_messages:
-            resp = send_cmd(alice_proc, f"CMD:UI_COMPOSE:Bob:{msg}")
+            resp = _send_cmd(alice_proc, f"CMD:UI_COMPOSE:Bob:{msg}")
             assert "CMD:OK:ui_compose:Bob" in resp, f"UI compose failed: {resp}"
         print(f"  PASS: Alice sent {len(alice_messages)} messages via UI Compose")
 
         # Capture all from CA-Alice and deliver to Bob
-        time.sleep(1.0)
-        alice_out = ca_alice.poll(timeout=2.0)
+        _wait_until(lambda: _poll_count(ca_alice) >= 12, timeout=3.0)
+        alice_out = [d for _, d in ca_alice.received if d.startswith(_MSG_PREFIX)]
         assert len(alice_out) >= 12, f"Expected 12 msgs from Alice CA, got {len(alice_out)}"
-        for _, data in alice_out:
-            msg_str = data.decode()
-            if msg_str.startswith("OSM:MSG:"):
-                ca_bob.send_message(CHAR_UUID_RX, data)
-                time.sleep(0.1)
-        time.sleep(1.0)
+        ca_bob.send_batch(CHAR_UUID_RX, alice_out)
+        bob_proc.stderr.wait_decrypted(12, timeout=3.0)
 
         # Verify Bob received them
-        resp = send_cmd(bob_proc, "CMD:RECV_COUNT:Alice")
+        resp = _send_cmd(bob_proc, "CMD:RECV_COUNT:Alice")
         assert "CMD:OK:recv_count:Alice:" in resp, f"Recv count failed: {resp}"
         bob_recv = int(resp.split(":")[-1])
         assert bob_recv == 12, f"Bob should have 12 msgs from Alice, got {bob_recv}"
@@ -1523,31 +2005,26 @@ def test_ui_driven_kex_and_messaging():
         # First 6 via Compose screen
         bob_messages = [f"Bob msg {i+1}: Hey Alice! #{i+1}" for i in range(12)]
         for msg in bob_messages[:6]:
-            resp = send_cmd(bob_proc, f"CMD:UI_COMPOSE:Alice:{msg}")
+            resp = _send_cmd(bob_proc, f"CMD:UI_COMPOSE:Alice:{msg}")
             assert "CMD:OK:ui_compose:Alice" in resp, f"Bob compose failed: {resp}"
 
         # Next 6 via Reply on conversation screen
-        resp = send_cmd(bob_proc, "CMD:UI_OPEN_CHAT:Alice")
+        resp = _send_cmd(bob_proc, "CMD:UI_OPEN_CHAT:Alice")
         assert "CMD:OK:ui_open_chat:Alice" in resp, f"Open chat failed: {resp}"
         for msg in bob_messages[6:]:
-            resp = send_cmd(bob_proc, f"CMD:UI_REPLY:{msg}")
+            resp = _send_cmd(bob_proc, f"CMD:UI_REPLY:{msg}")
             assert "CMD:OK:ui_reply" in resp, f"Bob reply failed: {resp}"
         print(f"  PASS: Bob sent {len(bob_messages)} messages (6 Compose + 6 Reply)")
 
         # Capture from CA-Bob and deliver to Alice
-        time.sleep(1.0)
-        bob_out = ca_bob.poll(timeout=2.0)
-        msg_count = sum(1 for _, d in bob_out if d.decode().startswith("OSM:MSG:"))
-        assert msg_count >= 12, f"Expected 12 msgs from Bob CA, got {msg_count}"
-        for _, data in bob_out:
-            msg_str = data.decode()
-            if msg_str.startswith("OSM:MSG:"):
-                ca_alice.send_message(CHAR_UUID_RX, data)
-                time.sleep(0.1)
-        time.sleep(1.0)
+        _wait_until(lambda: _poll_count(ca_bob) >= 12, timeout=3.0)
+        bob_out = [d for _, d in ca_bob.received if d.startswith(_MSG_PREFIX)]
+        assert len(bob_out) >= 12, f"Expected 12 msgs from Bob CA, got {len(bob_out)}"
+        ca_alice.send_batch(CHAR_UUID_RX, bob_out)
+        alice_proc.stderr.wait_decrypted(12, timeout=3.0)
 
         # Verify Alice received them
-        resp = send_cmd(alice_proc, "CMD:RECV_COUNT:Bob")
+        resp = _send_cmd(alice_proc, "CMD:RECV_COUNT:Bob")
         assert "CMD:OK:recv_count:Bob:" in resp, f"Recv count failed: {resp}"
         alice_recv = int(resp.split(":")[-1])
         assert alice_recv == 12, f"Alice should have 12 msgs from Bob, got {alice_recv}"
@@ -1562,24 +2039,24 @@ def test_ui_driven_kex_and_messaging():
         alice_proc.terminate()
         alice_proc.wait(timeout=3)
         stderr_alice = alice_proc.stderr.read().decode()
+        alice_dec = alice_proc.stderr.decrypt_count
         alice_proc = None
 
         bob_proc.terminate()
         bob_proc.wait(timeout=3)
         stderr_bob = bob_proc.stderr.read().decode()
+        bob_dec = bob_proc.stderr.decrypt_count
         bob_proc = None
 
         # Verify Alice decrypted Bob's messages
         for msg in bob_messages:
             assert msg in stderr_alice, f"Alice missing: {msg}\nLogs: {stderr_alice[-500:]}"
-        alice_dec = stderr_alice.count("Decrypted from")
         print(f"  PASS: Alice decrypted {alice_dec} messages (expected {len(bob_messages)})")
         assert alice_dec == len(bob_messages), f"Expected {len(bob_messages)}, got {alice_dec}"
 
         # Verify Bob decrypted Alice's messages
         for msg in alice_messages:
             assert msg in stderr_bob, f"Bob missing: {msg}\nLogs: {stderr_bob[-500:]}"
-        bob_dec = stderr_bob.count("Decrypted from")
         print(f"  PASS: Bob decrypted {bob_dec} messages (expected {len(alice_messages)})")
         assert bob_dec == len(alice_messages), f"Expected {len(alice_messages)}, got {bob_dec}"
 
@@ -1590,124 +2067,59 @@ def test_ui_driven_kex_and_messaging():
             ca_alice.disconnect()
         if ca_bob:
             ca_bob.disconnect()
-        for proc in [alice_proc, bob_proc]:
-            if proc and proc.poll() is None:
-                proc.terminate()
-                proc.wait(timeout=3)
+        _stop_osm(alice_proc, bob_proc)
         shutil.rmtree(alice_dir, ignore_errors=True)
         shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_offline_queue_delivery():
     """Test 19: Messages queued while CA disconnected are delivered on reconnect."""
     print("\n[Test 19] Offline queue + reconnect delivery")
 
-    import tempfile
-    import shutil
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_offline_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            env=env,
-            cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk:
-                    break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0
-                        break
-            if proc.poll() is not None:
-                break
-        result = []
-        for line in buf.decode(errors="replace").split("\n"):
-            line = line.strip()
-            if line.startswith("CMD:"):
-                result.append(line)
-        return "\n".join(result)
+    alice_dir = _mkdtemp("osm_offline_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(alice_dir, PORT_A)
+        proc = _start_osm(alice_dir, PORT_A)
         assert proc, "OSM failed to start"
 
         # Generate keypair and create an established contact
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         # No pending key yet — we need to fake one
         # Actually, let's set up properly: add key exchange via transport
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
 
         # Drain any KEX message from ADD
-        ca.poll(timeout=1.0)
+        _wait_until(lambda: _poll_count(ca, b"OSM:KEY:") >= 1, timeout=2.0)
 
         # Send a fake peer pubkey to establish the contact
-        import nacl.bindings
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        peer_pk_b64 = _PEER_PK_B64
+
+        ca.send_message(CHAR_UUID_RX, _kex_envelope(peer_pk_b64.encode()))
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp, f"Assign failed: {resp}"
 
         # Disconnect CA
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Send 5 messages while CA is disconnected (via UI)
-        for i in range(5):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Offline msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp, f"Compose while offline failed: {resp}"
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Offline msg {i+1}"
+                                 for i in range(5)])
+        assert resp.count("CMD:OK:ui_compose") == 5, f"Compose while offline failed: {resp}"
         print("  PASS: 5 messages queued while CA disconnected")
 
         # Reconnect CA
         ca2 = TcpClient(PORT_A, "CA-reconnect")
         assert ca2.connect(), "CA reconnect failed"
-        # Wait for outbox flush on next poll cycle
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        # Wait for outbox flush on next poll cycle, then catch any stragglers
+        _wait_until(lambda: _poll_count(ca2) >= 5, timeout=5.0)
+        msg_count = _poll_count(ca2, timeout=0.3)
         print(f"  Got {msg_count} messages after reconnect")
         assert msg_count == 5, f"Expected 5 queued messages, got {msg_count}"
         print("  PASS: All 5 queued messages delivered on reconnect")
@@ -1715,211 +2127,54 @@ def test_offline_queue_delivery():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(alice_dir, ignore_errors=True)
 
 
-def test_ack_basic():
-    """Test 20: Send 1 message from OSM to CA, verify ACK empties outbox."""
-    print("\n[Test 20] ACK basic — single message acknowledged")
-
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_ack_basic_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
-
-    proc = None
-    try:
-        import nacl.bindings
-
-        proc = start_osm_in_dir(work_dir, PORT_A)
-        assert proc, "OSM failed to start"
-
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
-
-        ca = TcpClient(PORT_A, "CA")
-        assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX msg
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
-        assert "ESTABLISHED" in resp, f"Assign failed: {resp}"
-        print("  PASS: Contact established")
-
-        # Send 1 message via compose
-        resp = send_cmd(proc, "CMD:UI_COMPOSE:TestPeer:Hello ACK test")
-        assert "CMD:OK:ui_compose" in resp
-
-        # CA polls — auto-ACKs on receive
-        time.sleep(1.0)
-        msgs = ca.poll(timeout=2.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
-        assert msg_count >= 1, f"Expected >=1 message, got {msg_count}"
-        print("  PASS: CA received message")
-
-        # Wait for ACK to propagate and outbox to clear
-        time.sleep(1.5)
-
-        state = send_cmd(proc, "CMD:STATE")
-        assert "outbox=0" in state, f"Outbox should be empty after ACK: {state}"
-        print("  PASS: Outbox empty after ACK (outbox=0)")
-
-        ca.disconnect()
-
-    finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
-        shutil.rmtree(work_dir, ignore_errors=True)
-
-
+@flaky
+@requires_nacl
 def test_ca_disconnect_during_burst():
     """Test 21: CA disconnects mid-burst, reconnects, all messages eventually arrive."""
     print("\n[Test 21] CA disconnect during burst — reconnect delivery")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_burst_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_burst_")
 
     proc = None
     try:
-        import nacl.bindings
-
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _wait_until(lambda: _poll_count(ca, b"OSM:KEY:") >= 1, timeout=2.0)  # drain KEX
+
+        peer_pk_b64 = _PEER_PK_B64
+        ca.send_message(CHAR_UUID_RX, _kex_envelope(peer_pk_b64.encode()))
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Send 10 messages rapidly
-        for i in range(10):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Burst msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Burst msg {i+1}"
+                                 for i in range(10)])
+        assert resp.count("CMD:OK:ui_compose") == 10
 
         # CA receives a few then disconnects
-        time.sleep(0.5)
-        first_batch = ca.poll(timeout=1.0)
-        first_count = sum(1 for _, d in first_batch if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca) >= 1, timeout=1.5)
+        first_count = _poll_count(ca, timeout=0)
         print(f"  Got {first_count} messages before disconnect")
         ca.disconnect()
-        time.sleep(0.5)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Reconnect
         ca2 = TcpClient(PORT_A, "CA-reconnect")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        second_batch = ca2.poll(timeout=3.0)
-        second_count = sum(1 for _, d in second_batch if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: first_count + _poll_count(ca2) >= 10, timeout=5.0)
+        second_count = _poll_count(ca2, timeout=0)
 
         total = first_count + second_count
         print(f"  Got {second_count} more after reconnect (total {total})")
@@ -1929,96 +2184,44 @@ def test_ca_disconnect_during_burst():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_osm_restart_with_outbox():
     """Test 22: OSM restart preserves outbox — queued messages delivered after restart."""
     print("\n[Test 22] OSM restart with outbox persistence")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_restart_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_restart_")
 
     proc = None
     try:
-        import nacl.bindings
-
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _wait_until(lambda: _poll_count(ca, b"OSM:KEY:") >= 1, timeout=2.0)  # drain KEX
+
+        peer_pk_b64 = _PEER_PK_B64
+        ca.send_message(CHAR_UUID_RX, _kex_envelope(peer_pk_b64.encode()))
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Disconnect CA so messages queue
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Queue 5 messages
-        for i in range(5):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Restart msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Restart msg {i+1}"
+                                 for i in range(5)])
+        assert resp.count("CMD:OK:ui_compose") == 5
         print("  PASS: 5 messages queued while CA disconnected")
 
         # Kill OSM
@@ -2027,21 +2230,20 @@ def test_osm_restart_with_outbox():
         proc = None
 
         # Verify outbox file exists
-        img_path = os.path.join(work_dir, "osm_data.img")
-        assert os.path.exists(img_path), "osm_data.img should exist (data persisted)"
+        img_path = os.path.join(work_dir, STORAGE_IMAGE)
+        assert _wait_until(lambda: os.path.exists(img_path), timeout=1.0), \
+            "osm_data.img should exist (data persisted)"
         print("  PASS: storage image persisted after shutdown")
 
         # Restart OSM in same dir (clean=False)
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to restart"
 
         # Reconnect CA
         ca2 = TcpClient(PORT_A, "CA-after-restart")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca2) >= 5, timeout=5.0)
+        msg_count = _poll_count(ca2, timeout=0.3)
         print(f"  Got {msg_count} messages after restart + reconnect")
         assert msg_count == 5, f"Expected 5 queued messages, got {msg_count}"
         print("  PASS: All 5 messages delivered after OSM restart")
@@ -2049,85 +2251,34 @@ def test_osm_restart_with_outbox():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@flaky
+@requires_nacl
 def test_rapid_reconnect():
     """Test 23: Rapid CA disconnect/reconnect cycles with messages after each."""
     print("\n[Test 23] Rapid reconnect — 5 cycles with messages")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_rapid_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_rapid_")
 
     proc = None
     try:
-        import nacl.bindings
-
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _wait_until(lambda: _poll_count(ca, b"OSM:KEY:") >= 1, timeout=2.0)  # drain KEX
+
+        peer_pk_b64 = _PEER_PK_B64
+        ca.send_message(CHAR_UUID_RX, _kex_envelope(peer_pk_b64.encode()))
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         ca.disconnect()
         print("  PASS: Contact established")
@@ -2136,240 +2287,130 @@ def test_rapid_reconnect():
         for cycle in range(5):
             ca_cycle = TcpClient(PORT_A, f"CA-cycle-{cycle}")
             assert ca_cycle.connect(), f"CA reconnect failed on cycle {cycle}"
-            time.sleep(0.5)
 
             # Send a message
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Rapid msg {cycle+1}")
+            resp = _send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Rapid msg {cycle+1}")
             assert "CMD:OK:ui_compose" in resp
 
-            time.sleep(1.0)
-            msgs = ca_cycle.poll(timeout=2.0)
-            got = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+            _wait_until(lambda: _poll_count(ca_cycle) >= 1, timeout=3.0)
+            got = _poll_count(ca_cycle, timeout=0)
             total_received += got
             ca_cycle.disconnect()
-            time.sleep(0.5)
+            assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         print(f"  Total received across 5 cycles: {total_received}")
         assert total_received >= 5, f"Expected >=5 messages, got {total_received}"
         print("  PASS: All 5 messages received across rapid reconnect cycles")
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_kex_interrupted_by_disconnect():
     """Test 24: KEX interrupted by CA disconnect — resumes after reconnect."""
     print("\n[Test 24] KEX interrupted by disconnect — resume on reconnect")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_kex_int_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_kex_int_")
 
     proc = None
     try:
-        import nacl.bindings
-
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
+        resp = _send_cmd(proc, "CMD:KEYGEN")
         assert "CMD:OK:keygen" in resp
 
         # Start KEX via UI — but disconnect CA before it can receive
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
 
-        resp = send_cmd(proc, "CMD:UI_ADD_CONTACT:TestPeer")
+        resp = _send_cmd(proc, "CMD:UI_ADD_CONTACT:TestPeer")
         assert "CMD:OK:ui_add_contact:TestPeer" in resp
         print("  PASS: KEX initiated (UI_ADD_CONTACT)")
 
         # Disconnect CA immediately — KEX may or may not have been received
         # Since ACK protocol: if CA never polls, no ACK is sent
-        time.sleep(0.3)
         ca.disconnect()
-        time.sleep(0.5)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
         print("  PASS: CA disconnected after KEX initiation")
 
         # Reconnect CA — outbox should re-send the KEX message
         ca2 = TcpClient(PORT_A, "CA-reconnect")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
 
         # KEX message should be (re-)sent on reconnect
-        kex_msgs2 = ca2.poll(timeout=3.0)
-        kex_count2 = sum(1 for _, d in kex_msgs2 if d.decode().startswith("OSM:KEY:"))
+        _wait_until(lambda: _poll_count(ca2, b"OSM:KEY:") >= 1, timeout=5.0)
+        kex_count2 = _poll_count(ca2, b"OSM:KEY:", timeout=0)
         assert kex_count2 >= 1, f"KEX message should be sent after reconnect, got {kex_count2}"
         print("  PASS: KEX message received after reconnect")
 
         # Complete KEX by sending peer key
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca2.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
+        peer_pk_b64 = _PEER_PK_B64
+        ca2.send_message(CHAR_UUID_RX, _kex_envelope(peer_pk_b64.encode()))
+        _wait_pending_key(proc)
 
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp, f"Assign failed: {resp}"
         print("  PASS: KEX completed after interrupted disconnect")
 
         # Verify messaging works
-        resp = send_cmd(proc, "CMD:UI_COMPOSE:TestPeer:Post-KEX message")
+        resp = _send_cmd(proc, "CMD:UI_COMPOSE:TestPeer:Post-KEX message")
         assert "CMD:OK:ui_compose" in resp
-        time.sleep(1.0)
-        msgs = ca2.poll(timeout=2.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca2) >= 1, timeout=3.0)
+        msg_count = _poll_count(ca2, timeout=0)
         assert msg_count >= 1, "Should receive message after interrupted KEX"
         print("  PASS: Messaging works after interrupted KEX")
 
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_outbox_overflow():
     """Test 25: Outbox overflow — queue 35 messages (MAX_OUTBOX=32), verify FIFO eviction."""
     print("\n[Test 25] Outbox overflow — FIFO eviction at 32")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_overflow_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_overflow_")
 
     proc = None
     try:
-        import nacl.bindings
-
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _wait_until(lambda: _poll_count(ca, b"OSM:KEY:") >= 1, timeout=2.0)  # drain KEX
+
+        peer_pk_b64 = _PEER_PK_B64
+        ca.send_message(CHAR_UUID_RX, _kex_envelope(peer_pk_b64.encode()))
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Disconnect CA so messages queue
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Queue 35 messages (exceeds MAX_OUTBOX=32)
-        for i in range(35):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Overflow msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Overflow msg {i+1}"
+                                 for i in range(35)])
+        assert resp.count("CMD:OK:ui_compose") == 35, f"Compose burst failed: {resp}"
         print("  PASS: 35 messages queued (overflow)")
 
         # Reconnect CA
         ca2 = TcpClient(PORT_A, "CA-overflow")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca2) >= 32, timeout=5.0)
+        msg_count = _poll_count(ca2, timeout=0.3)
         print(f"  Got {msg_count} messages after reconnect")
         # FIFO eviction: oldest 3 should be dropped, 32 delivered
         assert msg_count >= 32, f"Expected >=32 messages (FIFO eviction), got {msg_count}"
@@ -2378,9 +2419,7 @@ def test_outbox_overflow():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -2388,61 +2427,8 @@ def test_bidirectional_queue():
     """Test 26: Two OSMs do KEX, queue messages offline, exchange via CAs."""
     print("\n[Test 26] Bidirectional queue — two OSMs with offline queuing")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed (pip install pynacl)")
-        return
-
-    import json as json_mod
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_bidir_alice_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_bidir_bob_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    alice_dir = _mkdtemp("osm_bidir_alice_")
+    bob_dir = _mkdtemp("osm_bidir_bob_")
 
     alice_proc = None
     bob_proc = None
@@ -2450,73 +2436,62 @@ def test_bidirectional_queue():
     ca_bob = None
 
     try:
-        alice_proc = start_osm_in_dir(alice_dir, PORT_A)
+        alice_proc = _start_osm(alice_dir, PORT_A, capture_stderr=True)
         assert alice_proc, "Alice failed to start"
-        bob_proc = start_osm_in_dir(bob_dir, PORT_B)
+        bob_proc = _start_osm(bob_dir, PORT_B, capture_stderr=True)
         assert bob_proc, "Bob failed to start"
-        time.sleep(0.5)
 
         ca_alice = TcpClient(PORT_A, "CA-Alice")
         assert ca_alice.connect(), "CA-Alice failed"
         ca_bob = TcpClient(PORT_B, "CA-Bob")
         assert ca_bob.connect(), "CA-Bob failed"
-        time.sleep(0.3)
 
         # Generate keypairs
-        resp = send_cmd(alice_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(bob_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-
-        alice_id = send_cmd(alice_proc, "CMD:IDENTITY")
-        alice_pubkey_b64 = alice_id.split("CMD:IDENTITY:")[1].strip()
-        bob_id = send_cmd(bob_proc, "CMD:IDENTITY")
-        bob_pubkey_b64 = bob_id.split("CMD:IDENTITY:")[1].strip()
+        alice_pubkey_b64, bob_pubkey_b64 = _keygen_identity(alice_proc, bob_proc)
 
         # Full KEX: Alice adds Bob
-        resp = send_cmd(alice_proc, "CMD:ADD:Bob")
+        resp = _send_cmd(alice_proc, "CMD:ADD:Bob")
         assert "CMD:OK:add:Bob" in resp
 
-        time.sleep(0.5)
-        alice_outbox = ca_alice.poll(timeout=1.0)
+        _wait_until(lambda: _poll_count(ca_alice, b"OSM:KEY:") >= 1, timeout=2.0)
+        alice_outbox = ca_alice.received
         assert len(alice_outbox) > 0, "Alice should have sent KEX"
         _, kex_data = alice_outbox[0]
-        kex_msg = kex_data.decode()
 
         # Deliver to Bob
-        ca_bob.send_message(CHAR_UUID_RX, kex_msg.encode())
-        time.sleep(0.5)
+        ca_bob.send_message(CHAR_UUID_RX, kex_data)
+        _wait_pending_key(bob_proc)
 
-        resp = send_cmd(bob_proc, "CMD:CREATE:Alice")
+        resp = _send_cmd(bob_proc, "CMD:CREATE:Alice")
         assert "PENDING_RECEIVED" in resp
-        resp = send_cmd(bob_proc, "CMD:COMPLETE:Alice")
+        resp = _send_cmd(bob_proc, "CMD:COMPLETE:Alice")
         assert "ESTABLISHED" in resp
 
-        time.sleep(0.5)
-        bob_outbox = ca_bob.poll(timeout=1.0)
+        _wait_until(lambda: _poll_count(ca_bob, b"OSM:KEY:") >= 1, timeout=2.0)
+        bob_outbox = ca_bob.received
         assert len(bob_outbox) > 0, "Bob should have sent KEX"
         _, bob_kex_data = bob_outbox[0]
-        bob_kex_msg = bob_kex_data.decode()
 
         # Deliver to Alice
-        ca_alice.send_message(CHAR_UUID_RX, bob_kex_msg.encode())
-        time.sleep(0.5)
-        resp = send_cmd(alice_proc, "CMD:ASSIGN:Bob")
+        ca_alice.send_message(CHAR_UUID_RX, bob_kex_data)
+        _wait_pending_key(alice_proc)
+        resp = _send_cmd(alice_proc, "CMD:ASSIGN:Bob")
         assert "ESTABLISHED" in resp
         print("  PASS: Full KEX completed (both ESTABLISHED)")
 
         # Disconnect both CAs
         ca_alice.disconnect()
         ca_bob.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(alice_proc), "Alice never dropped its CA"
+        assert _wait_ca_disconnected(bob_proc), "Bob never dropped its CA"
 
         # Queue 5 messages on each
-        for i in range(5):
-            resp = send_cmd(alice_proc, f"CMD:UI_COMPOSE:Bob:Alice offline msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
-        for i in range(5):
-            resp = send_cmd(bob_proc, f"CMD:UI_COMPOSE:Alice:Bob offline msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(alice_proc, [f"CMD:UI_COMPOSE:Bob:Alice offline msg {i+1}"
+                                       for i in range(5)])
+        assert resp.count("CMD:OK:ui_compose") == 5
+        resp = _send_many(bob_proc, [f"CMD:UI_COMPOSE:Alice:Bob offline msg {i+1}"
+                                     for i in range(5)])
+        assert resp.count("CMD:OK:ui_compose") == 5
         print("  PASS: 5 messages queued on each OSM")
 
         # Reconnect both CAs
@@ -2524,13 +2499,14 @@ def test_bidirectional_queue():
         assert ca_alice.connect(), "CA-Alice reconnect failed"
         ca_bob = TcpClient(PORT_B, "CA-Bob-2")
         assert ca_bob.connect(), "CA-Bob reconnect failed"
-        time.sleep(2.0)
 
         # Collect messages from both CAs
-        alice_msgs = ca_alice.poll(timeout=3.0)
-        alice_msg_count = sum(1 for _, d in alice_msgs if d.decode().startswith("OSM:MSG:"))
-        bob_msgs = ca_bob.poll(timeout=3.0)
-        bob_msg_count = sum(1 for _, d in bob_msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca_alice) >= 5 and _poll_count(ca_bob) >= 5,
+                    timeout=5.0)
+        alice_msgs = [d for _, d in ca_alice.received if d.startswith(b"OSM:MSG:")]
+        alice_msg_count = len(alice_msgs)
+        bob_msgs = [d for _, d in ca_bob.received if d.startswith(b"OSM:MSG:")]
+        bob_msg_count = len(bob_msgs)
 
         print(f"  Alice CA got {alice_msg_count} outbound messages")
         print(f"  Bob CA got {bob_msg_count} outbound messages")
@@ -2540,30 +2516,19 @@ def test_bidirectional_queue():
 
         # Cross-deliver: Alice's encrypted msgs go to Bob, Bob's to Alice
         # Read private keys via CMD:PRIVKEY
-        alice_privkey_resp = send_cmd(alice_proc, "CMD:PRIVKEY")
-        alice_sk_b64 = alice_privkey_resp.strip().split("CMD:PRIVKEY:")[-1].split("\n")[0]
-        alice_sk = base64.b64decode(alice_sk_b64)
-        alice_pk = base64.b64decode(alice_pubkey_b64)
-
-        bob_privkey_resp = send_cmd(bob_proc, "CMD:PRIVKEY")
-        bob_sk_b64 = bob_privkey_resp.strip().split("CMD:PRIVKEY:")[-1].split("\n")[0]
-        bob_sk = base64.b64decode(bob_sk_b64)
-        bob_pk = base64.b64decode(bob_pubkey_b64)
+        alice_sk, bob_sk = _privkeys(alice_proc, bob_proc)
+        alice_pk = b64decode(alice_pubkey_b64)
+        bob_pk = b64decode(bob_pubkey_b64)
 
         # Relay Alice→Bob messages to Bob's OSM
-        for _, data in alice_msgs:
-            msg_str = data.decode()
-            if msg_str.startswith("OSM:MSG:"):
-                ca_bob.send_message(CHAR_UUID_RX, data)
-                time.sleep(0.1)
+        ca_bob.send_batch(CHAR_UUID_RX, alice_msgs)
 
         # Relay Bob→Alice messages to Alice's OSM
-        for _, data in bob_msgs:
-            msg_str = data.decode()
-            if msg_str.startswith("OSM:MSG:"):
-                ca_alice.send_message(CHAR_UUID_RX, data)
-                time.sleep(0.1)
-        time.sleep(1.0)
+        ca_alice.send_batch(CHAR_UUID_RX, bob_msgs)
+        # Each side holds its 5 sent messages plus the 5 it just decrypted
+        _wait_until(lambda: _send_cmd(alice_proc, "CMD:STATE").count("CMD:MSG:") >= 10
+                    and _send_cmd(bob_proc, "CMD:STATE").count("CMD:MSG:") >= 10,
+                    timeout=3.0)
 
         # Verify decryption by checking stderr
         ca_alice.disconnect()
@@ -2571,16 +2536,16 @@ def test_bidirectional_queue():
 
         alice_proc.terminate()
         alice_proc.wait(timeout=3)
-        stderr_alice = alice_proc.stderr.read().decode()
+        alice_proc.stderr.read()  # join the drain so decrypt_count is final
+        alice_dec = alice_proc.stderr.decrypt_count
         alice_proc = None
 
         bob_proc.terminate()
         bob_proc.wait(timeout=3)
-        stderr_bob = bob_proc.stderr.read().decode()
+        bob_proc.stderr.read()  # join the drain so decrypt_count is final
+        bob_dec = bob_proc.stderr.decrypt_count
         bob_proc = None
 
-        alice_dec = stderr_alice.count("Decrypted from")
-        bob_dec = stderr_bob.count("Decrypted from")
         print(f"  Alice decrypted {alice_dec} messages, Bob decrypted {bob_dec} messages")
         assert alice_dec >= 5, f"Alice should have decrypted >=5 from Bob, got {alice_dec}"
         assert bob_dec >= 5, f"Bob should have decrypted >=5 from Alice, got {bob_dec}"
@@ -2591,108 +2556,53 @@ def test_bidirectional_queue():
             ca_alice.disconnect()
         if ca_bob:
             ca_bob.disconnect()
-        for proc in [alice_proc, bob_proc]:
-            if proc and proc.poll() is None:
-                proc.terminate()
-                proc.wait(timeout=3)
+        _stop_osm(alice_proc, bob_proc)
         shutil.rmtree(alice_dir, ignore_errors=True)
         shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_message_ordering():
     """Test 27: Send 20 messages sequentially, verify CA receives them in order."""
     print("\n[Test 27] Message ordering — 20 sequential messages")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_order_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_order_")
 
     proc = None
     try:
-        import nacl.bindings
 
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _drain_all(ca)  # drain KEX
+
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Disconnect CA so messages queue, then reconnect to get them in order
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Send 20 numbered messages
-        for i in range(20):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Order msg {i:04d}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Order msg {i:04d}"
+                                 for i in range(20)])
+        assert resp.count("CMD:OK:ui_compose") == 20
 
         print("  PASS: 20 numbered messages queued")
 
         # Reconnect CA
         ca2 = TcpClient(PORT_A, "CA-order")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        osm_msgs = [d.decode() for _, d in msgs if d.decode().startswith("OSM:MSG:")]
+        _wait_until(lambda: _poll_count(ca2) >= 20, timeout=5.0)
+        osm_msgs = [d for _, d in ca2.received if d.startswith(b"OSM:MSG:")]
         print(f"  Got {len(osm_msgs)} OSM:MSG messages")
         assert len(osm_msgs) >= 20, f"Expected >=20, got {len(osm_msgs)}"
 
@@ -2705,104 +2615,103 @@ def test_message_ordering():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
-def test_ack_removes_from_outbox():
-    """Test 28: ACK removes messages from outbox, verified across restart."""
-    print("\n[Test 28] ACK removes from outbox — persist across restart")
+def _ack_session(proc) -> TcpClient:
+    """KEYGEN, add TestPeer and establish it through a fresh CA; returns
+    that CA. _poll_count() on it auto-ACKs what it receives."""
+    _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                  ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
+
+    ca = TcpClient(PORT_A, "CA")
+    try:
+        assert ca.connect(), "CA failed to connect"
+        _drain_all(ca)  # drain KEX
+
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        assert "ESTABLISHED" in resp, f"Assign failed: {resp}"
+    except BaseException:
+        ca.disconnect()
+        raise
+    print("  PASS: Contact established")
+    return ca
+
+
+def _ack_single_step(proc, ca: TcpClient, text: str):
+    """Compose one message; the CA receives and ACKs it and the outbox
+    drains."""
+    resp = _send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:{text}")
+    assert "CMD:OK:ui_compose" in resp
+    assert _wait_until(lambda: _poll_count(ca) >= 1, timeout=3.0), \
+        "CA never received the message"
+    print("  PASS: CA received message")
+    _wait_until(lambda: "outbox=0" in _send_cmd(proc, "CMD:STATE"), timeout=3.0)
+    state = _send_cmd(proc, "CMD:STATE")
+    assert "outbox=0" in state, f"Outbox should be empty after ACK: {state}"
+    print("  PASS: Single message ACKed (outbox=0)")
+
+
+@requires_nacl
+@debug_only
+def test_ack_basic():
+    """Test 28a: Send 1 message from OSM to CA, verify ACK empties outbox."""
+    print("\n[Test 28a] ACK basic — single message acknowledged")
 
-    import tempfile, shutil, json as json_mod
+    work_dir = _mkdtemp("osm_ack_basic_")
 
-    work_dir = tempfile.mkdtemp(prefix="osm_ack_rm_")
+    proc = ca = None
+    try:
+        proc = _start_osm(work_dir, PORT_A)
+        assert proc, "OSM failed to start"
 
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+        ca = _ack_session(proc)
+        _ack_single_step(proc, ca, "Hello ACK test")
 
-    proc = None
+    finally:
+        if ca:
+            ca.disconnect()
+        _stop_osm(proc)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+@requires_nacl
+def test_ack_removes_from_outbox():
+    """Test 28: ACK removes messages from outbox — a single message first
+    (test 28a's step), then a burst — and the empty outbox persists across
+    restart."""
+    print("\n[Test 28] ACK removes from outbox — persist across restart")
+
+    work_dir = _mkdtemp("osm_ack_rm_")
+
+    proc = ca = None
     try:
-        import nacl.bindings
 
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        ca = _ack_session(proc)
 
-        ca = TcpClient(PORT_A, "CA")
-        assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
-        assert "ESTABLISHED" in resp
-        print("  PASS: Contact established")
+        # One message: CA polls, auto-ACKs, outbox drains
+        _ack_single_step(proc, ca, "ACK test msg 1")
 
-        # Send 3 messages
-        for i in range(3):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:ACK test msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        # Two more
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:ACK test msg {i+1}"
+                                 for i in range(1, 3)])
+        assert resp.count("CMD:OK:ui_compose") == 2
 
         # CA polls and auto-ACKs
-        time.sleep(1.0)
-        msgs = ca.poll(timeout=2.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca) >= 3, timeout=3.0)
+        msg_count = _poll_count(ca, timeout=0)
         assert msg_count >= 3, f"Expected >=3 messages, got {msg_count}"
         print(f"  PASS: CA received {msg_count} messages (auto-ACKed)")
 
         # Wait for ACKs to propagate
-        time.sleep(2.0)
-
-        state = send_cmd(proc, "CMD:STATE")
+        _wait_until(lambda: "outbox=0" in _send_cmd(proc, "CMD:STATE"), timeout=3.0)
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=0" in state, f"Outbox should be 0 after ACKs: {state}"
         print("  PASS: Outbox empty after ACKs")
 
@@ -2817,104 +2726,54 @@ def test_ack_removes_from_outbox():
         print("  PASS: outbox confirmed empty via CMD:STATE")
 
         # Restart OSM and verify outbox is still empty
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to restart"
 
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=0" in state, f"Outbox should be 0 after restart: {state}"
         print("  PASS: Outbox still empty after restart")
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        if ca:
+            ca.disconnect()
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_offline_message_persistence():
     """Test 29: Offline messages persist in outbox file, survive OSM restart."""
     print("\n[Test 29] Offline message persistence — outbox survives restart")
 
-    import tempfile, shutil, json as json_mod
-
-    work_dir = tempfile.mkdtemp(prefix="osm_persist_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_persist_")
 
     proc = None
     try:
-        import nacl.bindings
 
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
-
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        peer_pk_b64 = base64.b64encode(peer_pk).decode()
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        _drain_all(ca)  # drain KEX
+
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Disconnect CA
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Send 5 messages (queued in outbox)
-        for i in range(5):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Persist msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Persist msg {i+1}"
+                                 for i in range(5)])
+        assert resp.count("CMD:OK:ui_compose") == 5
         print("  PASS: 5 messages queued while CA disconnected")
 
         # Kill OSM
@@ -2923,21 +2782,19 @@ def test_offline_message_persistence():
         proc = None
 
         # Verify outbox has 5 entries via CMD:STATE before shutdown
-        img_path = os.path.join(work_dir, "osm_data.img")
+        img_path = os.path.join(work_dir, STORAGE_IMAGE)
         assert os.path.exists(img_path), "osm_data.img should exist after queuing"
         print("  PASS: storage image exists with outbox data")
 
         # Restart OSM (clean=False — same dir)
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to restart"
 
         # Reconnect CA
         ca2 = TcpClient(PORT_A, "CA-persist")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca2) >= 5, timeout=5.0)
+        msg_count = _poll_count(ca2, timeout=0.3)  # grace period to catch duplicates
         print(f"  Got {msg_count} messages after restart + reconnect")
         assert msg_count == 5, f"Expected 5 persisted messages, got {msg_count}"
         print("  PASS: All 5 persisted messages delivered after restart")
@@ -2945,230 +2802,124 @@ def test_offline_message_persistence():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_compose_navigates_to_conversation():
     """Test 30: After sending from compose screen, OSM navigates to conversation."""
     print("\n[Test 30] Compose → Conversation navigation")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_compose_nav_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_compose_nav_")
 
     proc = None
     try:
-        import nacl.bindings
 
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:Peer1")
-        assert "CMD:OK:add:Peer1" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:Peer1"],
+                      ["CMD:OK:keygen", "CMD:OK:add:Peer1"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
+        _drain_all(ca)  # drain KEX
 
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{base64.b64encode(peer_pk).decode()}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:Peer1")
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:Peer1")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Verify we're NOT on CONVERSATION screen yet
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "screen=CONVERSATION" not in state, f"Should not be on conversation yet: {state}"
         print("  PASS: Not on CONVERSATION screen before compose")
 
         # Compose and send — response should indicate CONVERSATION screen
-        resp = send_cmd(proc, "CMD:UI_COMPOSE:Peer1:Test navigation message")
+        resp = _send_cmd(proc, "CMD:UI_COMPOSE:Peer1:Test navigation message")
         assert "CMD:OK:ui_compose:Peer1:screen=CONVERSATION" in resp, f"Expected conversation nav: {resp}"
         print("  PASS: CMD:UI_COMPOSE response indicates CONVERSATION screen")
 
         # Verify via CMD:STATE that we're on CONVERSATION screen
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "screen=CONVERSATION" in state, f"Expected CONVERSATION screen after compose, got: {state}"
         print("  PASS: CMD:STATE confirms CONVERSATION screen after compose")
 
         # We should be able to send a reply directly (proving we're on conversation)
-        resp = send_cmd(proc, "CMD:UI_REPLY:Follow-up message")
+        resp = _send_cmd(proc, "CMD:UI_REPLY:Follow-up message")
         assert "CMD:OK:ui_reply" in resp, f"Reply should work on conversation screen: {resp}"
         print("  PASS: CMD:UI_REPLY works (confirms conversation screen)")
 
         ca.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_ca_queue_while_disconnected():
     """Test 31: CA Queue button works when disconnected — queued messages sent on reconnect."""
     print("\n[Test 31] CA queue while disconnected — messages queued and sent on reconnect")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_ca_queue_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_ca_queue_")
 
     proc = None
     try:
-        import nacl.bindings
 
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:QueuePeer")
-        assert "CMD:OK:add:QueuePeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:QueuePeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:QueuePeer"])
 
         # Connect CA, establish contact
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        ca.poll(timeout=1.0)  # drain KEX
+        _drain_all(ca)  # drain KEX
 
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{base64.b64encode(peer_pk).decode()}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:QueuePeer")
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:QueuePeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Disconnect CA
         ca.disconnect()
-        time.sleep(0.5)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
         print("  PASS: CA disconnected")
 
         # Queue 3 messages while CA is disconnected
-        for i in range(3):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:QueuePeer:Queued msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:QueuePeer:Queued msg {i+1}"
+                                 for i in range(3)])
+        assert resp.count("CMD:OK:ui_compose") == 3
         print("  PASS: 3 messages queued while CA disconnected")
 
         # Verify outbox has 3 messages
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=3" in state, f"Expected outbox=3, got: {state}"
         print("  PASS: Outbox count = 3")
 
         # Reconnect CA — should receive all 3 queued messages
         ca2 = TcpClient(PORT_A, "CA-reconnect")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca2) >= 3, timeout=5.0)
+        msg_count = _poll_count(ca2, timeout=0.3)  # grace period to catch duplicates
         assert msg_count == 3, f"Expected 3 queued messages after reconnect, got {msg_count}"
         print(f"  PASS: All 3 queued messages received after reconnect")
 
         # Wait for ACKs to clear outbox
-        time.sleep(1.5)
-        state = send_cmd(proc, "CMD:STATE")
+        _wait_until(lambda: "outbox=0" in _send_cmd(proc, "CMD:STATE"), timeout=3.0)
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=0" in state, f"Outbox should be empty after ACKs: {state}"
         print("  PASS: Outbox cleared after ACKs")
 
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -3179,259 +2930,114 @@ def test_ca_queue_while_disconnected():
 def _setup_single_osm_with_peer():
     """Helper: Start an OSM in a tempdir, generate keys, establish a contact.
     Returns (proc, work_dir, ca, send_cmd_fn, peer_sk)."""
-    import tempfile, shutil, nacl.bindings
-
-    work_dir = tempfile.mkdtemp(prefix="osm_adv_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
-
-    proc = start_osm_in_dir(work_dir, PORT_A)
+
+    work_dir = _mkdtemp("osm_adv_")
+
+    proc = _start_osm(work_dir, PORT_A)
     assert proc, "OSM failed to start"
 
-    resp = send_cmd(proc, "CMD:KEYGEN")
-    assert "CMD:OK:keygen" in resp
-    resp = send_cmd(proc, "CMD:ADD:TestPeer")
-    assert "CMD:OK:add:TestPeer" in resp
+    _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                  ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
     ca = TcpClient(PORT_A, "CA")
     assert ca.connect(), "CA failed to connect"
-    ca.poll(timeout=1.0)  # drain KEX
-
-    peer_sk = nacl.bindings.randombytes(32)
-    peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-    peer_pk_b64 = base64.b64encode(peer_pk).decode()
-    ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{peer_pk_b64}".encode())
-    time.sleep(0.5)
-    resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+    _drain_all(ca)  # drain KEX
+
+    ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+    _wait_pending_key(proc)
+    resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
     assert "ESTABLISHED" in resp
 
-    return proc, work_dir, ca, send_cmd, peer_sk
+    return proc, work_dir, ca, _send_cmd, _PEER_SK
 
 
 def _setup_two_osms_with_kex():
     """Helper: Start Alice + Bob OSMs, do full KEX, return everything needed.
     Returns (alice_proc, bob_proc, alice_dir, bob_dir, ca_alice, ca_bob, send_cmd_fn)."""
-    import tempfile, nacl.bindings
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_alice_adv_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_bob_adv_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
-
-    alice_proc = start_osm_in_dir(alice_dir, PORT_A)
+
+    alice_dir = _mkdtemp("osm_alice_adv_")
+    bob_dir = _mkdtemp("osm_bob_adv_")
+
+    alice_proc = _start_osm(alice_dir, PORT_A)
     assert alice_proc, "Alice failed to start"
-    bob_proc = start_osm_in_dir(bob_dir, PORT_B)
+    bob_proc = _start_osm(bob_dir, PORT_B)
     assert bob_proc, "Bob failed to start"
-    time.sleep(0.3)
 
-    ca_alice = TcpClient(PORT_A, "CA-Alice")
+    # Background readers: both CAs receive (and ACK) concurrently
+    ca_alice = TcpClient(PORT_A, "CA-Alice", background=True)
     assert ca_alice.connect(), "CA-Alice failed"
-    ca_bob = TcpClient(PORT_B, "CA-Bob")
+    ca_bob = TcpClient(PORT_B, "CA-Bob", background=True)
     assert ca_bob.connect(), "CA-Bob failed"
-    time.sleep(0.3)
+    assert _wait_ca_connected(bob_proc), "OSM never accepted the CA"
 
     # Generate keys
-    resp = send_cmd(alice_proc, "CMD:KEYGEN")
-    assert "CMD:OK:keygen" in resp
-    resp = send_cmd(bob_proc, "CMD:KEYGEN")
-    assert "CMD:OK:keygen" in resp
+    resp_a, resp_b = _send_all([alice_proc, bob_proc], "CMD:KEYGEN")
+    assert "CMD:OK:keygen" in resp_a
+    assert "CMD:OK:keygen" in resp_b
 
     # Alice initiates KEX to Bob
-    resp = send_cmd(alice_proc, "CMD:ADD:Bob")
+    resp = _send_cmd(alice_proc, "CMD:ADD:Bob")
     assert "CMD:OK:add:Bob" in resp
-    time.sleep(0.5)
-    alice_out = ca_alice.poll(timeout=1.0)
+    alice_out = _drain_all(ca_alice)
     assert len(alice_out) > 0, "Alice should send KEX"
     _, kex_data = alice_out[0]
 
     # Relay KEX to Bob
     ca_bob.send_message(CHAR_UUID_RX, kex_data)
-    time.sleep(0.5)
-    resp = send_cmd(bob_proc, "CMD:CREATE:Alice")
+    assert _wait_pending_key(bob_proc), "Bob never queued Alice's key"
+    resp = _send_cmd(bob_proc, "CMD:CREATE:Alice")
     assert "PENDING_RECEIVED" in resp
-    resp = send_cmd(bob_proc, "CMD:COMPLETE:Alice")
+    resp = _send_cmd(bob_proc, "CMD:COMPLETE:Alice")
     assert "ESTABLISHED" in resp
 
     # Get Bob's response and relay to Alice
-    time.sleep(0.5)
-    bob_out = ca_bob.poll(timeout=1.0)
+    bob_out = _drain_all(ca_bob)
     assert len(bob_out) > 0, "Bob should send KEX response"
     _, bob_kex = bob_out[0]
 
     ca_alice.send_message(CHAR_UUID_RX, bob_kex)
-    time.sleep(0.5)
-    resp = send_cmd(alice_proc, "CMD:ASSIGN:Bob")
+    assert _wait_pending_key(alice_proc), "Alice never queued Bob's key"
+    resp = _send_cmd(alice_proc, "CMD:ASSIGN:Bob")
     assert "ESTABLISHED" in resp
 
-    return alice_proc, bob_proc, alice_dir, bob_dir, ca_alice, ca_bob, send_cmd
+    return alice_proc, bob_proc, alice_dir, bob_dir, ca_alice, ca_bob, _send_cmd
 
 
+@requires_nacl
 def test_osm_killed_mid_send():
     """Test 32: OSM killed mid-send — restart delivers messages from outbox."""
     print("\n[Test 32] OSM killed mid-send — outbox survives restart")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_midsend_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_midsend_")
 
     proc = None
     try:
-        import nacl.bindings
 
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed"
-        ca.poll(timeout=1.0)  # drain KEX
+        _drain_all(ca)  # drain KEX
 
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{base64.b64encode(peer_pk).decode()}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
         print("  PASS: Contact established")
 
         # Queue messages while CA is disconnected
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
-        for i in range(5):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:Kill test msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:Kill test msg {i+1}"
+                                 for i in range(5)])
+        assert resp.count("CMD:OK:ui_compose") == 5
 
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=5" in state, f"Expected outbox=5: {state}"
         print("  PASS: 5 messages queued in outbox")
 
@@ -3439,30 +3045,25 @@ def test_osm_killed_mid_send():
         proc.kill()
         proc.wait()
         proc = None
-        time.sleep(0.5)
         print("  PASS: OSM killed (SIGKILL)")
 
         # Restart OSM (no clean — preserve data)
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to restart"
         print("  PASS: OSM restarted")
 
         # Connect CA — should get all 5 messages
         ca2 = TcpClient(PORT_A, "CA-post-kill")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-
-        msgs = ca2.poll(timeout=3.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca2) >= 5, timeout=5.0)
+        msg_count = _poll_count(ca2, timeout=0)
         assert msg_count >= 5, f"Expected >=5 messages after restart, got {msg_count}"
         print(f"  PASS: All {msg_count} messages delivered after SIGKILL + restart")
 
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -3475,51 +3076,53 @@ def test_corrupt_fragment():
 
     ca = TcpClient(PORT_A, "CA")
     assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
+    assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
     # Send a 1-byte fragment (too short for header)
-    raw_frame = struct.pack("!IH", 1, CHAR_UUID_RX) + b"\x00"
+    raw_frame = _FRAME.pack(1, CHAR_UUID_RX) + b"\x00"
     ca.sock.sendall(raw_frame)
-    time.sleep(0.2)
+    # A CMD:STATE round-trip instead of a sleep: the OSM answers it from
+    # the same loop that reads the CA socket.
+    assert "CMD:STATE:" in osm.send_cmd("CMD:STATE")
     assert osm.proc.poll() is None, "OSM crashed on 1-byte fragment"
     print("  PASS: 1-byte fragment rejected, no crash")
 
     # Send a 2-byte fragment (still too short)
-    raw_frame = struct.pack("!IH", 2, CHAR_UUID_RX) + b"\x01\x00"
+    raw_frame = _FRAME.pack(2, CHAR_UUID_RX) + b"\x01\x00"
     ca.sock.sendall(raw_frame)
-    time.sleep(0.2)
+    assert "CMD:STATE:" in osm.send_cmd("CMD:STATE")
     assert osm.proc.poll() is None, "OSM crashed on 2-byte fragment"
     print("  PASS: 2-byte fragment rejected, no crash")
 
     # Send a START fragment with no total_len (only 3-byte header, flags=START)
-    frag = struct.pack("<BH", FRAG_FLAG_START, 0)  # 3 bytes, no payload
-    raw_frame = struct.pack("!IH", len(frag), CHAR_UUID_RX) + frag
+    frag = _FRAG.pack(FRAG_FLAG_START, 0)  # 3 bytes, no payload
+    raw_frame = _FRAME.pack(len(frag), CHAR_UUID_RX) + frag
     ca.sock.sendall(raw_frame)
-    time.sleep(0.2)
+    assert "CMD:STATE:" in osm.send_cmd("CMD:STATE")
     assert osm.proc.poll() is None, "OSM crashed on START with no total_len"
     print("  PASS: START with no total_len rejected, no crash")
 
     # Send a START+END with 0-length total_len (empty message body)
-    frag = struct.pack("<BH", FRAG_FLAG_START | FRAG_FLAG_END, 0)
-    frag += struct.pack("<H", 0)  # total_len = 0
-    raw_frame = struct.pack("!IH", len(frag), CHAR_UUID_RX) + frag
+    frag = _FRAG_START.pack(FRAG_FLAG_START | FRAG_FLAG_END, 0, 0)  # total_len = 0
+    raw_frame = _FRAME.pack(len(frag), CHAR_UUID_RX) + frag
     ca.sock.sendall(raw_frame)
-    time.sleep(0.2)
+    assert "CMD:STATE:" in osm.send_cmd("CMD:STATE")
     assert osm.proc.poll() is None, "OSM crashed on zero-length message"
     print("  PASS: Zero-length message handled, no crash")
 
     # Send a fragment with sequence=999 (no prior START)
-    frag = struct.pack("<BH", 0, 999) + b"orphan data"
-    raw_frame = struct.pack("!IH", len(frag), CHAR_UUID_RX) + frag
+    frag = _FRAG.pack(0, 999) + b"orphan data"
+    raw_frame = _FRAME.pack(len(frag), CHAR_UUID_RX) + frag
     ca.sock.sendall(raw_frame)
-    time.sleep(0.2)
+    assert "CMD:STATE:" in osm.send_cmd("CMD:STATE")
     assert osm.proc.poll() is None, "OSM crashed on orphan fragment"
     print("  PASS: Orphan fragment rejected, no crash")
 
     # Verify OSM still works after all the garbage
     valid_msg = b"OSM:MSG:AfterGarbage"
     ca.send_message(CHAR_UUID_RX, valid_msg)
-    time.sleep(0.5)
+    # Logged only once every earlier byte on the stream has been consumed
+    assert osm.wait_for_stderr(b"Could not decrypt"), "Valid msg after garbage not processed"
     assert osm.proc.poll() is None, "OSM crashed processing valid msg after garbage"
     print("  PASS: Valid message processed after garbage fragments")
 
@@ -3531,88 +3134,43 @@ def test_max_size_message():
     """Test 34: Message at MAX_MSG_SIZE boundary (4096 bytes)."""
     print("\n[Test 34] Max-size message (4096 bytes)")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_maxsize_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_maxsize_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A, capture_stderr=True)
         assert proc, "OSM failed to start"
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(proc), "OSM never accepted the CA"
 
         # Send exactly 4096 bytes (MAX_MSG_SIZE)
         big_msg = b"A" * 4096
         ca.send_message(CHAR_UUID_RX, big_msg)
-        time.sleep(1.0)
+        assert proc.stderr.wait_for(b"Unknown message format", 2.0), \
+            "4096-byte message was never processed"
         assert proc.poll() is None, "OSM crashed on 4096-byte message"
         print("  PASS: 4096-byte message accepted")
 
-        # Send 4097 bytes (exceeds MAX_MSG_SIZE) — should be rejected
+        # Send 4097 bytes (exceeds MAX_MSG_SIZE) — should be rejected.
+        # It is dropped silently; the valid message below shows the OSM
+        # got past it.
         oversized_msg = b"B" * 4097
         ca.send_message(CHAR_UUID_RX, oversized_msg)
-        time.sleep(1.0)
-        assert proc.poll() is None, "OSM crashed on oversized message"
-        print("  PASS: 4097-byte message rejected, no crash")
 
         # Verify still functional after oversized message
         ca.send_message(CHAR_UUID_RX, b"OSM:MSG:StillWorking")
-        time.sleep(0.5)
-        assert proc.poll() is None, "OSM crashed after oversized then valid"
+        assert proc.stderr.wait_for(b"Could not decrypt", 2.0), \
+            "OSM stopped processing after oversized message"
+        assert proc.poll() is None, "OSM crashed on oversized message"
+        print("  PASS: 4097-byte message rejected, no crash")
         print("  PASS: OSM still functional after oversized message")
 
         ca.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -3620,54 +3178,29 @@ def test_stale_connection():
     """Test 35: OSM restart while CA holds stale connection."""
     print("\n[Test 35] Stale connection after OSM restart")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_stale_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
+    work_dir = _mkdtemp("osm_stale_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA connected"
-        time.sleep(0.3)
+        assert _wait_ca_connected(proc), "OSM never accepted the CA"
         print("  PASS: CA connected to OSM")
 
         # Kill OSM while CA socket is still open
         proc.kill()
         proc.wait()
         proc = None
-        time.sleep(0.5)
         print("  PASS: OSM killed")
 
         # CA tries to send — should detect broken pipe
         try:
             ca.send_message(CHAR_UUID_RX, b"OSM:MSG:StaleTest")
-            # Give time for broken pipe to manifest
-            time.sleep(0.3)
-            # Try a recv — should get EOF or error
-            result = ca.poll(timeout=1.0)
+            # Try a recv — blocks until the EOF or error shows up
+            ca.poll(timeout=1.0)
         except (BrokenPipeError, ConnectionResetError, OSError):
             pass
         print("  PASS: Stale send detected (broken pipe / EOF)")
@@ -3675,7 +3208,7 @@ def test_stale_connection():
         ca.disconnect()
 
         # Restart OSM
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A, capture_stderr=True)
         assert proc, "OSM failed to restart"
         print("  PASS: OSM restarted on same port")
 
@@ -3683,16 +3216,15 @@ def test_stale_connection():
         ca2 = TcpClient(PORT_A, "CA-fresh")
         assert ca2.connect(), "Fresh CA failed to connect after restart"
         ca2.send_message(CHAR_UUID_RX, b"OSM:MSG:FreshConnection")
-        time.sleep(0.5)
+        assert proc.stderr.wait_for(b"Could not decrypt", 2.0), \
+            "OSM never processed the fresh CA's message"
         assert proc.poll() is None, "OSM crashed after fresh reconnect"
         print("  PASS: Fresh CA works after OSM restart")
 
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -3700,111 +3232,61 @@ def test_simultaneous_kex():
     """Test 36: Both sides initiate KEX simultaneously — both contacts established."""
     print("\n[Test 36] Simultaneous KEX from both sides")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed")
-        return
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_simkex_a_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_simkex_b_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    alice_dir = _mkdtemp("osm_simkex_a_")
+    bob_dir = _mkdtemp("osm_simkex_b_")
 
     alice_proc = None
     bob_proc = None
     try:
-        alice_proc = start_osm_in_dir(alice_dir, PORT_A)
+        alice_proc = _start_osm(alice_dir, PORT_A)
         assert alice_proc, "Alice failed to start"
-        bob_proc = start_osm_in_dir(bob_dir, PORT_B)
+        bob_proc = _start_osm(bob_dir, PORT_B)
         assert bob_proc, "Bob failed to start"
-        time.sleep(0.3)
 
         ca_alice = TcpClient(PORT_A, "CA-Alice")
         assert ca_alice.connect()
         ca_bob = TcpClient(PORT_B, "CA-Bob")
         assert ca_bob.connect()
-        time.sleep(0.3)
+        assert _wait_ca_connected(alice_proc), "Alice never accepted the CA"
+        assert _wait_ca_connected(bob_proc), "OSM never accepted the CA"
 
-        resp = send_cmd(alice_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(bob_proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
+        resp_a, resp_b = _send_all([alice_proc, bob_proc], "CMD:KEYGEN")
+        assert "CMD:OK:keygen" in resp_a
+        assert "CMD:OK:keygen" in resp_b
 
         # Both initiate KEX at the same time
-        resp_a = send_cmd(alice_proc, "CMD:ADD:Bob")
+        resp_a = _send_cmd(alice_proc, "CMD:ADD:Bob")
         assert "CMD:OK:add:Bob" in resp_a
-        resp_b = send_cmd(bob_proc, "CMD:ADD:Alice")
+        resp_b = _send_cmd(bob_proc, "CMD:ADD:Alice")
         assert "CMD:OK:add:Alice" in resp_b
         print("  PASS: Both sides initiated KEX simultaneously")
 
-        time.sleep(0.5)
-        alice_out = ca_alice.poll(timeout=1.0)
-        bob_out = ca_bob.poll(timeout=1.0)
+        _wait_until(lambda: _poll_count(ca_alice, _KEY_PREFIX) >= 1
+                    and _poll_count(ca_bob, _KEY_PREFIX) >= 1, timeout=2.0)
+        alice_out = [d for _, d in ca_alice.received if d.startswith(_KEY_PREFIX)]
+        bob_out = [d for _, d in ca_bob.received if d.startswith(_KEY_PREFIX)]
         assert len(alice_out) > 0, "Alice should send KEX"
         assert len(bob_out) > 0, "Bob should send KEX"
 
         # Cross-relay: Alice's KEX → Bob, Bob's KEX → Alice
-        _, alice_kex = alice_out[0]
-        _, bob_kex = bob_out[0]
+        alice_kex = alice_out[0]
+        bob_kex = bob_out[0]
 
         ca_bob.send_message(CHAR_UUID_RX, alice_kex)
         ca_alice.send_message(CHAR_UUID_RX, bob_kex)
-        time.sleep(0.5)
+        assert _wait_pending_key(alice_proc), "Alice never queued Bob's key"
+        assert _wait_pending_key(bob_proc), "Bob never queued Alice's key"
 
         # Both should have pending keys — assign them
-        resp = send_cmd(alice_proc, "CMD:ASSIGN:Bob")
+        resp = _send_cmd(alice_proc, "CMD:ASSIGN:Bob")
         # May already be ESTABLISHED or need ASSIGN
         print(f"  Alice assign: {resp}")
-        resp = send_cmd(bob_proc, "CMD:ASSIGN:Alice")
+        resp = _send_cmd(bob_proc, "CMD:ASSIGN:Alice")
         print(f"  Bob assign: {resp}")
 
         # Check both have established contacts
-        alice_state = send_cmd(alice_proc, "CMD:STATE")
-        bob_state = send_cmd(bob_proc, "CMD:STATE")
+        alice_state = _send_cmd(alice_proc, "CMD:STATE")
+        bob_state = _send_cmd(bob_proc, "CMD:STATE")
         assert "Bob" in alice_state, f"Alice should know Bob: {alice_state}"
         assert "Alice" in bob_state, f"Bob should know Alice: {bob_state}"
         print("  PASS: Both contacts established after simultaneous KEX")
@@ -3817,28 +3299,17 @@ def test_simultaneous_kex():
         ca_bob.disconnect()
 
     finally:
-        for p in [alice_proc, bob_proc]:
-            if p and p.poll() is None:
-                p.terminate()
-                p.wait(timeout=3)
+        _stop_osm(alice_proc, bob_proc)
         shutil.rmtree(alice_dir, ignore_errors=True)
         shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_kex_immediate_message():
     """Test 37: KEX followed immediately by encrypted message — message arrives."""
     print("\n[Test 37] KEX + immediate message")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed")
-        return
-
-    alice_dir = tempfile.mkdtemp(prefix="osm_kexmsg_a_")
-    bob_dir = tempfile.mkdtemp(prefix="osm_kexmsg_b_")
+    alice_dir = bob_dir = None
     alice_proc = None
     bob_proc = None
     try:
@@ -3850,13 +3321,13 @@ def test_kex_immediate_message():
         print("  PASS: KEX completed")
 
         # Immediately send a message from Alice with no delay
+        before = _poll_count(ca_alice, timeout=0)
         resp = send_cmd(alice_proc, "CMD:UI_COMPOSE:Bob:Immediate after KEX!")
         assert "CMD:OK:ui_compose" in resp
         print("  PASS: Message composed immediately after KEX")
 
-        time.sleep(1.0)
-        msgs = ca_alice.poll(timeout=2.0)
-        msg_count = sum(1 for _, d in msgs if d.decode().startswith("OSM:MSG:"))
+        _wait_until(lambda: _poll_count(ca_alice) > before, timeout=3.0)
+        msg_count = _poll_count(ca_alice, timeout=0) - before
         assert msg_count >= 1, f"Expected >=1 messages, got {msg_count}"
         print(f"  PASS: {msg_count} message(s) sent to CA immediately after KEX")
 
@@ -3867,121 +3338,65 @@ def test_kex_immediate_message():
         ca_bob.disconnect()
 
     finally:
-        for p in [alice_proc, bob_proc]:
-            if p and p.poll() is None:
-                p.terminate()
-                p.wait(timeout=3)
-        shutil.rmtree(alice_dir, ignore_errors=True)
-        shutil.rmtree(bob_dir, ignore_errors=True)
+        _stop_osm(alice_proc, bob_proc)
+        if alice_dir: shutil.rmtree(alice_dir, ignore_errors=True)
+        if bob_dir: shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_kex_while_outbox_full():
     """Test 38: KEX succeeds even when outbox is full."""
     print("\n[Test 38] KEX while outbox full")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed")
-        return
-
-    work_dir = tempfile.mkdtemp(prefix="osm_kexfull_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_kexfull_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
+        resp = _send_cmd(proc, "CMD:KEYGEN")
         assert "CMD:OK:keygen" in resp
 
         # First create a contact with peer so we can fill outbox with messages
-        resp = send_cmd(proc, "CMD:ADD:Filler")
+        resp = _send_cmd(proc, "CMD:ADD:Filler")
         assert "CMD:OK:add:Filler" in resp
 
         ca = TcpClient(PORT_A, "CA")
         assert ca.connect(), "CA failed"
-        ca.poll(timeout=1.0)  # drain KEX for Filler
+        _drain_all(ca)  # drain KEX for Filler
 
-        filler_sk = nacl.bindings.randombytes(32)
-        filler_pk = nacl.bindings.crypto_scalarmult_base(filler_sk)
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{base64.b64encode(filler_pk).decode()}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:Filler")
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:Filler")
         assert "ESTABLISHED" in resp
 
         # Disconnect CA so messages queue
         ca.disconnect()
-        time.sleep(0.3)
+        assert _wait_ca_disconnected(proc), "OSM never dropped the CA"
 
         # Fill outbox with 32 messages
-        for i in range(32):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:Filler:Fill msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:Filler:Fill msg {i+1}"
+                                 for i in range(32)])
+        assert resp.count("CMD:OK:ui_compose") == 32
 
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=32" in state, f"Expected outbox=32: {state}"
         print("  PASS: Outbox full (32 messages)")
 
         # Now initiate KEX for a new contact — should still work
-        resp = send_cmd(proc, "CMD:ADD:NewPeer")
+        resp = _send_cmd(proc, "CMD:ADD:NewPeer")
         assert "CMD:OK:add:NewPeer" in resp
         print("  PASS: KEX initiated despite full outbox")
 
         # Reconnect CA and verify KEX message was sent
         ca2 = TcpClient(PORT_A, "CA-kex")
         assert ca2.connect(), "CA reconnect failed"
-        time.sleep(2.0)
-        msgs = ca2.poll(timeout=3.0)
+        _wait_until(lambda: _poll_count(ca2, _KEY_PREFIX) >= 1, timeout=5.0)
 
         # Should have both: encrypted messages + KEX message
-        kex_msgs = [d for _, d in msgs if d.decode().startswith("OSM:KEY:")]
-        enc_msgs = [d for _, d in msgs if d.decode().startswith("OSM:MSG:")]
+        kex_msgs = [d for _, d in ca2.received if d.startswith(b"OSM:KEY:")]
+        enc_msgs = [d for _, d in ca2.received if d.startswith(b"OSM:MSG:")]
         print(f"  Got {len(kex_msgs)} KEX + {len(enc_msgs)} encrypted messages")
         # KEX goes through the outbox too, so it may have evicted oldest fill msg
         assert len(kex_msgs) >= 1, "KEX message should be sent even with full outbox"
@@ -3991,9 +3406,7 @@ def test_kex_while_outbox_full():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -4006,22 +3419,23 @@ def test_duplicate_message():
 
     ca = TcpClient(PORT_A, "CA")
     assert ca.connect(), "CA failed to connect"
-    time.sleep(0.3)
+    assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
     msg = b"OSM:MSG:DuplicateTest12345"
 
-    # Send the same message twice
-    ca.send_message(CHAR_UUID_RX, msg)
-    time.sleep(0.2)
-    ca.send_message(CHAR_UUID_RX, msg)
-    time.sleep(0.5)
+    # Send the same message twice; each one logs a failed decrypt
+    for _ in range(2):
+        mark = osm.stderr_mark()
+        ca.send_message(CHAR_UUID_RX, msg)
+        assert osm.wait_for_stderr(b"Could not decrypt", since=mark), "Duplicate not processed"
 
     assert osm.proc.poll() is None, "OSM crashed on duplicate message"
     print("  PASS: Duplicate messages processed without crash")
 
     # Send a different message after — verify OSM still works
+    mark = osm.stderr_mark()
     ca.send_message(CHAR_UUID_RX, b"OSM:MSG:AfterDuplicate")
-    time.sleep(0.5)
+    assert osm.wait_for_stderr(b"Could not decrypt", since=mark), "Message not processed"
     assert osm.proc.poll() is None, "OSM crashed after duplicate + new message"
     print("  PASS: OSM functional after processing duplicates")
 
@@ -4029,18 +3443,11 @@ def test_duplicate_message():
     osm.stop()
 
 
+@requires_nacl
 def test_bidirectional_concurrent_send():
     """Test 40: Both OSMs send messages simultaneously — no corruption."""
     print("\n[Test 40] Bidirectional concurrent send")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed")
-        return
-
     alice_proc = None
     bob_proc = None
     alice_dir = ""
@@ -4050,21 +3457,23 @@ def test_bidirectional_concurrent_send():
             _setup_two_osms_with_kex()
         print("  PASS: KEX completed")
 
-        # Both send 5 messages simultaneously
-        for i in range(5):
-            resp = send_cmd(alice_proc, f"CMD:UI_COMPOSE:Bob:A2B msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
-            resp = send_cmd(bob_proc, f"CMD:UI_COMPOSE:Alice:B2A msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
-
-        time.sleep(1.5)
-
-        # Collect messages from both CAs
-        alice_msgs = ca_alice.poll(timeout=2.0)
-        bob_msgs = ca_bob.poll(timeout=2.0)
-
-        a2b_count = sum(1 for _, d in alice_msgs if d.decode().startswith("OSM:MSG:"))
-        b2a_count = sum(1 for _, d in bob_msgs if d.decode().startswith("OSM:MSG:"))
+        # Both send 5 messages simultaneously: queue both bursts before
+        # reading either side's acknowledgements
+        bursts = [(alice_proc, [f"CMD:UI_COMPOSE:Bob:A2B msg {i+1}" for i in range(5)]),
+                  (bob_proc, [f"CMD:UI_COMPOSE:Alice:B2A msg {i+1}" for i in range(5)])]
+        for proc, cmds in bursts:
+            proc.stdin.write("".join(f"{cmd}\n" for cmd in cmds).encode())
+            proc.stdin.flush()
+        for proc, cmds in bursts:
+            resp = _read_cmd_lines(proc, len(cmds), False, 10.0)
+            assert resp.count("CMD:OK:ui_compose") == len(cmds), f"Compose burst failed: {resp}"
+
+        # Collect messages from both CAs (their reader threads receive in
+        # parallel, so just check the queues)
+        _wait_until(lambda: _poll_count(ca_alice, timeout=0) >= 5
+                    and _poll_count(ca_bob, timeout=0) >= 5, timeout=3.5)
+        a2b_count = _poll_count(ca_alice, timeout=0)
+        b2a_count = _poll_count(ca_bob, timeout=0)
 
         print(f"  Alice CA got {a2b_count} msgs, Bob CA got {b2a_count} msgs")
         assert a2b_count >= 5, f"Expected >=5 from Alice, got {a2b_count}"
@@ -4078,128 +3487,69 @@ def test_bidirectional_concurrent_send():
         ca_bob.disconnect()
 
     finally:
-        for p in [alice_proc, bob_proc]:
-            if p and p.poll() is None:
-                p.terminate()
-                p.wait(timeout=3)
+        _stop_osm(alice_proc, bob_proc)
         if alice_dir: shutil.rmtree(alice_dir, ignore_errors=True)
         if bob_dir: shutil.rmtree(bob_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_out_of_order_ack():
     """Test 41: ACKs arrive in different order than sends — all clear from outbox."""
     print("\n[Test 41] Out-of-order ACK handling")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed")
-        return
-
-    work_dir = tempfile.mkdtemp(prefix="osm_oooack_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_oooack_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:TestPeer")
-        assert "CMD:OK:add:TestPeer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:TestPeer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:TestPeer"])
 
         # Connect CA but don't auto-ACK — we'll manually ACK in reverse order
         ca = TcpClient(PORT_A, "CA-manual")
         assert ca.connect(), "CA failed"
-        ca.poll(timeout=1.0)  # drain KEX
+        _drain_all(ca)  # drain KEX
 
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        ca.send_message(CHAR_UUID_RX, f"OSM:KEY:{base64.b64encode(peer_pk).decode()}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:TestPeer")
+        ca.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:TestPeer")
         assert "ESTABLISHED" in resp
 
         # Queue 3 messages
-        for i in range(3):
-            resp = send_cmd(proc, f"CMD:UI_COMPOSE:TestPeer:OOO msg {i+1}")
-            assert "CMD:OK:ui_compose" in resp
-
-        time.sleep(1.0)
+        resp = _send_many(proc, [f"CMD:UI_COMPOSE:TestPeer:OOO msg {i+1}"
+                                 for i in range(3)])
+        assert resp.count("CMD:OK:ui_compose") == 3
 
         # Collect all messages WITHOUT auto-ACKing
         # Use raw recv to get the data without the poll auto-ACK
         collected = []
-        deadline = time.time() + 3.0
+        deadline = time.monotonic() + 3.0
         rx_buf = bytearray()
         rx_seq = 0
         rx_active = False
+        buf = bytearray()
 
-        while time.time() < deadline:
+        while time.monotonic() < deadline:
             try:
                 raw = ca.sock.recv(4096)
                 if not raw: break
             except BlockingIOError:
-                time.sleep(0.01)
+                select.select([ca.sock], [], [], max(0.0, deadline - time.monotonic()))
                 continue
             except OSError:
                 break
 
-            buf = raw
+            buf.extend(raw)
             pos = 0
             while pos + 6 <= len(buf):
-                msg_len, char_uuid = struct.unpack("!IH", buf[pos:pos+6])
-                pos += 6
-                if pos + msg_len > len(buf): break
-                frag = buf[pos:pos+msg_len]
-                pos += msg_len
+                msg_len, char_uuid = _FRAME.unpack_from(buf, pos)
+                if pos + 6 + msg_len > len(buf): break
+                frag = bytes(buf[pos + 6:pos + 6 + msg_len])
+                pos += 6 + msg_len
                 if len(frag) < 3: continue
-                flags, seq = struct.unpack("<BH", frag[:3])
+                flags, seq = _FRAG.unpack_from(frag)
                 payload = frag[3:]
                 if flags & FRAG_FLAG_ACK: continue
                 if flags & FRAG_FLAG_START:
@@ -4216,23 +3566,25 @@ def test_out_of_order_ack():
                     collected.append(bytes(rx_buf))
                     rx_active = False
                     rx_buf = bytearray()
+            del buf[:pos]
+            if sum(m.startswith(_MSG_PREFIX) for m in collected) >= 3:
+                break
 
         enc_msgs = [m for m in collected if m.decode(errors="replace").startswith("OSM:MSG:")]
         print(f"  Collected {len(enc_msgs)} messages (no ACKs sent)")
         assert len(enc_msgs) >= 3, f"Expected >=3, got {len(enc_msgs)}"
 
         # Outbox should still have 3 items (no ACKs sent)
-        state = send_cmd(proc, "CMD:STATE")
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=3" in state, f"Expected outbox=3 (no ACKs yet): {state}"
 
         # Send ACKs in REVERSE order
         for msg in reversed(enc_msgs[:3]):
             msg_id = TcpClient.compute_msg_id(msg)
             ca.send_ack(msg_id)
-            time.sleep(0.2)
 
-        time.sleep(1.0)
-        state = send_cmd(proc, "CMD:STATE")
+        _wait_until(lambda: "outbox=0" in _send_cmd(proc, "CMD:STATE"), timeout=2.0)
+        state = _send_cmd(proc, "CMD:STATE")
         assert "outbox=0" in state, f"Outbox should be empty after out-of-order ACKs: {state}"
         print("  PASS: All messages ACKed out-of-order, outbox empty")
 
@@ -4240,108 +3592,49 @@ def test_out_of_order_ack():
         ca.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
+@requires_nacl
 def test_two_cas_one_osm():
     """Test 42: Two CAs connected to one OSM — both receive broadcast messages."""
     print("\n[Test 42] Two CAs connected to one OSM")
 
-    import tempfile, shutil
-
-    try:
-        import nacl.bindings
-    except ImportError:
-        print("  SKIP: PyNaCl not installed")
-        return
-
-    work_dir = tempfile.mkdtemp(prefix="osm_multi_ca_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_multi_ca_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
-        assert "CMD:OK:keygen" in resp
-        resp = send_cmd(proc, "CMD:ADD:Peer")
-        assert "CMD:OK:add:Peer" in resp
+        _script(proc, ["CMD:KEYGEN", "CMD:ADD:Peer"],
+                      ["CMD:OK:keygen", "CMD:OK:add:Peer"])
 
         # Connect TWO CAs
         ca1 = TcpClient(PORT_A, "CA-1")
         assert ca1.connect(), "CA-1 failed"
         ca2 = TcpClient(PORT_A, "CA-2")
         assert ca2.connect(), "CA-2 failed"
-        time.sleep(0.5)
+        assert _wait_ca_connected(proc, 2), "OSM never accepted both CAs"
 
         # Drain any initial KEX on both
-        ca1.poll(timeout=1.0)
-        ca2.poll(timeout=1.0)
+        _drain_all(ca1)
+        _drain_all(ca2)
 
         # Establish contact via CA-1
-        peer_sk = nacl.bindings.randombytes(32)
-        peer_pk = nacl.bindings.crypto_scalarmult_base(peer_sk)
-        ca1.send_message(CHAR_UUID_RX, f"OSM:KEY:{base64.b64encode(peer_pk).decode()}".encode())
-        time.sleep(0.5)
-        resp = send_cmd(proc, "CMD:ASSIGN:Peer")
+        ca1.send_message(CHAR_UUID_RX, _PEER_KEX)
+        _wait_pending_key(proc)
+        resp = _send_cmd(proc, "CMD:ASSIGN:Peer")
         assert "ESTABLISHED" in resp
 
         # Send a message — both CAs should receive it (broadcast)
-        resp = send_cmd(proc, "CMD:UI_COMPOSE:Peer:BroadcastTest")
+        resp = _send_cmd(proc, "CMD:UI_COMPOSE:Peer:BroadcastTest")
         assert "CMD:OK:ui_compose" in resp
-        time.sleep(1.0)
+        _wait_until(lambda: _poll_count(ca1) >= 1 and _poll_count(ca2) >= 1, timeout=3.0)
 
-        msgs1 = ca1.poll(timeout=2.0)
-        msgs2 = ca2.poll(timeout=2.0)
-
-        enc1 = sum(1 for _, d in msgs1 if d.decode().startswith("OSM:MSG:"))
-        enc2 = sum(1 for _, d in msgs2 if d.decode().startswith("OSM:MSG:"))
+        enc1 = _poll_count(ca1, timeout=0)
+        enc2 = _poll_count(ca2, timeout=0)
 
         print(f"  CA-1 got {enc1} msgs, CA-2 got {enc2} msgs")
         assert enc1 >= 1, f"CA-1 should get message, got {enc1}"
@@ -4353,9 +3646,7 @@ def test_two_cas_one_osm():
         ca2.disconnect()
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -4363,87 +3654,40 @@ def test_send_to_invalid_device():
     """Test 43: Sending to a nonexistent contact — graceful failure."""
     print("\n[Test 43] Send to invalid/nonexistent contact")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_invalid_")
-
-    def start_osm_in_dir(workdir, port):
-        env = os.environ.copy()
-        env["SDL_VIDEODRIVER"] = "dummy"
-        proc = subprocess.Popen(
-            [os.path.abspath(BINARY), "--port", str(port)],
-            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-            env=env, cwd=workdir,
-        )
-        deadline = time.time() + 5
-        while time.time() < deadline:
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.settimeout(0.5)
-                s.connect(("127.0.0.1", port))
-                s.close()
-                return proc
-            except (ConnectionRefusedError, OSError):
-                time.sleep(0.1)
-        return None
-
-    def send_cmd(proc, cmd, timeout=5.0):
-        import select
-        proc.stdin.write(f"{cmd}\n".encode())
-        proc.stdin.flush()
-        is_state = cmd.strip() == "CMD:STATE"
-        buf = b""
-        fd = proc.stdout.fileno()
-        deadline = time.time() + timeout
-        while time.time() < deadline:
-            ready, _, _ = select.select([fd], [], [], 0.2)
-            if ready:
-                chunk = os.read(fd, 4096)
-                if not chunk: break
-                buf += chunk
-                text = buf.decode(errors="replace")
-                if is_state and "CMD:STATE:END" in text: break
-                for line in text.split("\n"):
-                    line = line.strip()
-                    if not is_state and line.startswith(("CMD:OK:", "CMD:ERR:", "CMD:IDENTITY:")):
-                        deadline = 0; break
-            if proc.poll() is not None: break
-        return "\n".join(l.strip() for l in buf.decode(errors="replace").split("\n") if l.strip().startswith("CMD:"))
+    work_dir = _mkdtemp("osm_invalid_")
 
     proc = None
     try:
-        proc = start_osm_in_dir(work_dir, PORT_A)
+        proc = _start_osm(work_dir, PORT_A)
         assert proc, "OSM failed to start"
 
-        resp = send_cmd(proc, "CMD:KEYGEN")
+        resp = _send_cmd(proc, "CMD:KEYGEN")
         assert "CMD:OK:keygen" in resp
 
         # Try to compose for nonexistent contact
-        resp = send_cmd(proc, "CMD:UI_COMPOSE:NonExistent:Hello nobody")
+        resp = _send_cmd(proc, "CMD:UI_COMPOSE:NonExistent:Hello nobody")
         print(f"  Response: {resp}")
         # Should get an error, not crash
         assert proc.poll() is None, "OSM crashed on compose to nonexistent contact"
         print("  PASS: Compose to nonexistent contact — no crash")
 
         # Try to complete KEX for nonexistent contact
-        resp = send_cmd(proc, "CMD:COMPLETE:GhostPeer")
+        resp = _send_cmd(proc, "CMD:COMPLETE:GhostPeer")
         assert proc.poll() is None, "OSM crashed on COMPLETE for nonexistent"
         print("  PASS: COMPLETE for nonexistent contact — no crash")
 
         # Try to assign nonexistent pending key
-        resp = send_cmd(proc, "CMD:ASSIGN:NobodyHere")
+        resp = _send_cmd(proc, "CMD:ASSIGN:NobodyHere")
         assert proc.poll() is None, "OSM crashed on ASSIGN for nonexistent"
         print("  PASS: ASSIGN for nonexistent contact — no crash")
 
         # Verify OSM is still fully functional
-        resp = send_cmd(proc, "CMD:ADD:RealPeer")
+        resp = _send_cmd(proc, "CMD:ADD:RealPeer")
         assert "CMD:OK:add:RealPeer" in resp
         print("  PASS: OSM still functional after invalid commands")
 
     finally:
-        if proc and proc.poll() is None:
-            proc.terminate()
-            proc.wait(timeout=3)
+        _stop_osm(proc)
         shutil.rmtree(work_dir, ignore_errors=True)
 
 
@@ -4451,22 +3695,16 @@ def test_force_kill_persistence():
     """Test 44: Force-kill OSM (SIGKILL), restart, verify data survived."""
     print("\n[Test 44] Force-kill persistence (power-loss simulation)")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_kill_")
+    work_dir = _mkdtemp("osm_kill_")
     osm = OsmProcess(PORT_A, "OSM-Kill", work_dir=work_dir)
     try:
         assert osm.start(), "OSM failed to start"
         ca = TcpClient(PORT_A, "CA-Kill")
         assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
-
-        # Generate keypair first
-        osm.send_cmd("CMD:KEYGEN")
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-        # Get our pubkey to use as fake peer key
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        # Generate keypair first, and use our pubkey as a fake peer key
+        pubkey = _keygen_identity(osm.proc)[0]
 
         # Add established contact directly
         resp = osm.send_cmd(f"CMD:ADD_CONTACT:PowerTestPeer:2:{pubkey}")
@@ -4474,7 +3712,7 @@ def test_force_kill_persistence():
 
         # Send a message
         resp = osm.send_cmd("CMD:SEND:PowerTestPeer:survive the kill")
-        ca.poll(timeout=2)
+        _wait_until(lambda: _poll_count(ca) >= 1, timeout=2.0)
 
         # Verify data present before kill
         state = osm.send_cmd("CMD:STATE")
@@ -4486,7 +3724,6 @@ def test_force_kill_persistence():
         osm.proc.wait()
         osm.proc = None
         ca.disconnect()
-        time.sleep(0.5)
 
         # Restart from same work_dir (don't clean)
         assert osm.start(clean=False), "OSM failed to restart after SIGKILL"
@@ -4506,23 +3743,19 @@ def test_contact_delete_and_readd():
     """Test 45: Delete a contact, verify messages gone, re-add same name."""
     print("\n[Test 45] Contact deletion + re-add")
 
-    osm = OsmProcess(PORT_A, "OSM-Del")
+    osm = _shared_osm()
+    ca = TcpClient(osm.port, "CA-Del")
+    assert ca.connect(), "CA failed to connect"
     try:
-        assert osm.start(), "OSM failed to start"
-        ca = TcpClient(PORT_A, "CA-Del")
-        assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-        osm.send_cmd("CMD:KEYGEN")
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        pubkey = _keygen_identity(osm.proc)[0]
 
         # Create established contact + messages
         osm.send_cmd(f"CMD:ADD_CONTACT:ReaddPeer:2:{pubkey}")
         osm.send_cmd("CMD:SEND:ReaddPeer:message one")
         osm.send_cmd("CMD:SEND:ReaddPeer:message two")
-        ca.poll(timeout=2)
-        time.sleep(0.5)
+        _wait_until(lambda: _poll_count(ca) >= 2, timeout=2.0)
 
         state = osm.send_cmd("CMD:STATE")
         assert "ReaddPeer" in state
@@ -4550,29 +3783,24 @@ def test_contact_delete_and_readd():
 
     finally:
         ca.disconnect()
-        osm.stop()
 
 
 def test_message_delete():
     """Test 46: Delete a single message, verify thread updated."""
     print("\n[Test 46] Message deletion via CMD")
 
-    osm = OsmProcess(PORT_A, "OSM-MsgDel")
+    osm = _shared_osm()
+    ca = TcpClient(osm.port, "CA-MsgDel")
+    assert ca.connect(), "CA failed to connect"
     try:
-        assert osm.start(), "OSM failed to start"
-        ca = TcpClient(PORT_A, "CA-MsgDel")
-        assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-        osm.send_cmd("CMD:KEYGEN")
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        pubkey = _keygen_identity(osm.proc)[0]
 
         osm.send_cmd(f"CMD:ADD_CONTACT:MsgDelPeer:2:{pubkey}")
         osm.send_cmd("CMD:SEND:MsgDelPeer:keep this")
         osm.send_cmd("CMD:SEND:MsgDelPeer:delete this")
-        ca.poll(timeout=2)
-        time.sleep(0.5)
+        _wait_until(lambda: _poll_count(ca) >= 2, timeout=2.0)
 
         state = osm.send_cmd("CMD:STATE")
         assert "keep this" in state
@@ -4582,7 +3810,6 @@ def test_message_delete():
         # Delete second message by text match
         resp = osm.send_cmd("CMD:DELETE_MSG:delete this")
         assert "CMD:OK:delete_msg" in resp
-        time.sleep(0.3)
 
         state = osm.send_cmd("CMD:STATE")
         assert "keep this" in state
@@ -4591,23 +3818,19 @@ def test_message_delete():
 
     finally:
         ca.disconnect()
-        osm.stop()
 
 
 def test_long_names_and_messages():
     """Test 47: Long contact names and messages at buffer boundaries."""
     print("\n[Test 47] Long names/messages at buffer limits")
 
-    osm = OsmProcess(PORT_A, "OSM-Long")
+    osm = _shared_osm()
+    ca = TcpClient(osm.port, "CA-Long")
+    assert ca.connect(), "CA failed to connect"
     try:
-        assert osm.start(), "OSM failed to start"
-        ca = TcpClient(PORT_A, "CA-Long")
-        assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-        osm.send_cmd("CMD:KEYGEN")
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        pubkey = _keygen_identity(osm.proc)[0]
 
         # Max name is 63 chars (MAX_NAME_LEN=64, -1 for NUL)
         long_name = "A" * 63
@@ -4618,8 +3841,7 @@ def test_long_names_and_messages():
         # Long message (900 chars — well under MAX_TEXT_LEN=1024)
         long_msg = "B" * 900
         resp = osm.send_cmd(f"CMD:SEND:{long_name}:{long_msg}")
-        ca.poll(timeout=3)
-        time.sleep(0.5)
+        _wait_until(lambda: _poll_count(ca) >= 1, timeout=3.0)
 
         state = osm.send_cmd("CMD:STATE")
         # Verify message was stored (at least first 100 chars)
@@ -4632,23 +3854,18 @@ def test_long_names_and_messages():
 
     finally:
         ca.disconnect()
-        osm.stop()
 
 
 def test_power_cycle_with_outbox():
     """Test 48: Queue messages offline, force-kill, restart, verify outbox survives."""
     print("\n[Test 48] Power-cycle with outbox")
 
-    import tempfile, shutil
-
-    work_dir = tempfile.mkdtemp(prefix="osm_outbox_kill_")
+    work_dir = _mkdtemp("osm_outbox_kill_")
     osm = OsmProcess(PORT_A, "OSM-OQ", work_dir=work_dir)
     try:
         assert osm.start(), "OSM failed to start"
 
-        osm.send_cmd("CMD:KEYGEN")
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        pubkey = _keygen_identity(osm.proc)[0]
 
         # Add established contact, no CA connected
         osm.send_cmd(f"CMD:ADD_CONTACT:OutboxPeer:2:{pubkey}")
@@ -4656,7 +3873,6 @@ def test_power_cycle_with_outbox():
         # Queue messages (no CA connected, so they stay in outbox)
         for i in range(3):
             osm.send_cmd(f"CMD:SEND:OutboxPeer:queued msg {i}")
-        time.sleep(0.5)
 
         state = osm.send_cmd("CMD:STATE")
         assert "OutboxPeer" in state
@@ -4666,7 +3882,6 @@ def test_power_cycle_with_outbox():
         osm.proc.kill()
         osm.proc.wait()
         osm.proc = None
-        time.sleep(0.5)
 
         # Restart
         assert osm.start(clean=False), "OSM failed to restart"
@@ -4679,10 +3894,8 @@ def test_power_cycle_with_outbox():
         # Connect CA, outbox should flush
         ca = TcpClient(PORT_A, "CA-OQ")
         assert ca.connect(), "CA reconnected"
-        time.sleep(2)
-
-        msgs = ca.poll(timeout=3)
-        print(f"  Received {len(msgs)} messages after restart")
+        _wait_until(lambda: _poll_count(ca) >= 3, timeout=3.0)
+        print(f"  Received {_poll_count(ca, timeout=0)} messages after restart")
         print("  PASS: Outbox survived SIGKILL + restart")
 
         ca.disconnect()
@@ -4695,16 +3908,13 @@ def test_contact_rename():
     """Test 49: Rename a contact via CMD:RENAME and verify state."""
     print("\n[Test 49] Contact rename")
 
-    osm = OsmProcess(PORT_A, "OSM-Rename")
+    osm = _shared_osm()
     try:
-        assert osm.start(), "OSM failed to start"
-        ca = TcpClient(PORT_A, "CA-Rename")
+        ca = TcpClient(osm.port, "CA-Rename")
         assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-        osm.send_cmd("CMD:KEYGEN")
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        pubkey = _keygen_identity(osm.proc)[0]
 
         # Add established contact
         resp = osm.send_cmd(f"CMD:ADD_CONTACT:OldName:2:{pubkey}")
@@ -4731,26 +3941,21 @@ def test_contact_rename():
         assert "CMD:OK:ui_compose:NewName" in resp, f"Compose after rename failed: {resp}"
         print("  PASS: Can compose to renamed contact")
 
-        ca.disconnect()
-
     finally:
-        osm.stop()
+        ca.disconnect()
 
 
 def test_empty_conversation():
     """Test 50: Navigate to conversation with no messages — shows empty state."""
     print("\n[Test 50] Empty conversation")
 
-    osm = OsmProcess(PORT_A, "OSM-EmptyConvo")
+    osm = _shared_osm()
     try:
-        assert osm.start(), "OSM failed to start"
-        ca = TcpClient(PORT_A, "CA-EmptyConvo")
+        ca = TcpClient(osm.port, "CA-EmptyConvo")
         assert ca.connect(), "CA failed to connect"
-        time.sleep(0.3)
+        assert _wait_ca_connected(osm.proc), "OSM never accepted the CA"
 
-        osm.send_cmd("CMD:KEYGEN")
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+        pubkey = _keygen_identity(osm.proc)[0]
 
         # Add established contact (no messages)
         resp = osm.send_cmd(f"CMD:ADD_CONTACT:EmptyPeer:2:{pubkey}")
@@ -4778,131 +3983,422 @@ def test_empty_conversation():
         assert "CMD:OK:ui_reply" in resp
         print("  PASS: Reply works in conversation")
 
-        ca.disconnect()
-
     finally:
-        osm.stop()
+        ca.disconnect()
 
 
 def test_screen_navigation():
     """Test 51: Verify screen navigation — default is contacts, tab nav works."""
     print("\n[Test 51] Screen navigation")
 
-    osm = OsmProcess(PORT_A, "OSM-Nav")
+    osm = _shared_osm()
+    osm.send_cmd("CMD:KEYGEN")
+
+    # After setup, default screen should be CONTACTS
+    state = osm.send_cmd("CMD:STATE")
+    assert "screen=CONTACTS" in state, f"Expected CONTACTS screen, got: {state}"
+    print("  PASS: Default screen is CONTACTS")
+
+    # Setup an established contact
+    resp = osm.send_cmd("CMD:IDENTITY")
+    pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
+    osm.send_cmd(f"CMD:ADD_CONTACT:NavPeer:2:{pubkey}")
+
+    # Compose goes to CONVERSATION
+    resp = osm.send_cmd("CMD:UI_COMPOSE:NavPeer:Nav test msg")
+    assert "screen=CONVERSATION" in resp
+    state = osm.send_cmd("CMD:STATE")
+    assert "screen=CONVERSATION" in state
+    print("  PASS: CMD:UI_COMPOSE navigates to CONVERSATION")
+
+    # HOME/COMPOSE screens should NOT exist in screen names
+    assert "screen=HOME" not in state
+    assert "screen=COMPOSE" not in state
+    print("  PASS: No HOME or COMPOSE screens in state")
+
+
+def test_reset_clears_state():
+    """Test 52: CMD:RESET wipes identity, contacts and queues in-process."""
+    print("\n[Test 52] CMD:RESET")
+
+    osm = _shared_osm()
+    pubkey = _keygen_identity(osm.proc)[0]
+    osm.send_cmd(f"CMD:ADD_CONTACT:ResetPeer:2:{pubkey}")
+    osm.send_cmd("CMD:UI_COMPOSE:ResetPeer:Before reset")
+    state = osm.send_cmd("CMD:STATE")
+    assert "contacts=1" in state, f"Setup failed: {state}"
+
+    resp = osm.send_cmd("CMD:RESET")
+    assert "CMD:OK:reset" in resp, f"RESET failed: {resp}"
+    state = osm.send_cmd("CMD:STATE")
+    assert "contacts=0,pending=0,outbox=0,screen=SETUP" in state, \
+        f"State not cleared: {state}"
+    assert "CMD:MSG:" not in state
+    assert "storage=OK" in state, f"Storage flag survived RESET: {state}"
+    print("  PASS: RESET clears contacts, messages, outbox, storage flags")
+
+    resp = osm.send_cmd("CMD:KEYGEN")
+    assert "generated" in resp, f"KEYGEN after RESET failed: {resp}"
+    print("  PASS: Fresh identity can be generated after RESET")
+
+
+def _pool_worker_init():
+    """Set up a main() pool worker the way an xdist worker is set up: its
+    own kernel-assigned ports (each test gets its own cwd in _run_test)."""
+    global PORT_A, PORT_B, PORT_SHARED
+    PORT_A, PORT_B, PORT_SHARED = _free_ports(3)
+    # Pool workers leave through multiprocessing's exit path, not atexit.
+    multiprocessing.util.Finalize(None, _stop_shared_osm, exitpriority=10)
+
+
+def _child_cpu() -> tuple[float, int]:
+    """CPU seconds used and peak RSS (KiB on Linux) of reaped children."""
+    if resource is None:
+        return 0.0, 0
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime, ru.ru_maxrss
+
+
+def _run_test(test_fn) -> tuple[str, str, float, dict]:
+    """Run one test and report ("pass"|"fail"|"error", detail, seconds,
+    stats), where stats holds the OSM CPU time and spawn count it caused.
+    peak_rss is the largest child so far in this process, not per test."""
+    cpu0, _ = _child_cpu()
+    spawned0 = _SPAWN_COUNT
+    t0 = time.perf_counter()
     try:
-        assert osm.start(), "OSM failed to start"
-        time.sleep(0.3)
+        with _scratch_cwd():
+            test_fn()
+        outcome, detail = "pass", ""
+    except AssertionError as e:
+        outcome, detail = "fail", str(e)
+    except Exception as e:
+        outcome, detail = "error", str(e)
+    seconds = time.perf_counter() - t0
+    cpu1, peak_rss = _child_cpu()
+    return outcome, detail, seconds, {"child_cpu": round(cpu1 - cpu0, 3),
+                                      "peak_rss": peak_rss,
+                                      "spawned": _SPAWN_COUNT - spawned0}
 
-        osm.send_cmd("CMD:KEYGEN")
 
-        # After setup, default screen should be CONTACTS
-        state = osm.send_cmd("CMD:STATE")
-        assert "screen=CONTACTS" in state, f"Expected CONTACTS screen, got: {state}"
-        print("  PASS: Default screen is CONTACTS")
+# One JSON line per executed test (appended by main()), for profiling.
+_TELEMETRY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               ".e2e_telemetry.jsonl")
 
-        # Setup an established contact
-        resp = osm.send_cmd("CMD:IDENTITY")
-        pubkey = resp.split("CMD:IDENTITY:")[-1].strip()
-        osm.send_cmd(f"CMD:ADD_CONTACT:NavPeer:2:{pubkey}")
+# Last known wall time per test, written by main() and used by --shard.
+_DURATIONS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                               ".e2e_durations.json")
 
-        # Compose goes to CONVERSATION
-        resp = osm.send_cmd("CMD:UI_COMPOSE:NavPeer:Nav test msg")
-        assert "screen=CONVERSATION" in resp
-        state = osm.send_cmd("CMD:STATE")
-        assert "screen=CONVERSATION" in state
-        print("  PASS: CMD:UI_COMPOSE navigates to CONVERSATION")
 
-        # HOME/COMPOSE screens should NOT exist in screen names
-        assert "screen=HOME" not in state
-        assert "screen=COMPOSE" not in state
-        print("  PASS: No HOME or COMPOSE screens in state")
+def _load_durations() -> dict[str, float]:
+    try:
+        with open(_DURATIONS_FILE) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Tests that passed against an identical binary, test body, shared harness
+# and Python version; main() skips them unless --no-memo / E2E_NO_MEMO.
+_MEMO_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          ".e2e_memo.json")
+
+
+def _memo_keys(tests: list) -> dict:
+    """Map each test to its memo key. The harness hash covers everything in
+    this file except the test bodies, so editing a helper invalidates all."""
+    with open(_BINARY_ABS, "rb") as f:
+        bin_hash = hashlib.sha256(f.read()).hexdigest()
+    bodies = {fn: inspect.getsource(fn) for fn in tests}
+    harness = inspect.getsource(sys.modules[__name__])
+    for body in bodies.values():
+        harness = harness.replace(body, "")
+    common = ":".join([bin_hash, hashlib.sha256(harness.encode()).hexdigest(),
+                       sys.version.split()[0]])
+    return {fn: f"{fn.__name__}:{common}:"
+                f"{hashlib.sha256(body.encode()).hexdigest()}"
+            for fn, body in bodies.items()}
+
+
+def _write_junit(path: str, records: list[tuple[str, str, str, float]]):
+    """Write (name, outcome, detail, seconds) records as a JUnit XML report,
+    so reports from separate shards can be merged by CI."""
+    suite = ET.Element("testsuite", name="e2e_test", tests=str(len(records)),
+                       failures=str(sum(r[1] == "fail" for r in records)),
+                       errors=str(sum(r[1] == "error" for r in records)),
+                       skipped=str(sum(r[1] == "skip" for r in records)))
+    for name, outcome, detail, seconds in records:
+        case = ET.SubElement(suite, "testcase", classname="e2e_test",
+                             name=name, time=f"{seconds:.3f}")
+        if outcome == "fail":
+            ET.SubElement(case, "failure", message=detail)
+        elif outcome == "error":
+            ET.SubElement(case, "error", message=detail)
+        elif outcome == "skip":
+            ET.SubElement(case, "skipped", message=detail)
+    ET.ElementTree(suite).write(path, encoding="utf-8", xml_declaration=True)
+
+
+_OSM_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "osm")
+# Built binaries keyed by _osm_build_key(), so CI (or a fresh checkout) can
+# skip the cmake build when the OSM sources haven't changed.
+_BUILD_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME")
+                            or os.path.expanduser("~/.cache"), "osm-e2e")
+_BUILD_INPUTS = ("src", "littlefs", "CMakeLists.txt", "lv_conf.h")
+_CMAKE_CACHE = os.path.join(_OSM_DIR, "build", "CMakeCache.txt")
+
+
+def _build_input_files() -> list[str]:
+    files = []
+    for entry in _BUILD_INPUTS:
+        path = os.path.join(_OSM_DIR, entry)
+        if os.path.isfile(path):
+            files.append(path)
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, n) for n in sorted(names))
+    return files
+
+
+def _build_config() -> bytes:
+    """The user-settable entries of osm/build/CMakeCache.txt (options such as
+    TRANSPORT_BLE, build type, compiler and flags), with the checkout path
+    stripped so the same configuration hashes alike in any clone."""
+    try:
+        with open(_CMAKE_CACHE) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return b""
+    osm_dir = os.path.realpath(_OSM_DIR)
+    entries = [line.replace(osm_dir, "") for line in lines
+               if re.match(r"[^#/][^:]*:(BOOL|STRING|FILEPATH)=", line)]
+    return "\n".join(sorted(entries)).encode()
+
+
+def _newest_build_input() -> float:
+    """Newest mtime among the build inputs and the CMake cache. Only stats
+    files, so main() can rule out a store before hashing anything."""
+    paths = _build_input_files() + [_CMAKE_CACHE]
+    return max((os.path.getmtime(p) for p in paths if os.path.exists(p)),
+               default=0.0)
+
+
+def _osm_build_key() -> str:
+    """Hash of the OSM build inputs and build configuration. LVGL is a
+    submodule, so its pinned commit stands in for its sources."""
+    h = hashlib.sha256()
+    for path in _build_input_files():
+        h.update(os.path.relpath(path, _OSM_DIR).encode() + b"\0")
+        with open(path, "rb") as f:
+            h.update(f.read())
+    h.update(b"CMakeCache.txt\0" + _build_config())
+    try:
+        h.update(subprocess.run(["git", "-C", _OSM_DIR, "ls-tree", "HEAD", "lvgl"],
+                                capture_output=True, timeout=5).stdout)
+    except (OSError, subprocess.SubprocessError):
+        pass
+    return h.hexdigest()
 
-    finally:
-        osm.stop()
+
+def _cached_binary_path() -> str:
+    return os.path.join(_BUILD_CACHE, _osm_build_key(), "secure_communicator")
+
+
+def _shard(tests: list, durations: dict[str, float], index: int, count: int) -> list:
+    """Longest-processing-time-first split of tests into `count` shards;
+    returns shard `index` (1-based), longest test first. Tests with no
+    recorded time are assumed to take the median of the known ones. Every
+    shard of one run must see the same durations, or the split drifts."""
+    known = sorted(durations.get(fn.__name__, 0.0) for fn in tests
+                   if fn.__name__ in durations)
+    default = known[len(known) // 2] if known else 1.0
+    cost = {fn: durations.get(fn.__name__, default) for fn in tests}
+    bins = [(0.0, []) for _ in range(count)]
+    for fn in sorted(tests, key=cost.get, reverse=True):
+        i = min(range(count), key=lambda b: bins[b][0])
+        bins[i] = (bins[i][0] + cost[fn], bins[i][1] + [fn])
+    return bins[index - 1][1]
 
 
 def main():
+    parser = argparse.ArgumentParser(description="OSM E2E integration tests")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="tests to run in parallel (1 = serially, in-process)")
+    parser.add_argument("--shard", metavar="I/N",
+                        help="run only shard I of N, balanced by the durations "
+                             "recorded in tests/.e2e_durations.json")
+    parser.add_argument("--no-memo", action="store_true",
+                        help="rerun tests that already passed against this binary")
+    parser.add_argument("-k", metavar="SUBSTRING",
+                        help="only run tests whose name contains SUBSTRING")
+    parser.add_argument("--shuffle", type=int, metavar="SEED",
+                        help="run tests in a random order seeded by SEED")
+    parser.add_argument("--list", action="store_true",
+                        help="print the selected test names and exit")
+    parser.add_argument("--repeat", type=int, metavar="N",
+                        help="flake hunt: run each selected test N times, stopping "
+                             "at the first failure (default selection: @flaky tests)")
+    parser.add_argument("--fail-fast", action="store_true",
+                        help="stop at the first failing test")
+    parser.add_argument("--junit-xml", metavar="PATH",
+                        help="also write a JUnit XML report to PATH")
+    args = parser.parse_args()
+    shard = None
+    if args.shard:
+        try:
+            shard = tuple(int(x) for x in args.shard.split("/"))
+            assert len(shard) == 2 and 1 <= shard[0] <= shard[1]
+        except (ValueError, AssertionError):
+            parser.error(f"--shard expects I/N with 1 <= I <= N, got {args.shard!r}")
+
+    if not os.path.isfile(BINARY):
+        cached_binary = _cached_binary_path()
+        if os.path.isfile(cached_binary):
+            os.makedirs(os.path.dirname(_BINARY_ABS), exist_ok=True)
+            shutil.copy2(cached_binary, _BINARY_ABS)
+            print(f"Restored OSM binary for these sources from {cached_binary}")
     if not os.path.isfile(BINARY):
         print(f"ERROR: OSM binary not found at {BINARY}")
         print("Build it first: cd osm/build && cmake .. && make -j$(nproc)")
         sys.exit(1)
 
+    # Every module-level test_* function, in source order (which is also
+    # the Test N numbering used in their output).
+    tests = sorted((fn for name, fn in inspect.getmembers(sys.modules[__name__],
+                                                         inspect.isfunction)
+                    if name.startswith("test_")),
+                   key=lambda fn: fn.__code__.co_firstlineno)
+    if args.k:
+        tests = [fn for fn in tests if args.k in fn.__name__]
+    else:
+        tests = [fn for fn in tests if not getattr(fn, "_debug_only", False)]
+    if args.repeat:
+        if not args.k:
+            tests = [fn for fn in tests if getattr(fn, "_flaky", False)]
+        tests = tests * args.repeat
+        args.no_memo = args.fail_fast = True
+    if args.shuffle is not None:
+        random.Random(args.shuffle).shuffle(tests)
+    if args.list:
+        print("\n".join(fn.__name__ for fn in tests))
+        return
+
     print("=" * 60)
     print("E2E Integration Tests — Offline Secure Messenger")
     print("=" * 60)
 
-    tests = [
-        test_tcp_connectivity,
-        test_send_receive,
-        test_osm_sends_to_ca,
-        test_large_message_fragmentation,
-        test_multiple_osm_instances,
-        test_reconnect,
-        test_key_exchange_envelope,
-        test_unknown_envelope,
-        test_kex_queues_pending_key,
-        test_kex_dedup_pending,
-        test_bidirectional_kex_anonymous,
-        test_encrypted_msg_delivery,
-        test_kex_outbound_no_name,
-        test_pending_key_persistence,
-        test_full_kex_and_multi_message,
-        test_full_kex_flow_via_stdin,
-        test_full_kex_and_messaging_isolated,
-        test_ui_driven_kex_and_messaging,
-        test_offline_queue_delivery,
-        test_ack_basic,
-        test_ca_disconnect_during_burst,
-        test_osm_restart_with_outbox,
-        test_rapid_reconnect,
-        test_kex_interrupted_by_disconnect,
-        test_outbox_overflow,
-        test_bidirectional_queue,
-        test_message_ordering,
-        test_ack_removes_from_outbox,
-        test_offline_message_persistence,
-        test_compose_navigates_to_conversation,
-        test_ca_queue_while_disconnected,
-        # Phase 14: Adversarial tests
-        test_osm_killed_mid_send,
-        test_corrupt_fragment,
-        test_max_size_message,
-        test_stale_connection,
-        test_simultaneous_kex,
-        test_kex_immediate_message,
-        test_kex_while_outbox_full,
-        test_duplicate_message,
-        test_bidirectional_concurrent_send,
-        test_out_of_order_ack,
-        test_two_cas_one_osm,
-        test_send_to_invalid_device,
-        # Phase 16: Hardening tests
-        test_force_kill_persistence,
-        test_contact_delete_and_readd,
-        test_message_delete,
-        test_long_names_and_messages,
-        test_power_cycle_with_outbox,
-        # Phase 17: UI simplification tests
-        test_contact_rename,
-        test_empty_conversation,
-        test_screen_navigation,
-    ]
+    memo_keys = _memo_keys(tests)
+    durations = _load_durations()
+    if shard:
+        tests = _shard(tests, durations, *shard)
+        print(f"Shard {shard[0]}/{shard[1]}: {len(tests)} tests")
+
+    use_memo = not (args.no_memo or os.environ.get("E2E_NO_MEMO"))
+    memo = {}
+    try:
+        with open(_MEMO_FILE) as f:
+            memo = json.load(f)
+    except (OSError, ValueError):
+        pass
 
     passed = 0
     failed = 0
+    skipped = 0
+    cached = 0
+    runnable = []
+    records = []  # (name, outcome, detail, seconds) for --junit-xml
+    telemetry = []
     for test_fn in tests:
-        try:
-            test_fn()
-            passed += 1
-        except AssertionError as e:
-            print(f"  FAIL: {e}")
-            failed += 1
-        except Exception as e:
-            print(f"  ERROR: {e}")
+        if requires_nacl.mark in getattr(test_fn, "pytestmark", []) and not _HAS_NACL:
+            print(f"\n[{test_fn.__name__}] SKIP: pynacl not installed")
+            skipped += 1
+            records.append((test_fn.__name__, "skip", "pynacl not installed", 0.0))
+        elif use_memo and memo.get(memo_keys[test_fn]) == "pass":
+            cached += 1
+            records.append((test_fn.__name__, "skip",
+                            "memo: unchanged since last pass", 0.0))
+        else:
+            runnable.append(test_fn)
+    if cached:
+        print(f"{cached} tests unchanged since they last passed "
+              f"(--no-memo to rerun)")
+
+    # Tests are dominated by OSM start-up and network waits, so they run
+    # side by side in worker processes; each worker gets its own ports via
+    # _pool_worker_init. Output from parallel tests interleaves; use -j 1
+    # for a readable serial log.
+    pool = None
+    if args.jobs <= 1:
+        results = ((fn, _run_test(fn)) for fn in runnable)
+    else:
+        pool = ProcessPoolExecutor(max_workers=args.jobs,
+                                   initializer=_pool_worker_init)
+        futures = {pool.submit(_run_test, fn): fn for fn in runnable}
+        results = ((futures[f], f.result()) for f in as_completed(futures))
+    # One TAP line per finished test, as it finishes, so CI logs stream.
+    try:
+        for n, (test_fn, (outcome, detail, seconds, stats)) in enumerate(results, 1):
+            name = test_fn.__name__
+            durations[name] = round(seconds, 3)
+            records.append((name, outcome, detail, seconds))
+            telemetry.append({"name": name, "outcome": outcome,
+                              "dt": round(seconds, 3), **stats})
+            if outcome == "pass":
+                memo[memo_keys[test_fn]] = "pass"
+                passed += 1
+                print(f"ok {n} - {name}", flush=True)
+                continue
+            memo.pop(memo_keys[test_fn], None)
+            label = "FAIL" if outcome == "fail" else "ERROR"
+            print(f"  {label} [{name}]: {detail}")
+            print(f"not ok {n} - {name}", flush=True)
             failed += 1
+            if args.fail_fast:
+                print("Bail out! --fail-fast")
+                break
+    finally:
+        if pool:
+            # Drops queued tests after a --fail-fast bail-out; tests already
+            # running in a worker still finish.
+            pool.shutdown(cancel_futures=True)
+        if args.junit_xml:
+            _write_junit(args.junit_xml, records)
+        try:
+            with open(_DURATIONS_FILE, "w") as f:
+                json.dump(durations, f, indent=1, sort_keys=True)
+            with open(_TELEMETRY_FILE, "a") as f:
+                f.writelines(json.dumps(t) + "\n" for t in telemetry)
+            # Only current keys are kept, so entries for old builds drop out.
+            live = set(memo_keys.values())
+            with open(_MEMO_FILE, "w") as f:
+                json.dump({k: v for k, v in memo.items() if k in live},
+                          f, indent=1, sort_keys=True)
+        except OSError:
+            pass
+
+    if telemetry:
+        print("\nSlowest tests:")
+        for t in sorted(telemetry, key=lambda t: t["dt"], reverse=True)[:5]:
+            print(f"  {t['dt']:7.2f}s  cpu {t['child_cpu']:5.2f}s  "
+                  f"{t['spawned']} OSM  {t['name']}")
+
+    # Cache a binary only once tests have actually passed against it (a run
+    # of memo hits means it was already cached), and only if it was built
+    # after the last source or config edit (otherwise it may not match the
+    # key). The key itself is hashed last, once a store is likely.
+    if (failed == 0 and runnable
+            and os.path.getmtime(_BINARY_ABS) >= _newest_build_input()):
+        try:
+            cached_binary = _cached_binary_path()
+            if not os.path.isfile(cached_binary):
+                os.makedirs(os.path.dirname(cached_binary), exist_ok=True)
+                shutil.copy2(_BINARY_ABS, cached_binary)
+        except OSError:
+            pass
 
     print("\n" + "=" * 60)
-    print(f"E2E Results: {passed} passed, {failed} failed")
+    print(f"E2E Results: {passed} passed, {failed} failed, {skipped} skipped, "
+          f"{cached} cached")
     print("=" * 60)
     sys.exit(0 if failed == 0 else 1)
 